@@ -1 +1,103 @@
-from lamontypython import app
\ No newline at end of file
+"""
+(la)Monty Python
+
+Command line entry point.
+
+    python -m lamontypython serve [--prod]
+    python -m lamontypython batch [--hurricanes HARVEY IRMA] [--output reports]
+                                  [--workers 4] [--effects state county] [--force]
+                                  [--streamed]
+    python -m lamontypython catalog [--since 2010] [--source dds.csv] [--format csv]
+"""
+import os
+import sys
+import logging
+import argparse
+
+PACKAGE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def serve(args):
+    """
+    Runs the Dash app, under Gunicorn with --prod.
+    """
+    if args.prod:
+        os.execvp("gunicorn", ["gunicorn", "-c", "gunicorn.conf.py", "app:server"])
+    from app import app
+    app.run(debug=args.debug)
+
+
+def batch(args):
+    """
+    Runs the batch analysis and exits non-zero if any scope failed.
+    """
+    from batch import run_batch
+    results = run_batch(args.hurricanes, args.output, args.workers, args.effects, args.force,
+                        args.streamed)
+    failed = [r["hurricane"] for r in results if r["status"] == "failed"]
+    for result in results:
+        resumed = " (resumed)" if result.get("resumed") else ""
+        print(f"{result['hurricane']:<12} {result['status']:<7} {result['seconds']:>8.1f}s{resumed}")
+    if failed:
+        print(f"Failed: {', '.join(failed)}. Rerun the same command to retry them.")
+        sys.exit(1)
+
+
+def build_catalog(args):
+    """
+    Builds the local disaster catalog from OpenFEMA or a downloaded csv.
+    """
+    from backend.catalog import build_catalog, CATALOG_PATH
+    from data.ingest import write_table
+    table = build_catalog(args.source, args.since)
+    write_table(table, os.path.dirname(CATALOG_PATH), os.path.basename(CATALOG_PATH), args.format)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m lamontypython")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    serve_parser = commands.add_parser("serve", help="run the web app")
+    serve_parser.add_argument("--prod", action="store_true", help="serve with Gunicorn")
+    serve_parser.add_argument("--debug", action="store_true", help="Dash debug mode")
+    serve_parser.set_defaults(run=serve)
+
+    batch_parser = commands.add_parser("batch", help="run every hurricane analysis headlessly")
+    batch_parser.add_argument("--hurricanes", nargs="+",
+                              help="hurricane names (default: every configured scope and every hurricane with a track)")
+    batch_parser.add_argument("--output", default="reports",
+                              help="output directory (default: ./reports)")
+    batch_parser.add_argument("--workers", type=int, help="worker processes (default: one per CPU)")
+    batch_parser.add_argument("--effects", nargs="+", default=["state"],
+                              choices=["state", "county", "county_year", "county_disaster"],
+                              help="fixed effects regressions to run (default: state)")
+    batch_parser.add_argument("--force", action="store_true",
+                              help="rerun scopes that already finished")
+    batch_parser.add_argument("--streamed", action="store_true",
+                              help="fit the pooled regression one state-year at a time")
+    batch_parser.set_defaults(run=batch)
+
+    catalog_parser = commands.add_parser("catalog", help="build the local disaster catalog")
+    catalog_parser.add_argument("--since", type=int, default=2010,
+                                help="first fiscal year to include (default: 2010)")
+    catalog_parser.add_argument("--source",
+                                help="DisasterDeclarationsSummaries csv to read instead of downloading")
+    catalog_parser.add_argument("--format", choices=["csv", "parquet"], default="csv")
+    catalog_parser.set_defaults(run=build_catalog)
+
+    args = parser.parse_args(argv)
+    if args.command == "batch":
+        args.output = os.path.abspath(args.output)
+    if getattr(args, "source", None):
+        args.source = os.path.abspath(args.source)
+
+    # Modules import each other as top-level packages (backend, models, ...)
+    # and read their data files relative to this directory.
+    os.chdir(PACKAGE_DIR)
+    sys.path.insert(0, PACKAGE_DIR)
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(name)s %(levelname)s %(message)s")
+    args.run(args)
+
+
+if __name__ == "__main__":
+    main()
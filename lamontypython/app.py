@@ -1,30 +1,52 @@
+import uuid
+import logging
 from dash import Dash, dcc, html, Input, Output, callback
 import dash_bootstrap_components as dbc
 from dash_bootstrap_templates import load_figure_template
 from pages import cross_section, detail_view, about
-from backend import datasets
+from backend import datasets, export, governor, prefetch
+from utils import utils, profiling
 
 
 app = Dash(__name__, suppress_callback_exceptions=True, external_stylesheets=[dbc.themes.SANDSTONE])
 server = app.server
+export.register_export(server)
+utils.register_geometry(server)
+profiling.register_profiling(server)
+governor.register_stats(server)
+prefetch.register_stats(server)
+
+logging.basicConfig(level=logging.INFO, format="%(asctime)s %(name)s %(levelname)s %(message)s")
 
 load_figure_template('sandstone')
-app.layout = dbc.Container([html.Div([
-    dbc.NavbarSimple(
-    children=[
-        dbc.NavItem(dbc.NavLink("Cross-Section", href="/cross_section")),
-        dbc.NavItem(dbc.NavLink("Deep Dive", href="/detail_view")),
-        dbc.NavItem(dbc.NavLink("About", href="/about")),
-    ],
-    brand="FEMA Aid & Demographics",
-    brand_href="#",
-    color="primary",
-    dark=True, 
-    ),
-    dcc.Location(id='url', refresh=False),
-    html.Div(id='page-content')
-])
-])
+
+
+def serve_layout():
+    """
+    Builds the page for each visit, with a new id for the browser tab,
+    so a new query can supersede the tab's previous one from the first.
+    """
+    return dbc.Container([html.Div([
+        dbc.NavbarSimple(
+        children=[
+            dbc.NavItem(dbc.NavLink("Cross-Section", href="/cross_section")),
+            dbc.NavItem(dbc.NavLink("Deep Dive", href="/detail_view")),
+            dbc.NavItem(dbc.NavLink("About", href="/about")),
+        ],
+        brand="FEMA Aid & Demographics",
+        brand_href="#",
+        color="primary",
+        dark=True, 
+        ),
+        dcc.Location(id='url', refresh=False),
+        # A tab reloading the page keeps the id already in its session storage.
+        dcc.Store(id='session-id', storage_type='session', data=uuid.uuid4().hex),
+        html.Div(id='page-content')
+    ])
+    ])
+
+
+app.layout = serve_layout
 
 
 @callback(Output('page-content', 'children'),
@@ -39,5 +61,6 @@ def display_page(pathname):
     else:
         return '404'
 
+
 if __name__ == '__main__':
-    app.run_server(debug=True)
\ No newline at end of file
+    app.run(debug=True)
\ No newline at end of file
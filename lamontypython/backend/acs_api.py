@@ -12,7 +12,12 @@ CensusData information: https://pypi.org/project/CensusData/
 import pandas as pd
 import re
 import censusdata
+from backend import governor, progress
 from backend.api import API
+from backend.cache import SharedCache
+from backend.cancel import check
+from backend.deadline import fetch_with_deadline
+from backend.timing import StageTimer
 pd.set_option('display.expand_frame_repr', False)
 pd.set_option('display.precision', 2)
 
@@ -20,104 +25,226 @@ class ACSapi(API):
     '''
     Class built to pull ACS data.
     '''
-    table_dict = {"detail": ['B01003_001E','B05012_003E','B06011_001E'],
-                "dp": ['DP05_0038PE','DP03_0005PE','DP03_0074PE','DP03_0096PE',
-                    'DP04_0003PE','DP04_0005E','DP04_0047PE','DP04_0089E','DP04_0134E']}
-
-    def __init__(self, states, years):
+    variable_codes = {"population": "B01003_001E", "foreign_born": "B05012_003E",
+                "median_income": "B06011_001E", "black_afam": "DP05_0038PE",
+                "unemp_rate": "DP03_0005PE", "snap_benefits": "DP03_0074PE",
+                "health_insurance_rate": "DP03_0096PE", "vacant_housing_rate": "DP04_0003PE",
+                "rental_vacancy_rate": "DP04_0005E", "median_home_price": "DP04_0089E",
+                "median_rent": "DP04_0134E",
+                # Optional indicators, downloaded only when a query asks for them.
+                "renter_occupied_rate": "DP04_0047PE", "median_age": "B01002_001E",
+                "gini_index": "B19083_001E"}
+    default_variables = ["population", "foreign_born", "median_income", "black_afam",
+                "unemp_rate", "snap_benefits", "health_insurance_rate", "vacant_housing_rate",
+                "rental_vacancy_rate", "median_home_price", "median_rent"]
+    # The Census API accepts 50 variables per call, one of which censusdata uses.
+    max_variables = 49
+    # censusdata table type of each Census variable code prefix.
+    table_types = {"B": "detail", "DP": "profile", "S": "subject"}
+    cache = SharedCache("acs", ttl=7 * 24 * 60 * 60)
+    # Published ACS estimates never change, so columns are kept indefinitely.
+    column_cache = SharedCache("acs_columns", max_entries=512)
+
+    def __init__(self, states, years, cancel_token=None, timer=None, variables=None):
         '''
 		Constructor.
 
         Parameters:
 			-states: list of states to filter on
 			-years: list of years to filter on
+			-cancel_token: optional CancelToken checked between downloads
+			-timer: optional StageTimer to record stage timings in
+			-variables: list of column names from variable_codes, or Census
+			    variable codes, to download; None for default_variables
 		'''
         self.states = states
         self.years = years
-        self.detail_df = None
-        self.dp_df = None
+        self.cancel_token = cancel_token
+        self.timer = timer or StageTimer()
+        self.variables = self.resolve_variables(variables)
+        self.data = None
+        self.freshness = None
+
+
+    @classmethod
+    def resolve_variables(cls, variables=None):
+        '''
+        Class method that completes a requested variable list. Population is
+            always included, since aid per capita is computed from it.
+
+        Input:
+            -variables: list of column names or Census codes, None for the defaults.
+
+        Raises ValueError for a code from a table censusdata cannot download.
+        '''
+        variables = list(variables) if variables else list(cls.default_variables)
+        if "population" not in variables:
+            variables.insert(0, "population")
+        for name in variables:
+            cls.table_type(cls.variable_codes.get(name, name))
+        return list(dict.fromkeys(variables))
+
+
+    @classmethod
+    def table_type(cls, code):
+        '''
+        Class method giving the censusdata table type of a Census variable code:
+            Detail Tables (B), Data Profiles (DP) or Subject Tables (S).
+
+        Input:
+            -code: Census variable code, e.g. "DP03_0005PE".
+
+        Raises ValueError for codes from any other table.
+        '''
+        prefix = re.match('[A-Z]*', code).group()
+        if prefix not in cls.table_types:
+            raise ValueError(f"{code!r} is not a Detail Table, Data Profile or Subject Table variable")
+        return cls.table_types[prefix]
+
+
+    @classmethod
+    def extra_variables(cls, variables=None):
+        '''
+        Class method listing the requested variables that are not defaults.
+
+        Input:
+            -variables: list of column names or Census codes, None for the defaults.
+        '''
+        return [name for name in cls.resolve_variables(variables)
+                if name not in cls.default_variables]
+
+
+    @classmethod
+    def columns_cached(cls, variables, years):
+        '''
+        Class method checking whether every (variable, year) column is in the
+            column cache, so assembling them needs no download.
+
+        Input:
+            -variables: list of column names or Census codes.
+            -years: list of years.
+        '''
+        return all(cls.column_cache.get((cls.variable_codes.get(name, name), year)) is not None
+                   for name in cls.resolve_variables(variables) for year in years)
 
 
     def get_data(self):
         '''
-        Class method that uses CensusData library to pull American Community Survey
-            data using an API. It downloads the two separate tables, outputs them as
-            pandas dataframes.
+        Class method that gets the ACS columns for the input years, serving the
+            last good result if the Census API misses its deadline. ACS tables
+            cover every county, so results are cached by year and variables alone.
+            Sets self.freshness to describe the age of the result.
+        '''
+        key = (tuple(sorted(self.years)), tuple(self.variables))
+        with self.timer.stage("acs.download"):
+            data, self.freshness = fetch_with_deadline(self.cache, key, self.fetch_data,
+                                                       cancel_token=self.cancel_token)
+        self.data = data.copy()
 
-        The two tables correspond to relevant variables pulled from the Detail
-            Tables (detail) and the Data Profiles (dp), respectively. More information
-            can be found in the links below:
+
+    def fetch_data(self, cancel_token=None):
+        '''
+        Class method that assembles the requested variables for every county from
+            the column cache, downloading only the (variable, year) columns not seen
+            before. Missing columns are grouped by year and table, and each group is
+            fetched with as few censusdata calls as the API allows.
+
+        Variables come from the Detail Tables (detail), the Data Profiles (dp) and
+            the Subject Tables (subject). More information can be found in the links below:
 
         Detail: https://data.census.gov/cedsci/all?d=ACS%201-Year%20Estimates%20Detailed%20Tables
         DP: https://www.census.gov/acs/www/data/data-tables-and-tools/data-profiles/
-        '''
-        for table,cols in self.table_dict.items():
-            for year in self.years:
-                if table == "detail":
-                    detail_year = censusdata.download('acs1', year,
-                                    censusdata.censusgeo([('county', '*')]), cols)
-                    detail_year['year'] = year
-                    self.detail_df = pd.concat([self.detail_df,detail_year])
+        Subject: https://www.census.gov/acs/www/data/data-tables-and-tools/subject-tables/
 
-                elif table == "dp":
-                    dp_year = censusdata.download('acs1', year,
+        Input:
+            -cancel_token: optional CancelToken of the fetch, which may be shared
+                by several queries, checked between downloads.
+        '''
+        codes = {name: self.variable_codes.get(name, name) for name in self.variables}
+        columns = {(code, year): self.column_cache.get((code, year))
+                   for code in codes.values() for year in self.years}
+
+        batches = {}
+        for (code, year), column in columns.items():
+            if column is None:
+                batches.setdefault((year, self.table_type(code)), []).append(code)
+
+        progress.page_planned(sum(-(-len(missing) // self.max_variables)
+                                  for missing in batches.values()))
+        for (year, tabletype), missing in batches.items():
+            for i in range(0, len(missing), self.max_variables):
+                check(cancel_token)
+                batch = missing[i:i + self.max_variables]
+                with governor.limit(governor.CENSUS_HOST):
+                    downloaded = censusdata.download('acs1', year,
                                     censusdata.censusgeo([('county', '*')]),
-                                   cols, tabletype='profile')
-                    self.dp_df = pd.concat([self.dp_df,dp_year])
+                                    batch, tabletype=tabletype)
+                progress.page_done()
+                downloaded.index = self.make_geoids(downloaded.index)
+                for code in batch:
+                    columns[(code, year)] = downloaded[code]
+                    self.column_cache.set((code, year), downloaded[code])
+
+        year_dfs = []
+        for year in self.years:
+            year_df = pd.concat({name: columns[(code, year)] for name, code in codes.items()},
+                                axis=1, join='inner')
+            year_df['year'] = year
+            year_dfs.append(year_df)
+
+        return pd.concat(year_dfs)
 
 
     def clean_data(self):
         '''
         Class method that initially calls the "get_data" method that pulls ACS
-            data, merges and then cleans the merged pandas dataframe. It removes any
+            data and then cleans the assembled pandas dataframe. It removes any
             NA or null values, removes missing observations, and creates relevant
             variables from the index. The last step is to filter by the input "states" list.
         '''
 
         self.get_data()
-        self.detail_df = self.make_state_county(self.detail_df)
-        self.dp_df = self.make_state_county(self.dp_df)
-
-        final_df = pd.merge(self.detail_df, self.dp_df, on = ['state_fips','county_fips'], how = 'inner')
-        final_df = final_df.rename(columns={"B01003_001E":"population",
-                "B05012_003E":"foreign_born","B06011_001E":"median_income",
-                "DP05_0038PE":"black_afam","DP03_0005PE":"unemp_rate",
-                "DP03_0074PE":"snap_benefits", "DP03_0096PE":"health_insurance_rate",
-                "DP04_0003PE":"vacant_housing_rate", "DP04_0005E":"rental_vacancy_rate",
-                "DP04_0047PE":"renter_occupied_rate","DP04_0089E":"median_home_price",
-                "DP04_0134E":"median_rent"})
-
-        for col in final_df:
+        check(self.cancel_token)
+        with self.timer.stage("acs.clean"):
+            return self.clean_tables()
+
+
+    def clean_tables(self):
+        '''
+        Class method that cleans the assembled ACS columns.
+        '''
+        final_df = self.data
+        final_df['state_fips'] = final_df.index.str[:2]
+        final_df['county_fips'] = final_df.index.str[2:]
+        final_df = final_df.reset_index(drop=True)
+
+        for col in self.variables:
             final_df = final_df[final_df[col] != -999999999.0]
 
-        final_df["foreign_born"] = 100*(final_df["foreign_born"]/final_df["population"])
+        if "foreign_born" in final_df:
+            final_df["foreign_born"] = 100*(final_df["foreign_born"]/final_df["population"])
 
         final_df = final_df.loc[final_df['state_fips'].isin(self.states)]
 
         return final_df
 
-    def make_state_county(self,data):
+    def make_geoids(self,index):
         '''
-        Class method to generate state and county FIPS code from ACS index.
+        Class method to generate 5-digit state and county FIPS codes from an ACS index.
         '''
-        state_list = []
-        county_list = []
-        for row in data.index:
+        geoids = []
+        for row in index:
             row = str(row)
             _, state, county = re.findall('[0-9]+', row)
-            state_list.append(state)
-            county_list.append(county)
-
-        data['state_fips'] = state_list
-        data['county_fips'] = county_list
+            geoids.append(state + county)
 
-        return data
+        return pd.Index(geoids)
 
 
-def make_acs_api_call(states,years):
+def make_acs_api_call(states,years,variables=None):
     '''
     Functions that makes the call to run ACS class, and return final dataframe.
     '''
-    df_create = ACSapi(states,years)
+    df_create = ACSapi(states,years,variables=variables)
     dataframe = df_create.clean_data()
-    return dataframe
\ No newline at end of file
+    return dataframe
@@ -0,0 +1,222 @@
+"""
+(la)Monty Python
+
+Two-tier cache shared by every process serving the app.
+
+Each process keeps a small in-memory LRU in front of a directory of
+pickled entries on local disk, so a dataset fetched by one worker is
+served from disk by all of the others instead of going back to the
+APIs. The directory defaults to ./cache and can be moved with the
+LAMONTY_CACHE_DIR environment variable (pointing it at /dev/shm gives
+a shared-memory tier with no external service).
+"""
+
+import os
+import time
+import pickle
+import hashlib
+import tempfile
+import threading
+from collections import OrderedDict, namedtuple
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # Windows: no cross-process locking, only threads
+    fcntl = None
+
+CACHE_DIR = os.environ.get("LAMONTY_CACHE_DIR", "cache")
+MEMORY_ENTRIES = int(os.environ.get("LAMONTY_CACHE_MEMORY_ENTRIES", 64))
+
+CacheEntry = namedtuple("CacheEntry", ["value", "created"])
+
+
+class SharedCache:
+    """
+    Cache with a per-process memory tier backed by a shared disk tier.
+    """
+
+    def __init__(self, namespace, directory=None, max_entries=MEMORY_ENTRIES, ttl=None):
+        """
+        Constructor.
+
+        :param namespace: (str) subdirectory that keeps this cache's
+                entries apart from other caches
+        :param directory: (str) root cache directory, defaults to CACHE_DIR
+        :param max_entries: (int) entries kept in this process's memory
+        :param ttl: (float) seconds after which get() treats an entry
+                as missing, None to keep entries forever
+        """
+        self.directory = os.path.join(directory or CACHE_DIR, namespace)
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.memory = OrderedDict()
+        self.lock = threading.Lock()
+        self.key_locks = {}
+
+
+    @staticmethod
+    def digest(key):
+        """
+        Hashes a key into a file-name-safe digest.
+
+        :param key: any value with a stable repr (tuples of str/int)
+
+        :return: (str) hex digest
+        """
+        return hashlib.sha1(repr(key).encode()).hexdigest()
+
+
+    def _path(self, digest):
+        return os.path.join(self.directory, digest + ".pkl")
+
+
+    def _remember(self, digest, entry, mtime):
+        with self.lock:
+            self.memory[digest] = (entry, mtime)
+            self.memory.move_to_end(digest)
+            while len(self.memory) > self.max_entries:
+                self.memory.popitem(last=False)
+
+
+    def get_entry(self, key, remember=True):
+        """
+        Looks up a key in memory, then on disk, ignoring the ttl.
+
+        A memory hit is only trusted while the file on disk is unchanged,
+        so a refresh written by another worker is picked up on the next read.
+
+        :param key: cache key
+        :param remember: (bool) keep an entry read from disk in memory;
+                False for one-off scans that would flush the memory tier
+
+        :return: CacheEntry or None if the key has never been stored
+        """
+        digest = self.digest(key)
+        path = self._path(digest)
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except FileNotFoundError:
+            with self.lock:
+                self.memory.pop(digest, None)
+            return None
+
+        with self.lock:
+            cached = self.memory.get(digest)
+            if cached is not None and cached[1] == mtime:
+                self.memory.move_to_end(digest)
+                return cached[0]
+
+        try:
+            with open(path, "rb") as f:
+                entry = pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return None
+
+        if remember:
+            self._remember(digest, entry, mtime)
+        return entry
+
+
+    def get(self, key, default=None, remember=True):
+        """
+        Gets a cached value that is still within the ttl.
+
+        :param key: cache key
+        :param default: returned on a miss
+        :param remember: (bool) keep a value read from disk in memory
+
+        :return: cached value or default
+        """
+        entry = self.get_entry(key, remember)
+        if entry is None or self.is_expired(entry):
+            return default
+        return entry.value
+
+
+    def is_expired(self, entry):
+        """
+        Checks an entry against the ttl.
+
+        :param entry: CacheEntry
+
+        :return: (bool) True if the entry is older than the ttl
+        """
+        return self.ttl is not None and time.time() - entry.created > self.ttl
+
+
+    def set(self, key, value, remember=True):
+        """
+        Stores a value in memory and writes it atomically to disk.
+
+        :param key: cache key
+        :param value: picklable value
+        :param remember: (bool) also keep the value in memory
+
+        :return: the stored CacheEntry
+        """
+        digest = self.digest(key)
+        entry = CacheEntry(value, time.time())
+        os.makedirs(self.directory, exist_ok=True)
+
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                pickle.dump(entry, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, self._path(digest))
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+        if remember:
+            self._remember(digest, entry, os.stat(self._path(digest)).st_mtime_ns)
+        return entry
+
+
+    @contextmanager
+    def key_lock(self, key):
+        """
+        Holds an exclusive lock on a key across threads and processes,
+        so only one worker computes a missing value at a time.
+
+        :param key: cache key
+        """
+        digest = self.digest(key)
+        with self.lock:
+            thread_lock = self.key_locks.setdefault(digest, threading.Lock())
+
+        with thread_lock:
+            if fcntl is None:
+                yield
+                return
+            os.makedirs(self.directory, exist_ok=True)
+            with open(os.path.join(self.directory, digest + ".lock"), "w") as f:
+                fcntl.flock(f, fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+
+
+    def get_or_set(self, key, compute):
+        """
+        Returns the cached value for a key, computing and storing it on a miss.
+        Concurrent misses for the same key wait for the first one to finish
+        instead of repeating the work.
+
+        :param key: cache key
+        :param compute: zero-argument function producing the value
+
+        :return: cached or freshly computed value
+        """
+        value = self.get(key)
+        if value is not None:
+            return value
+
+        with self.key_lock(key):
+            value = self.get(key)
+            if value is None:
+                value = compute()
+                self.set(key, value)
+
+        return value
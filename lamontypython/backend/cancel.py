@@ -0,0 +1,66 @@
+"""
+(la)Monty Python
+
+Cooperative cancellation for long-running data pulls.
+
+A CancelToken is passed down to the API classes, which check it
+between upstream pages and pipeline stages and stop early once it
+has been cancelled.
+"""
+
+import threading
+
+
+class QueryCancelled(Exception):
+    """
+    Raised inside a pipeline when its CancelToken has been cancelled.
+    """
+
+
+class CancelToken:
+    """
+    Flag shared between a query and everything working on it.
+    """
+
+    def __init__(self):
+        """
+        Constructor.
+        """
+        self.event = threading.Event()
+        self.reason = None
+
+
+    def cancel(self, reason="cancelled"):
+        """
+        Cancels the query. Work already in progress stops at its next check.
+
+        :param reason: (str) why the query was cancelled
+        """
+        self.reason = reason
+        self.event.set()
+
+
+    @property
+    def cancelled(self):
+        """
+        :return: (bool) True once cancel() has been called
+        """
+        return self.event.is_set()
+
+
+    def raise_if_cancelled(self):
+        """
+        Raises QueryCancelled if the query has been cancelled.
+        """
+        if self.cancelled:
+            raise QueryCancelled(self.reason)
+
+
+def check(cancel_token):
+    """
+    Checks an optional token, doing nothing when there is none.
+
+    :param cancel_token: CancelToken or None
+    """
+    if cancel_token is not None:
+        cancel_token.raise_if_cancelled()
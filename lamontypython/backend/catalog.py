@@ -0,0 +1,281 @@
+"""
+(la)Monty Python
+
+Local catalog of FEMA disaster declarations.
+
+The catalog is one table of OpenFEMA Disaster Declarations Summaries
+rows (one per declared county), built once with
+
+    python -m lamontypython catalog [--since 2010] [--source dds.csv]
+
+and written to data/disaster_catalog.csv (or .parquet). The app loads
+it once per process and indexes it in memory by disaster number, title
+word, incident type, state and year, so a disaster's counties, states,
+years and dates are found without querying OpenFEMA. FEMAapi also takes
+its declarations from the catalog for years the catalog fully covers.
+"""
+
+import os
+import re
+import logging
+import threading
+import numpy as np
+import pandas as pd
+from utils.utils import read_reference
+
+logger = logging.getLogger(__name__)
+
+CATALOG_PATH = os.path.join("data", "disaster_catalog")
+
+COLUMNS = {"disasterNumber": "int64", "state": str, "declarationDate": str,
+           "fyDeclared": "int64", "incidentType": str, "declarationTitle": str,
+           "incidentBeginDate": str, "incidentEndDate": str,
+           "fipsStateCode": str, "fipsCountyCode": str}
+
+catalog = None
+catalog_lock = threading.Lock()
+
+
+def title_words(title):
+    """
+    Splits a declaration title into upper-case words.
+
+    :param title: (str) declaration title, e.g. "HURRICANE HARVEY"
+
+    :return: (set) words
+    """
+    return set(re.findall(r"[A-Z0-9]+", str(title).upper()))
+
+
+def clean_declarations(dds):
+    """
+    Normalizes DDS rows: typed columns, zero-padded FIPS codes and one
+    row per (disaster, county).
+
+    :param dds: Pandas dataframe of DDS rows with the COLUMNS columns
+
+    :return: Pandas dataframe
+    """
+    dds = dds[list(COLUMNS)].dropna(subset=["disasterNumber", "fipsStateCode"])
+    text = [column for column, dtype in COLUMNS.items() if dtype is str]
+    dds = dds.assign(**{column: dds[column].fillna("") for column in text}).astype(COLUMNS)
+    dds["fipsStateCode"] = dds["fipsStateCode"].str.zfill(2)
+    dds["fipsCountyCode"] = dds["fipsCountyCode"].str.zfill(3)
+    return (dds.drop_duplicates(["disasterNumber", "fipsStateCode", "fipsCountyCode"])
+            .sort_values(["disasterNumber", "fipsStateCode", "fipsCountyCode"])
+            .reset_index(drop=True))
+
+
+def download_declarations(since=None):
+    """
+    Downloads DDS rows from OpenFEMA, a page at a time.
+
+    :param since: (int) first fiscal year to include, None for all
+
+    :return: Pandas dataframe
+    """
+    from backend.fema_api import FEMAapi
+
+    api = FEMAapi([], [])
+    filter_path = f"&$filter=fyDeclared ge {since}" if since else ""
+    return api.get_dataset("dds", filter_path)
+
+
+def read_declarations(path, since=None, chunksize=200_000):
+    """
+    Reads DDS rows from a DisasterDeclarationsSummaries csv downloaded
+    from OpenFEMA, in chunks with only the needed columns.
+
+    :param path: (str) path to the csv
+    :param since: (int) first fiscal year to include, None for all
+    :param chunksize: (int) rows per chunk
+
+    :return: Pandas dataframe
+    """
+    chunks = []
+    for chunk in pd.read_csv(path, usecols=list(COLUMNS), dtype=str, chunksize=chunksize):
+        if since:
+            chunk = chunk[pd.to_numeric(chunk["fyDeclared"]) >= since]
+        chunks.append(chunk)
+    return pd.concat(chunks, ignore_index=True)
+
+
+def build_catalog(source=None, since=None):
+    """
+    Builds the catalog table from OpenFEMA or a downloaded csv.
+
+    :param source: (str) path to a DDS csv, None to download
+    :param since: (int) first fiscal year to include, None for all
+
+    :return: Pandas dataframe
+    """
+    dds = read_declarations(source, since) if source else download_declarations(since)
+    return clean_declarations(dds)
+
+
+class DisasterCatalog:
+    """
+    In-memory indexes over the catalog table.
+    """
+
+    def __init__(self, table):
+        """
+        Constructor.
+
+        :param table: Pandas dataframe from build_catalog
+        """
+        self.table = clean_declarations(table)
+        self.first_year = int(self.table["fyDeclared"].min())
+        self.last_year = int(self.table["fyDeclared"].max())
+
+        # Rows of each disaster are contiguous, so a disaster is a slice.
+        numbers = self.table["disasterNumber"].to_numpy()
+        starts = np.flatnonzero(np.r_[True, numbers[1:] != numbers[:-1]])
+        ends = np.r_[starts[1:], len(numbers)]
+        self.rows = {int(numbers[s]): (int(s), int(e)) for s, e in zip(starts, ends)}
+
+        first = self.table.iloc[starts]
+        self.types = dict(zip(first["disasterNumber"].tolist(), first["incidentType"]))
+        self.by_word = {}
+        for number, title in zip(first["disasterNumber"], first["declarationTitle"]):
+            for word in title_words(title):
+                self.by_word.setdefault(word, set()).add(int(number))
+        self.by_type = self.index("incidentType")
+        self.by_state = self.index("fipsStateCode")
+        self.by_year = self.index("fyDeclared")
+
+
+    def index(self, column):
+        """
+        Maps each value of a column to the disaster numbers having it.
+
+        :param column: (str) catalog column
+
+        :return: (dict) value to set of disaster numbers
+        """
+        pairs = self.table[[column, "disasterNumber"]].drop_duplicates()
+        return {value: set(group.tolist())
+                for value, group in pairs.groupby(column)["disasterNumber"]}
+
+
+    def declarations(self, number):
+        """
+        :param number: (int) disaster number
+
+        :return: Pandas dataframe of the disaster's declared counties
+        """
+        start, end = self.rows.get(int(number), (0, 0))
+        return self.table.iloc[start:end]
+
+
+    def find(self, title=None, incident_type=None, states=None, years=None):
+        """
+        Finds disasters matching every given filter.
+
+        :param title: (str) words that must all appear in the title
+        :param incident_type: (str) e.g. "Hurricane"
+        :param states: (lst) state FIPS codes, any of which may match
+        :param years: (lst) fiscal years declared, any of which may match
+
+        :return: (lst) sorted disaster numbers
+        """
+        matches = []
+        if title:
+            matches.extend(self.by_word.get(word, set()) for word in title_words(title))
+        if incident_type:
+            matches.append(self.by_type.get(incident_type, set()))
+        if states is not None:
+            matches.append(set().union(*(self.by_state.get(s, set()) for s in states)))
+        if years is not None:
+            matches.append(set().union(*(self.by_year.get(int(y), set()) for y in years)))
+        if not matches:
+            return sorted(self.rows)
+        return sorted(set.intersection(*matches))
+
+
+    def scope(self, numbers):
+        """
+        Describes the area and time covered by disasters.
+
+        :param numbers: (lst) disaster numbers
+
+        :return: (dict) "counties_fips", "states_fips", "year", "begin" and
+                "end", with the first three in the same shape as the entries
+                of hurricane_scope.json. None if no disaster is found.
+        """
+        if not numbers:
+            return None
+        rows = pd.concat([self.declarations(n) for n in numbers])
+        if rows.empty:
+            return None
+        counties = rows[rows["fipsCountyCode"] != "000"]
+        return {"counties_fips": sorted(set(counties["fipsStateCode"] + counties["fipsCountyCode"])),
+                "states_fips": sorted(set(rows["fipsStateCode"])),
+                "year": sorted(set(rows["fyDeclared"].tolist())),
+                "begin": rows["incidentBeginDate"].min(),
+                "end": rows["incidentEndDate"].max()}
+
+
+    def hurricane_scope(self, name, years=None):
+        """
+        Scope of the hurricane declarations named after a storm.
+
+        :param name: (str) storm name, e.g. "HARVEY"
+        :param years: (lst) seasons to consider, None for any
+
+        :return: (dict) see scope, or None if the catalog has no match
+        """
+        numbers = self.find(title=name, incident_type="Hurricane", years=years)
+        return self.scope(numbers) if numbers else None
+
+
+    def covers(self, years):
+        """
+        Checks the catalog holds every declaration of the given years.
+        Its latest year may still be growing, so it is not covered.
+
+        :param years: (lst) fiscal years
+
+        :return: (bool)
+        """
+        return all(self.first_year <= int(year) < self.last_year for year in years)
+
+
+    def dds_rows(self, states, years):
+        """
+        DDS rows for states and years, in the shape OpenFEMA returns them.
+
+        :param states: (lst) state FIPS codes
+        :param years: (lst) fiscal years
+
+        :return: Pandas dataframe
+        """
+        rows = self.table[self.table["fipsStateCode"].isin(states)
+                          & self.table["fyDeclared"].isin([int(y) for y in years])]
+        return rows.reset_index(drop=True).rename_axis("id").reset_index()
+
+
+    def incident_types(self, states, years):
+        """
+        :param states: (lst) state FIPS codes
+        :param years: (lst) fiscal years
+
+        :return: (lst) sorted incident types declared in the states and years
+        """
+        return sorted({self.types[number] for number in self.find(states=states, years=years)})
+
+
+def get_catalog():
+    """
+    Loads the catalog on first use.
+
+    :return: DisasterCatalog, or None if the catalog has not been built
+    """
+    global catalog
+    with catalog_lock:
+        if catalog is None and (os.path.exists(CATALOG_PATH + ".csv")
+                                or os.path.exists(CATALOG_PATH + ".parquet")):
+            catalog = DisasterCatalog(read_reference(CATALOG_PATH, dtype=str))
+            logger.info("Loaded disaster catalog: %d disasters, fiscal years %d-%d",
+                        len(catalog.rows), catalog.first_year, catalog.last_year)
+    return catalog
@@ -8,8 +8,13 @@ and combine into a single dataframe.
 """
 
 import pandas as pd
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_EXCEPTION
 from backend.fema_api import FEMAapi
 from backend.acs_api import ACSapi
+from backend.cancel import CancelToken
+from backend.deadline import combine_freshness
+from backend.timing import StageTimer
+from backend import workers
 
 
 def write_data_to_csv(dataframe, filename):
@@ -22,58 +27,94 @@ def write_data_to_csv(dataframe, filename):
     dataframe.to_csv(filename, index=False)
 
 
-def get_data(states, years):
+def fetch_data(states, years, cancel_token=None, variables=None):
     """
-    Calls the FEMA and ACS API functions to get data
-    from each based on the given states and years.
+    Downloads and merges FEMA and ACS data, bypassing the cache
+    (backend/partitions.py caches the result by state and year).
+    The FEMA and ACS pipelines run concurrently; if either fails
+    the other is cancelled. Stage timings are logged and stored
+    in the dataframe's attrs["timings"].
 
     :param states: (lst) states to include
     :param years: (lst) years to include
+    :param cancel_token: optional CancelToken to stop the download early
+    :param variables: (lst) ACS variables to include, None for the defaults
 
     :return: Pandas dataframe of the combined FEMA
             and ACS data for the given years
     """
-    fema_df = make_fema_api_call(states, years)
-    acs_df = make_acs_api_call(states, years)
-
-    merged_df = pd.merge(acs_df, fema_df, how="left",
-                        left_on=["county_fips", "state_fips", "year"],
-                        right_on=["county_fips", "state_fips", "year"])
-
-    merged_df['aid_per_capita'] = merged_df['aid_requested'] / merged_df['population']
-
-    merged_df = merged_df[merged_df['disaster_number'].notna()]
-    merged_df = merged_df.fillna(0)
+    cancel_token = cancel_token or CancelToken()
+    timer = StageTimer()
+
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        fema_future = workers.submit(pool, make_fema_api_call, states, years, cancel_token, timer)
+        acs_future = workers.submit(pool, make_acs_api_call, states, years, cancel_token, timer,
+                                    variables)
+        done, _ = wait([fema_future, acs_future], return_when=FIRST_EXCEPTION)
+        for future in done:
+            if future.exception() is not None:
+                cancel_token.cancel(f"sibling pipeline failed: {future.exception()!r}")
+                raise future.exception()
+        fema_df = fema_future.result()
+        acs_df = acs_future.result()
+
+    with timer.stage("merge"):
+        # ACS has one row per county and year, so this can only fan out
+        # over the disasters declared in each county.
+        merged_df = pd.merge(acs_df, fema_df, how="left",
+                            left_on=["county_fips", "state_fips", "year"],
+                            right_on=["county_fips", "state_fips", "year"],
+                            validate="one_to_many")
+
+        merged_df['aid_per_capita'] = merged_df['aid_requested'] / merged_df['population']
+
+        merged_df = merged_df[merged_df['disaster_number'].notna()]
+        merged_df = merged_df.fillna(0)
+
+    timer.log(f"states={list(states)} years={list(years)}")
+    merged_df.attrs["freshness"] = combine_freshness([fema_df.attrs.get("freshness"),
+                                                      acs_df.attrs.get("freshness")])
+    merged_df.attrs["timings"] = timer.summary()
 
     return merged_df
 
 
-def make_fema_api_call(states, years):
+def make_fema_api_call(states, years, cancel_token=None, timer=None):
     """
     Creates an instance of the FEMAapi class
     to get data for given states and years.
 
     :param states: (lst) states to include
     :param years: (lst) years to include
+    :param cancel_token: optional CancelToken to stop the download early
+    :param timer: optional StageTimer to record stage timings in
 
     :return: Pandas dataframe of resulting FEMA data
     """
-    fema_api_call = FEMAapi(states, years)
-    dataframes = fema_api_call.get_data()
-    fema_api_call.clean_data(dataframes)
+    fema_api_call = FEMAapi(states, years, cancel_token, timer)
+    with fema_api_call.timer.stage("fema"):
+        dataframes = fema_api_call.get_data()
+        with fema_api_call.timer.stage("fema.clean"):
+            fema_api_call.clean_data(dataframes)
+    fema_api_call.data.attrs["freshness"] = fema_api_call.freshness
     return fema_api_call.data
 
 
-def make_acs_api_call(states, years):
+def make_acs_api_call(states, years, cancel_token=None, timer=None, variables=None):
     """
     Creates an instance of the ACSapi class
     to get data for given states and years.
 
     :param states: (lst) states to include
     :param years: (lst) years to include
+    :param cancel_token: optional CancelToken to stop the download early
+    :param timer: optional StageTimer to record stage timings in
+    :param variables: (lst) ACS variables to include, None for the defaults
 
     :return: Pandas dataframe of resulting ACS data
     """
-    acs_api_call = ACSapi(states, years)
-    dataframe = acs_api_call.clean_data()
+    acs_api_call = ACSapi(states, years, cancel_token, timer, variables)
+    with acs_api_call.timer.stage("acs"):
+        dataframe = acs_api_call.clean_data()
+    dataframe.attrs["freshness"] = acs_api_call.freshness
     return dataframe
@@ -0,0 +1,200 @@
+"""
+(la)Monty Python
+
+Deadline-bounded fetches with a stale-while-revalidate fallback.
+
+An upstream fetch is started in a background thread. If it finishes
+within the deadline its result is cached and returned. If it does not,
+the last good cached result for the same query is returned straight
+away and the fetch keeps running to refresh the cache for next time.
+
+Concurrent queries for the same key share one fetch. A query that is
+cancelled stops waiting straight away, but the shared fetch is only
+cancelled once no query is waiting on it or wants its result cached.
+"""
+
+import os
+import time
+import threading
+import contextvars
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
+from backend import governor, workers
+from backend.cancel import CancelToken, QueryCancelled
+
+FETCH_DEADLINE = float(os.environ.get("LAMONTY_FETCH_DEADLINE", 8))
+HARD_DEADLINE = float(os.environ.get("LAMONTY_FETCH_HARD_DEADLINE", 180))
+REQUEST_TIMEOUT = float(os.environ.get("LAMONTY_REQUEST_TIMEOUT", 30))
+# How often a waiting query checks whether it has been cancelled.
+CANCEL_POLL = 0.1
+
+executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix="fetch")
+inflight = {}
+inflight_lock = threading.Lock()
+
+
+def make_freshness(fetched_at, stale, source):
+    """
+    Builds the freshness metadata attached to fetched data.
+
+    :param fetched_at: (float) epoch seconds when the data was downloaded
+    :param stale: (bool) True if newer data is still being fetched
+    :param source: (str) "live", "cache" or "stale-cache"
+
+    :return: (dict) freshness metadata
+    """
+    return {"fetched_at": fetched_at, "stale": stale, "source": source}
+
+
+def combine_freshness(freshness_list):
+    """
+    Combines the freshness of several inputs into that of their merge,
+    which is as old as its oldest input.
+
+    :param freshness_list: (lst) freshness dicts
+
+    :return: (dict) freshness metadata
+    """
+    freshness_list = [f for f in freshness_list if f]
+    if not freshness_list:
+        return make_freshness(time.time(), False, "live")
+
+    oldest = min(freshness_list, key=lambda f: f["fetched_at"])
+    return make_freshness(oldest["fetched_at"],
+                          any(f["stale"] for f in freshness_list),
+                          oldest["source"])
+
+
+class SharedFetch:
+    """
+    An upstream fetch and the queries waiting on it.
+    """
+
+    def __init__(self):
+        """
+        Constructor.
+        """
+        self.token = CancelToken()
+        self.future = None
+        self.waiters = 0
+        # Set once a query has served stale data and left the fetch
+        # running to refresh the cache.
+        self.keep = False
+
+
+    def wait(self, timeout, cancel_token=None):
+        """
+        Waits for the fetch as one of its queries. If the query is
+        cancelled it stops waiting, and the fetch is cancelled too
+        when it was the last query interested in the result.
+
+        :param timeout: (float) seconds to wait
+        :param cancel_token: optional CancelToken of the waiting query
+
+        :return: the fetched value
+        """
+        with inflight_lock:
+            self.waiters += 1
+        end = time.monotonic() + timeout
+        try:
+            while True:
+                if cancel_token is not None and cancel_token.cancelled:
+                    with inflight_lock:
+                        if self.waiters == 1 and not self.keep:
+                            self.token.cancel("no query is waiting for this fetch")
+                    cancel_token.raise_if_cancelled()
+                remaining = end - time.monotonic()
+                try:
+                    return self.future.result(timeout=min(CANCEL_POLL, max(remaining, 0)))
+                except FutureTimeout:
+                    if remaining <= 0:
+                        with inflight_lock:
+                            self.keep = True
+                        raise
+        finally:
+            with inflight_lock:
+                self.waiters -= 1
+
+
+def submit_refresh(cache, key, fetch, background=False):
+    """
+    Starts fetching a key in the background unless a fetch for it is
+    already running, storing the result in the cache when it completes.
+
+    :param cache: SharedCache to refresh
+    :param key: cache key
+    :param fetch: function producing the value, given the fetch's CancelToken
+    :param background: (bool) run the fetch's upstream calls at background
+            priority instead of the caller's
+
+    :return: SharedFetch for the key
+    """
+    digest = (cache.directory, cache.digest(key))
+    with inflight_lock:
+        shared = inflight.get(digest)
+        if shared is not None and not shared.token.cancelled:
+            return shared
+
+        shared = SharedFetch()
+
+        def run():
+            try:
+                value = fetch(shared.token)
+                cache.set(key, value)
+                return value
+            finally:
+                with inflight_lock:
+                    # A cancelled fetch may already have been replaced.
+                    if inflight.get(digest) is shared:
+                        inflight.pop(digest)
+
+        context = contextvars.copy_context()
+        if background:
+            context.run(governor.priority.set, governor.BACKGROUND)
+        shared.future = executor.submit(workers.in_context(run, context))
+        inflight[digest] = shared
+        return shared
+
+
+def fetch_with_deadline(cache, key, fetch, deadline=FETCH_DEADLINE, cancel_token=None):
+    """
+    Gets a value from the cache or upstream, waiting at most `deadline`
+    seconds for upstream when an older cached copy can be served instead.
+    With nothing cached, waits up to HARD_DEADLINE seconds. Upstream
+    errors are raised only when there is no cached copy to fall back to.
+
+    :param cache: SharedCache holding the last good results
+    :param key: cache key for the query
+    :param fetch: function that queries upstream, given a CancelToken to check
+    :param deadline: (float) seconds to wait before serving stale data
+    :param cancel_token: optional CancelToken of the query; cancelling it
+            raises QueryCancelled here without disturbing other queries
+            sharing the same fetch
+
+    :return: the value and (dict) its freshness metadata
+    """
+    entry = cache.get_entry(key)
+    if entry is not None and not cache.is_expired(entry):
+        return entry.value, make_freshness(entry.created, False, "cache")
+
+    # With an older copy to fall back on, the refresh can yield to
+    # requests from users who have nothing to show yet.
+    shared = submit_refresh(cache, key, fetch, background=entry is not None)
+    try:
+        value = shared.wait(deadline if entry is not None else HARD_DEADLINE, cancel_token)
+    except FutureTimeout:
+        if entry is None:
+            raise TimeoutError(f"Upstream fetch exceeded {HARD_DEADLINE}s")
+        return entry.value, make_freshness(entry.created, True, "stale-cache")
+    except QueryCancelled:
+        if cancel_token is not None and cancel_token.cancelled:
+            raise
+        # This query joined a shared fetch just as its last other query
+        # cancelled it, so start a fresh one.
+        return fetch_with_deadline(cache, key, fetch, deadline, cancel_token)
+    except Exception:
+        # Upstream errors also fall back to the last good result.
+        if entry is None:
+            raise
+        return entry.value, make_freshness(entry.created, True, "stale-cache")
+
+    return value, make_freshness(time.time(), False, "live")
@@ -0,0 +1,266 @@
+"""
+(la)Monty Python
+
+Streaming bulk export of query results.
+
+Registers an /export route on the Flask server behind the Dash app.
+It accepts the same filters as the cross-section view and streams the
+merged FEMA and ACS data one (state, year) partition at a time, as csv
+or as an Arrow IPC stream. Data is loaded a year at a time, so memory
+use is bounded by one year of the selected states rather than the
+whole range, and bytes start flowing once the first year is ready.
+
+    /export?state=Texas&state=Louisiana&start=2015&end=2017
+           &incident_type=Hurricane&format=csv
+"""
+
+import json
+import logging
+import itertools
+import pandas as pd
+from urllib.parse import urlencode
+from flask import Response, request, stream_with_context
+from backend import partitions
+
+try:
+    import pyarrow as pa
+except ImportError:  # Arrow export is optional
+    pa = None
+
+logger = logging.getLogger(__name__)
+
+# Types of the columns whose type cannot be taken from the data: text
+# columns that are all missing in a partition come back as floats. Every
+# other column keeps the type of its first batch.
+TEXT_COLUMNS = ["state_fips", "county_fips", "state", "declaration_date", "incident_type",
+                "disaster_name", "incident_begin_date", "incident_end_date"]
+INTEGER_COLUMNS = ["year"]
+
+with open('data/statestofips.json', 'r') as f:
+    states_lookup = json.load(f)
+
+
+def export_url(states, years, incident_types, file_format="csv"):
+    """
+    Builds an /export link for a set of cross-section filters.
+
+    :param states: (lst) state names
+    :param years: (lst) endpoints of the year range
+    :param incident_types: (lst) incident types, empty for all
+    :param file_format: (str) "csv" or "arrow"
+
+    :return: (str) relative URL
+    """
+    params = [("state", state) for state in states]
+    params += [("start", min(years)), ("end", max(years))]
+    params += [("incident_type", incident) for incident in incident_types]
+    params.append(("format", file_format))
+    return "/export?" + urlencode(params)
+
+
+def parse_filters(args):
+    """
+    Reads export filters from request arguments. States may be given
+    by name or FIPS code.
+
+    :param args: request query arguments
+
+    :return: (lst) state FIPS codes, (lst) years, (lst) incident types
+    """
+    state_codes = [states_lookup.get(state, state) for state in args.getlist("state")]
+    start = args.get("start", type=int)
+    end = args.get("end", type=int, default=start)
+    if not state_codes or start is None:
+        raise ValueError("state and start are required")
+
+    return state_codes, partitions.expand_years([start, end]), args.getlist("incident_type")
+
+
+def iter_batches(state_codes, years, incident_types):
+    """
+    Yields the export one partition at a time. Missing partitions are
+    downloaded a year at a time, so at most one year is held in memory.
+    A year with no rows yields an empty batch, so the columns are known
+    even when the whole selection is empty.
+
+    :return: Pandas dataframes, one per (state, year)
+    """
+    for year in years:
+        year_df = partitions.get_data(state_codes, [year])
+        if incident_types:
+            year_df = year_df[year_df["incident_type"].isin(incident_types)]
+        if year_df.empty:
+            yield year_df
+            continue
+        for _, batch in year_df.groupby("state_fips", sort=True):
+            yield batch
+
+
+def guard(chunks, file_format):
+    """
+    Logs an error raised while streaming, then re-raises it so the server
+    aborts the response instead of ending it cleanly. A csv gets a last
+    line saying the export failed, since its readers cannot otherwise
+    tell a cut-off file from a complete one; an Arrow stream cut off
+    before its end marker already fails to read.
+
+    :param chunks: generator of encoded chunks
+    :param file_format: (str) "csv" or "arrow"
+    """
+    try:
+        yield from chunks
+    except Exception as e:
+        logger.exception("Export failed partway through")
+        if file_format == "csv":
+            yield f"# EXPORT FAILED, the data above is incomplete: {e!r}\n"
+        raise
+
+
+def stream_csv(batches):
+    """
+    Encodes batches as csv with a single header row.
+    """
+    columns = None
+    for batch in batches:
+        if columns is None:
+            columns = list(batch.columns)
+            yield batch.to_csv(index=False)
+        elif not batch.empty:
+            yield batch.reindex(columns=columns).to_csv(index=False, header=False)
+
+
+class ChunkSink:
+    """
+    Writable file object that hands written bytes back to a generator.
+    """
+
+    def __init__(self):
+        self.chunks = []
+        self.closed = False
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def drain(self):
+        """
+        :return: (bytes) everything written since the last drain
+        """
+        data = b"".join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def arrow_schema(batch):
+    """
+    Arrow schema of the export, from the dtypes of its first batch with
+    the types of TEXT_COLUMNS and INTEGER_COLUMNS fixed. Columns with no
+    values to infer a type from are exported as text.
+
+    :param batch: Pandas dataframe, possibly empty
+
+    :return: pyarrow Schema
+    """
+    inferred = pa.Schema.from_pandas(batch, preserve_index=False)
+
+    def arrow_type(column):
+        if column in TEXT_COLUMNS:
+            return pa.string()
+        if column in INTEGER_COLUMNS:
+            return pa.int64()
+        inferred_type = inferred.field(column).type
+        if pa.types.is_null(inferred_type) or pa.types.is_large_string(inferred_type):
+            return pa.string()
+        return inferred_type
+
+    return pa.schema([(column, arrow_type(column)) for column in batch.columns])
+
+
+def to_record_batch(batch, schema):
+    """
+    Converts a batch to the export schema.
+
+    :param batch: Pandas dataframe
+    :param schema: pyarrow Schema from arrow_schema
+
+    :return: pyarrow RecordBatch
+    """
+    batch = batch.reindex(columns=schema.names)
+    arrays = []
+    for field in schema:
+        column = batch[field.name]
+        if pa.types.is_string(field.type):
+            column = column.astype("string")
+        elif pa.types.is_integer(field.type):
+            column = column.astype("Int64")
+        elif pa.types.is_floating(field.type):
+            column = column.astype("float64")
+        arrays.append(pa.array(column, type=field.type, from_pandas=True))
+    return pa.RecordBatch.from_arrays(arrays, schema=schema)
+
+
+def stream_arrow(batches):
+    """
+    Encodes batches as an Arrow IPC stream, with the schema given by
+    arrow_schema for the first batch.
+    """
+    sink = ChunkSink()
+    writer = None
+    for batch in batches:
+        if writer is None:
+            schema = arrow_schema(batch)
+            writer = pa.ipc.new_stream(pa.PythonFile(sink, mode="w"), schema)
+        writer.write_batch(to_record_batch(batch, schema))
+        yield sink.drain()
+
+    if writer is not None:
+        writer.close()
+        yield sink.drain()
+
+
+def export():
+    """
+    Flask view streaming the filtered query results.
+    """
+    try:
+        state_codes, years, incident_types = parse_filters(request.args)
+    except ValueError as e:
+        return Response(str(e), status=400, mimetype="text/plain")
+
+    file_format = request.args.get("format", "csv")
+    if file_format == "arrow" and pa is None:
+        return Response("Arrow export requires pyarrow", status=501, mimetype="text/plain")
+    if file_format not in ("csv", "arrow"):
+        return Response("format must be csv or arrow", status=400, mimetype="text/plain")
+
+    batches = iter_batches(state_codes, years, incident_types)
+    try:
+        # Errors in the first year still get a proper error response.
+        first = next(batches)
+    except Exception as e:
+        logger.exception("Export failed")
+        return Response(f"Export failed: {e!r}", status=502, mimetype="text/plain")
+    batches = itertools.chain([first], batches)
+    filename = f"fema_acs_{min(years)}_{max(years)}.{file_format}"
+    if file_format == "csv":
+        body, mimetype = stream_csv(batches), "text/csv"
+    else:
+        body, mimetype = stream_arrow(batches), "application/vnd.apache.arrow.stream"
+
+    return Response(stream_with_context(guard(body, file_format)), mimetype=mimetype,
+                    headers={"Content-Disposition": f"attachment; filename={filename}"})
+
+
+def register_export(server):
+    """
+    Adds the /export route to the Flask server.
+
+    :param server: Flask app behind the Dash app
+    """
+    server.add_url_rule("/export", "export", export)
@@ -12,9 +12,18 @@ https://www.fema.gov/about/openfema/developer-resources.
 
 import json
 import math
+import logging
 import requests
 import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
+from backend import governor, progress, catalog, workers
 from backend.api import API
+from backend.cache import SharedCache
+from backend.cancel import check
+from backend.deadline import fetch_with_deadline, REQUEST_TIMEOUT
+from backend.timing import StageTimer
+
+logger = logging.getLogger(__name__)
 
 
 class FEMAapi(API):
@@ -24,6 +33,8 @@ class FEMAapi(API):
     base_path = "https://www.fema.gov/api/open"
     record_count_path = "?$inlinecount=allpages&$select=id&$top=1"
     top = 1000
+    page_workers = 4
+    cache = SharedCache("fema", ttl=6 * 60 * 60)
 
     dataset_dict = {"dds": ("/v2/DisasterDeclarationsSummaries", """?$select=disasterNumber,
                             state,declarationDate,fyDeclared,incidentType,declarationTitle,
@@ -35,16 +46,21 @@ class FEMAapi(API):
                     "ms": ("/v1/MissionAssignments", """?$select=disasterNumber,zip,
                             requestedAmount,obligationAmount""")}
 
-    def __init__(self, states, years):
+    def __init__(self, states, years, cancel_token=None, timer=None):
         """
         Constructor.
 
         :param states: list of states to filter on
         :param years: list of years to filter on
+        :param cancel_token: optional CancelToken checked between pages
+        :param timer: optional StageTimer to record stage timings in
         """
         self.states = states
         self.years = years
+        self.cancel_token = cancel_token
+        self.timer = timer or StageTimer()
         self.disasters = None
+        self.freshness = None
         self.data = pd.DataFrame()
         self.zip_df = self.get_zip_fips_df()
 
@@ -55,11 +71,17 @@ class FEMAapi(API):
 
         :return: Pandas dataframe with zip codes and corresponding county codes.
         """
-        zip_df = pd.read_csv("data/zip_to_fips_2017.csv")
-        zip_df["STCOUNTYFP"] = zip_df["STCOUNTYFP"].astype(str)
-        zip_df["ZIP"] = zip_df["ZIP"].astype(str)
-        zip_df['county_fips'] = zip_df.STCOUNTYFP.str[-3:]
-        zip_df = zip_df.drop(['COUNTYNAME', 'STATE', 'STCOUNTYFP', 'CLASSFP'], axis=1)
+        # Read as strings so leading zeros in zip codes and state codes survive.
+        zip_df = pd.read_csv("data/zip_to_fips_2017.csv", dtype=str,
+                             usecols=['ZIP', 'STCOUNTYFP'])
+        zip_df["ZIP"] = zip_df["ZIP"].str.zfill(5)
+        zip_df["STCOUNTYFP"] = zip_df["STCOUNTYFP"].str.zfill(5)
+        zip_df['state_fips'] = zip_df.STCOUNTYFP.str[:2]
+        zip_df['county_fips'] = zip_df.STCOUNTYFP.str[2:]
+        zip_df = zip_df.drop(['STCOUNTYFP'], axis=1)
+        # The crosswalk has no population or address ratios, so a zip code
+        # spanning several counties is split evenly between them.
+        zip_df['weight'] = 1 / zip_df.groupby('ZIP')['ZIP'].transform('size')
 
         return zip_df
 
@@ -120,11 +142,13 @@ class FEMAapi(API):
         :return: (int) number of loops required
                 and (int) total record count
         """
-        r = requests.get(
-            cls.base_path
-            + cls.dataset_dict[dataset][0]
-            + cls.record_count_path
-            + filter_path)
+        with governor.limit(cls.base_path):
+            r = requests.get(
+                cls.base_path
+                + cls.dataset_dict[dataset][0]
+                + cls.record_count_path
+                + filter_path,
+                timeout=REQUEST_TIMEOUT)
         if r.status_code != 200:
             raise ValueError("API call failed")
         result = r.text.encode("iso-8859-1")
@@ -136,7 +160,7 @@ class FEMAapi(API):
         return loop_num, count
 
 
-    def get_dataframe(self, dataset, filter_path, loop_num):
+    def get_dataframe(self, dataset, filter_path, loop_num, cancel_token=None):
         """
         Calls the API, looping to get all records, and
         generates a dataframe from the resulting json data.
@@ -144,85 +168,187 @@ class FEMAapi(API):
         :param dataset: (str) dataset to connect to
         :param filter_path: (str) filter path
         :param loop_num: (int) number of iterations required
+        :param cancel_token: optional CancelToken checked before each page
 
         :return: Pandas dataframe with resulting API call data
         """
         endpoint, select_path = self.dataset_dict[dataset]
-        dataframe = pd.DataFrame()
-
-        skip = 0
-        i = 0
-        while i < loop_num:
-            r = requests.get(
-                self.base_path
+        path = (self.base_path
                 + endpoint
                 + select_path.replace("\n", "")
                 + filter_path
-                + "&$metadata=off&$format=jsona&$skip="
-                + str(skip)
-                + "&$top="
-                + str(self.top)
-            )
+                + "&$metadata=off&$format=jsona&$skip=")
+
+        def get_page(i):
+            check(cancel_token)
+            with governor.limit(path):
+                r = requests.get(
+                    path
+                    + str(i * self.top)
+                    + "&$top="
+                    + str(self.top),
+                    timeout=REQUEST_TIMEOUT
+                )
             if r.status_code != 200:
                 raise ValueError("API call failed")
             result = r.text.encode("iso-8859-1")
-            json_data = json.loads(result.decode())
-
-            df = pd.DataFrame(json_data)
-            dataframe = pd.concat([dataframe,df])
+            page = pd.DataFrame(json.loads(result.decode()))
+            progress.page_done()
+            return page
 
-            i += 1
-            skip = i * self.top
+        progress.page_planned(loop_num)
+        # Page offsets are known from the record count, so fetch them concurrently.
+        with ThreadPoolExecutor(max_workers=self.page_workers) as pool:
+            # Each page runs in a copy of this context so it keeps the caller's priority.
+            futures = [workers.submit(pool, get_page, i) for i in range(loop_num)]
+            try:
+                pages = [future.result() for future in futures]
+            except BaseException:
+                for future in futures:
+                    future.cancel()
+                raise
 
-        return dataframe
+        return pd.concat([pd.DataFrame()] + pages)
 
 
     def get_data(self):
         """
-        Gets the data from API calls for each dataset.
+        Gets the data for each dataset, serving the last good result
+        for the same states and years if OpenFEMA misses its deadline.
+        Sets self.freshness to describe the age of the result.
 
         :return: (dict) Pandas dataframes for each dataset
         """
-        dataframes = {}
-        keys = ["dds", "wds", "ms"]
+        key = (tuple(sorted(self.states)), tuple(sorted(self.years)))
+        dataframes, self.freshness = fetch_with_deadline(self.cache, key, self.fetch_data,
+                                                         cancel_token=self.cancel_token)
+
+        return {dataset: df.copy() for dataset, df in dataframes.items()}
 
-        for dataset in keys:
-            if dataset == "dds":
-                filter_path = self.get_dds_filter_path()
-            else:
-                self.disasters = dataframes["dds"].disasterNumber.unique()
-                filter_path = self.get_wds_ms_filter_path()
 
-            loop_num, count = self.get_loop_num(dataset, filter_path)
+    def fetch_data(self, cancel_token=None):
+        """
+        Gets the data from API calls for each dataset. DDS is
+        fetched first, then WDS and MS concurrently. DDS comes from the
+        local disaster catalog instead when it covers the years.
 
+        :param cancel_token: optional CancelToken of the fetch, which may
+                be shared by several queries
 
-            dataframes[dataset] = self.get_dataframe(dataset, filter_path, loop_num)
+        :return: (dict) Pandas dataframes for each dataset
+        """
+        disasters = catalog.get_catalog()
+        if disasters is not None and disasters.covers(self.years):
+            dataframes = {"dds": disasters.dds_rows(self.states, self.years)}
+        else:
+            dataframes = {"dds": self.get_timed_dataset("dds", self.get_dds_filter_path(),
+                                                        cancel_token)}
+
+        self.disasters = dataframes["dds"].disasterNumber.unique()
+        filter_path = self.get_wds_ms_filter_path()
+
+        # WDS and MS only depend on the disaster numbers from DDS.
+        with ThreadPoolExecutor(max_workers=2) as pool:
+            futures = {dataset: workers.submit(pool, self.get_timed_dataset, dataset, filter_path,
+                                               cancel_token)
+                       for dataset in ["wds", "ms"]}
+            try:
+                for dataset, future in futures.items():
+                    dataframes[dataset] = future.result()
+            except BaseException:
+                for future in futures.values():
+                    future.cancel()
+                raise
 
         return dataframes
 
 
+    def get_dataset(self, dataset, filter_path, cancel_token=None):
+        """
+        Gets every record of a dataset matching a filter.
+
+        :param dataset: (str) dataset to connect to
+        :param filter_path: (str) filter path
+        :param cancel_token: optional CancelToken checked between requests
+
+        :return: Pandas dataframe with resulting API call data
+        """
+        check(cancel_token)
+        loop_num, count = self.get_loop_num(dataset, filter_path)
+        return self.get_dataframe(dataset, filter_path, loop_num, cancel_token)
+
+
+    def get_timed_dataset(self, dataset, filter_path, cancel_token=None):
+        """
+        Gets a dataset, recording the time taken as a "fema.<dataset>" stage.
+
+        :param dataset: (str) dataset to connect to
+        :param filter_path: (str) filter path
+        :param cancel_token: optional CancelToken checked between requests
+
+        :return: Pandas dataframe with resulting API call data
+        """
+        with self.timer.stage("fema." + dataset):
+            return self.get_dataset(dataset, filter_path, cancel_token)
+
+
     def clean_ms_data(self, dataframe):
         """
-        Cleans the MS dataframe and merges with the
-        zip code and FIPS county code dataframe.
+        Cleans the MS dataframe and merges with the zip code and
+        FIPS county code dataframe. Amounts are summed per zip code
+        and disaster first; a zip code that spans several counties
+        then has its amounts split between them by the crosswalk
+        weight, so county totals add up to the zip code's total.
 
         :param dataframe: Pandas dataframe with MS data
 
-        :return: Pandas dataframe of MS data merged with FIPS county codes
+        :return: Pandas dataframe of MS amounts, one row per
+                state, county and disaster
+        """
+        amounts = ['requestedAmount', 'obligationAmount']
+        dataframe = dataframe.dropna(subset=['zip', 'disasterNumber'] + amounts).copy()
+        dataframe['zip'] = dataframe['zip'].astype(str).str.zfill(5)
+        zip_totals = dataframe.groupby(['zip', 'disasterNumber'], as_index=False)[amounts].sum()
+        # A zip code recurs once per disaster on the left and once per county
+        # on the right. The fan-out is intended: each zip code's weights sum
+        # to one, so the split rows add back up to its total.
+        merged_df = self.logged_merge(zip_totals, self.zip_df, "ms-zip", "many_to_many",
+                                      left_on=['zip'], right_on=['ZIP'])
+        merged_df = merged_df.dropna(subset=['state_fips', 'county_fips'])
+        merged_df[amounts] = merged_df[amounts].mul(merged_df['weight'], axis=0)
+        merged_df = merged_df.groupby(['state_fips', 'county_fips', 'disasterNumber'],
+                                      as_index=False)[amounts].sum()
+
+        return merged_df
+
+
+    @staticmethod
+    def logged_merge(left, right, name, validate, **merge_kwargs):
+        """
+        Left-joins two dataframes, checking the join's cardinality and
+        logging the row counts, so an unexpected fan-out fails straight
+        away with a MergeError instead of multiplying rows downstream.
+
+        :param left: Pandas dataframe
+        :param right: Pandas dataframe
+        :param name: (str) name of the join for the log
+        :param validate: (str) expected cardinality, as for pd.merge
+        :param merge_kwargs: join keys, as for pd.merge
+
+        :return: merged Pandas dataframe
         """
-        dataframe['zip'] = dataframe['zip'].astype(str)
-        merged_df = pd.merge(dataframe, self.zip_df, how="left",
-                            left_on=['zip'], right_on=['ZIP'])
-        merged_df = merged_df.dropna()
-        merged_df = merged_df.drop(['zip', 'id'], axis=1)
-        merged_df = merged_df.groupby(['county_fips','disasterNumber']).sum()
+        merged_df = pd.merge(left, right, how="left", validate=validate, **merge_kwargs)
+        logger.info("FEMA %s join: %d x %d rows -> %d rows",
+                    name, len(left), len(right), len(merged_df))
 
         return merged_df
 
 
     def clean_data(self, dataframes):
         """
-        Merges data returned by the API calls.
+        Merges data returned by the API calls. WDS has one row per
+        disaster and cleaned MS one row per (state, county, disaster),
+        so both joins keep one row per DDS county designation.
 
         :param dataframes: (dict) Pandas dataframes for each dataset
         """
@@ -230,12 +356,13 @@ class FEMAapi(API):
         dds_df = dataframes['dds'].drop(['id'], axis=1)
         wds_df = dataframes['wds'].drop(['id'], axis=1)
 
-        self.data = pd.merge(dds_df, wds_df, how="left",
-                             left_on = ["disasterNumber"],
-                             right_on = ["disasterNumber"])
+        self.data = self.logged_merge(dds_df, wds_df, "dds-wds", "many_to_one",
+                                      on=["disasterNumber"])
 
-        self.data = pd.merge(self.data, ms_df, how="left",
-                             left_on=['fipsCountyCode'], right_on=['county_fips'])
+        ms_df = ms_df.rename(columns={'state_fips': 'fipsStateCode',
+                                      'county_fips': 'fipsCountyCode'})
+        self.data = self.logged_merge(self.data, ms_df, "dds-ms", "many_to_one",
+                                      on=['fipsStateCode', 'fipsCountyCode', 'disasterNumber'])
 
         self.data = self.data.rename(columns={'disasterNumber': 'disaster_number',
                                     'declarationDate': 'declaration_date',
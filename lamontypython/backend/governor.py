@@ -0,0 +1,302 @@
+"""
+(la)Monty Python
+
+Outbound rate governor for the upstream APIs.
+
+Every request to OpenFEMA or the Census API goes through limit(),
+which enforces a per-host token bucket and a cap on concurrent
+requests. The bucket lives in a small file under the cache directory
+and the concurrency cap is a set of slot lock files, so both are
+shared by every worker process rather than multiplied by them.
+
+Requests are either interactive (a user is waiting) or background
+(refreshes, prefetch, batch runs). Within a process, waiters are
+served strictly by priority; across processes, background requests
+leave part of each bucket untouched so interactive ones always find
+tokens first.
+
+    with governor.background():
+        ...  # every upstream call made here, or in threads started
+             # with backend.workers, is background work
+"""
+
+import os
+import json
+import time
+import heapq
+import logging
+import itertools
+import threading
+from collections import namedtuple
+from contextlib import contextmanager
+from contextvars import ContextVar
+from urllib.parse import urlparse
+from flask import jsonify
+from backend.cache import CACHE_DIR
+
+try:
+    import fcntl
+except ImportError:  # Windows: limits apply per process only
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+INTERACTIVE = 0
+BACKGROUND = 1
+PRIORITY_NAMES = {INTERACTIVE: "interactive", BACKGROUND: "background"}
+
+HostLimit = namedtuple("HostLimit", ["rate", "burst", "concurrency"])
+
+FEMA_HOST = "www.fema.gov"
+CENSUS_HOST = "api.census.gov"
+HOST_LIMITS = {
+    FEMA_HOST: HostLimit(float(os.environ.get("LAMONTY_FEMA_RATE", 10)),
+                         float(os.environ.get("LAMONTY_FEMA_BURST", 20)),
+                         int(os.environ.get("LAMONTY_FEMA_CONCURRENCY", 8))),
+    CENSUS_HOST: HostLimit(float(os.environ.get("LAMONTY_CENSUS_RATE", 5)),
+                           float(os.environ.get("LAMONTY_CENSUS_BURST", 10)),
+                           int(os.environ.get("LAMONTY_CENSUS_CONCURRENCY", 4))),
+}
+DEFAULT_LIMIT = HostLimit(5.0, 10.0, 4)
+
+# Share of each bucket that background requests may not use.
+BACKGROUND_RESERVE = float(os.environ.get("LAMONTY_BACKGROUND_RESERVE", 0.25))
+# How often to look for a slot freed by another worker.
+SLOT_POLL = 0.05
+SLOW_WAIT = 1.0
+
+GOVERNOR_DIR = os.path.join(CACHE_DIR, "governor")
+
+priority = ContextVar("outbound_priority", default=INTERACTIVE)
+
+
+@contextmanager
+def background():
+    """
+    Marks upstream calls made inside the block as background work.
+    """
+    token = priority.set(BACKGROUND)
+    try:
+        yield
+    finally:
+        priority.reset(token)
+
+
+class HostGovernor:
+    """
+    Token bucket and concurrency cap for one upstream host.
+    """
+
+    def __init__(self, host, limit, directory=GOVERNOR_DIR):
+        """
+        Constructor.
+
+        :param host: (str) host name
+        :param limit: HostLimit for the host
+        :param directory: (str) where the shared bucket and slot files live
+        """
+        self.host = host
+        self.limit = limit
+        self.directory = directory
+        self.condition = threading.Condition()
+        self.waiting = []
+        self.sequence = itertools.count()
+        self.in_flight = 0
+        self.stats = {name: {"requests": 0, "wait_total": 0.0, "wait_max": 0.0}
+                      for name in PRIORITY_NAMES.values()}
+        # Fallback state when there is no cross-process locking.
+        self.tokens = limit.burst
+        self.updated = time.time()
+        self.local_slots = threading.Semaphore(limit.concurrency)
+
+
+    def _take_token(self, level):
+        """
+        Takes a token from the shared bucket if enough are left.
+
+        :param level: request priority
+
+        :return: (float) 0 if a token was taken, else seconds until one may be
+        """
+        reserve = self.limit.burst * BACKGROUND_RESERVE if level == BACKGROUND else 0.0
+        if fcntl is None:
+            self.tokens, self.updated, delay = self._refill(self.tokens, self.updated, reserve)
+            return delay
+
+        os.makedirs(self.directory, exist_ok=True)
+        with open(os.path.join(self.directory, self.host + ".bucket"), "a+") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                f.seek(0)
+                try:
+                    state = json.loads(f.read())
+                except ValueError:
+                    state = {"tokens": self.limit.burst, "updated": time.time()}
+                self.tokens, self.updated, delay = self._refill(state["tokens"], state["updated"],
+                                                                reserve)
+                f.seek(0)
+                f.truncate()
+                f.write(json.dumps({"tokens": self.tokens, "updated": self.updated}))
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+        return delay
+
+
+    def _refill(self, tokens, updated, reserve):
+        """
+        Refills a bucket for the time elapsed and takes a token from it.
+
+        :param tokens: (float) tokens in the bucket when last updated
+        :param updated: (float) epoch seconds of the last update
+        :param reserve: (float) tokens that must be left behind
+
+        :return: (float) tokens left, (float) update time and
+                (float) 0 if a token was taken, else seconds until one may be
+        """
+        now = time.time()
+        tokens = min(self.limit.burst, tokens + (now - updated) * self.limit.rate)
+        if tokens >= 1 + reserve:
+            return tokens - 1, now, 0.0
+        return tokens, now, (1 + reserve - tokens) / self.limit.rate
+
+
+    def _take_slot(self):
+        """
+        Takes a free concurrency slot without blocking.
+
+        :return: slot handle, or None if every slot is busy
+        """
+        if fcntl is None:
+            return self.local_slots if self.local_slots.acquire(blocking=False) else None
+
+        os.makedirs(self.directory, exist_ok=True)
+        for i in range(self.limit.concurrency):
+            f = open(os.path.join(self.directory, f"{self.host}.slot{i}"), "w")
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return f
+            except BlockingIOError:
+                f.close()
+        return None
+
+
+    @staticmethod
+    def _release_slot(slot):
+        if fcntl is None:
+            slot.release()
+        else:
+            fcntl.flock(slot, fcntl.LOCK_UN)
+            slot.close()
+
+
+    @contextmanager
+    def acquire(self):
+        """
+        Waits for a token and a slot, serving waiters in priority order,
+        and holds the slot for the duration of the block.
+        """
+        level = priority.get()
+        ticket = (level, next(self.sequence))
+        start = time.monotonic()
+
+        with self.condition:
+            heapq.heappush(self.waiting, ticket)
+            try:
+                while True:
+                    delay = None
+                    if self.waiting[0] == ticket:
+                        slot = self._take_slot()
+                        if slot is None:
+                            delay = SLOT_POLL
+                        else:
+                            delay = self._take_token(level)
+                            if delay == 0:
+                                break
+                            self._release_slot(slot)
+                    self.condition.wait(delay)
+            finally:
+                self.waiting.remove(ticket)
+                heapq.heapify(self.waiting)
+                self.condition.notify_all()
+
+            waited = time.monotonic() - start
+            stats = self.stats[PRIORITY_NAMES[level]]
+            stats["requests"] += 1
+            stats["wait_total"] += waited
+            stats["wait_max"] = max(stats["wait_max"], waited)
+            self.in_flight += 1
+
+        if waited > SLOW_WAIT:
+            logger.info("%s request to %s waited %.2fs for the rate limit",
+                        PRIORITY_NAMES[level], self.host, waited)
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.in_flight -= 1
+                self._release_slot(slot)
+                self.condition.notify_all()
+
+
+    def snapshot(self):
+        """
+        :return: (dict) this process's queue depth, in-flight count and wait times
+        """
+        with self.condition:
+            queued = {name: sum(1 for level, _ in self.waiting if level == value)
+                      for value, name in PRIORITY_NAMES.items()}
+            stats = {name: dict(values, wait_mean=values["wait_total"] / values["requests"]
+                                if values["requests"] else 0.0)
+                     for name, values in self.stats.items()}
+            return {"limit": self.limit._asdict(), "queued": queued,
+                    "in_flight": self.in_flight, "tokens": round(self.tokens, 2),
+                    "priorities": stats}
+
+
+governors = {}
+governors_lock = threading.Lock()
+
+
+def get_governor(host):
+    """
+    Gets the governor for a host, creating it on first use.
+
+    :param host: (str) host name
+
+    :return: HostGovernor
+    """
+    with governors_lock:
+        if host not in governors:
+            governors[host] = HostGovernor(host, HOST_LIMITS.get(host, DEFAULT_LIMIT))
+        return governors[host]
+
+
+def limit(url_or_host):
+    """
+    Context manager that holds a rate-limited slot for one upstream call.
+
+    :param url_or_host: (str) request URL or bare host name
+
+    :return: context manager
+    """
+    host = urlparse(url_or_host).hostname or url_or_host
+    return get_governor(host).acquire()
+
+
+def outbound_stats():
+    """
+    Flask view reporting this worker's outbound queues as JSON.
+    """
+    with governors_lock:
+        hosts = list(governors.values())
+    return jsonify({"pid": os.getpid(),
+                    "hosts": {governor.host: governor.snapshot() for governor in hosts}})
+
+
+def register_stats(server):
+    """
+    Adds the /debug/outbound route to the Flask server.
+
+    :param server: Flask app behind the Dash app
+    """
+    server.add_url_rule("/debug/outbound", "outbound_stats", outbound_stats)
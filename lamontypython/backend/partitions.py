@@ -0,0 +1,275 @@
+"""
+(la)Monty Python
+
+Partition-level query cache.
+
+Each query is split into (state_fips, year) partitions. Partitions
+already fetched by any user or worker are served from the shared
+cache, only the missing ones are downloaded, and the result is
+concatenated. Widening the year slider by one year therefore only
+downloads that year. Partitions hold the default ACS variables; other
+ACS variables are joined onto them from the ACS column cache, so asking
+for another indicator downloads its columns but not the FEMA data again.
+
+A progressive query returns the cached partitions straight away and
+downloads the rest one year at a time in the background, publishing
+the rows gathered so far after each year (see backend/progress.py).
+"""
+
+import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
+from backend import datasets, rollup, progress, workers
+from backend.cancel import QueryCancelled
+from backend.acs_api import ACSapi
+from backend.cache import SharedCache
+from backend.deadline import combine_freshness
+
+PARTITION_CACHE_TTL = 24 * 60 * 60
+
+partition_cache = SharedCache("partitions", max_entries=1024, ttl=PARTITION_CACHE_TTL)
+progressive_executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix="progressive")
+
+
+def expand_years(years):
+    """
+    Expands slider endpoints into every year they cover.
+
+    :param years: (lst) years, or the two endpoints of a range
+
+    :return: (lst) every year from the first to the last
+    """
+    return list(range(min(years), max(years) + 1))
+
+
+def partition_keys(states, years):
+    """
+    Lists the partitions making up a query.
+
+    :param states: (lst) state FIPS codes
+    :param years: (lst) years, or the two endpoints of a range
+
+    :return: (lst) (state_fips, year) tuples
+    """
+    return [(state, year) for year in expand_years(years) for state in sorted(set(states))]
+
+
+def group_missing(missing):
+    """
+    Groups missing partitions into as few downloads as possible: years
+    missing the same set of states are downloaded together.
+
+    :param missing: (lst) partition keys of a single query
+
+    :return: (dict) tuple of states to list of years
+    """
+    states_by_year = {}
+    for state, year in missing:
+        states_by_year.setdefault(year, []).append(state)
+
+    groups = {}
+    for year, states in states_by_year.items():
+        groups.setdefault(tuple(sorted(states)), []).append(year)
+
+    return groups
+
+
+def fetch_partitions(states, years, cancel_token=None, remember=True):
+    """
+    Downloads a block of partitions and caches each one. Partitions
+    built from stale fallback data are returned but not cached.
+
+    :param states: (lst) state FIPS codes
+    :param years: (lst) years
+    :param cancel_token: optional CancelToken to stop the download early
+    :param remember: (bool) keep the partitions in this process's memory
+            tier as well as on disk
+
+    :return: (dict) partition key to Pandas dataframe
+    """
+    keys = partition_keys(states, years)
+    group_key = (tuple(states), tuple(years))
+    with partition_cache.key_lock(group_key):
+        # Another worker may have fetched these while we waited.
+        cached = {key: partition_cache.get(key, remember=remember) for key in keys}
+        if all(df is not None for df in cached.values()):
+            return cached
+
+        fetched = datasets.fetch_data(states, years, cancel_token)
+        freshness = fetched.attrs["freshness"]
+        groups = dict(list(fetched.groupby(["state_fips", "year"])))
+
+        partitions = {}
+        for key in cached:
+            partition = groups.get(key, fetched.iloc[0:0]).reset_index(drop=True)
+            partition.attrs = {"freshness": freshness}
+            if not freshness["stale"]:
+                partition_cache.set(key, partition, remember=remember)
+                rollup.update_partition(key, partition)
+            partitions[key] = partition
+
+    return partitions
+
+
+def get_data(states, years, cancel_token=None, variables=None, remember=True):
+    """
+    Gets combined FEMA and ACS data for every year in a range, serving
+    cached (state, year) partitions and downloading only missing ones.
+
+    :param states: (lst) state FIPS codes
+    :param years: (lst) years, or the two endpoints of a range
+    :param cancel_token: optional CancelToken to stop the download early
+    :param variables: (lst) ACS variables to include, None for the defaults.
+            Variables not downloaded before are fetched column by column;
+            the rest come from the ACS column cache.
+    :param remember: (bool) keep the partitions in this process's memory
+            tier; False for scans over more partitions than it holds, which
+            would otherwise evict everything the app is serving
+
+    :return: Pandas dataframe of the combined FEMA and ACS data
+    """
+    keys = partition_keys(states, years)
+    partitions = {key: partition_cache.get(key, remember=remember) for key in keys}
+    missing = [key for key, df in partitions.items() if df is None]
+
+    for group_states, group_years in group_missing(missing).items():
+        partitions.update(fetch_partitions(list(group_states), group_years, cancel_token,
+                                           remember))
+
+    return add_variables(assemble(keys, partitions), states, years, variables, cancel_token)
+
+
+def assemble(keys, partitions):
+    """
+    Concatenates the partitions of a query that are available.
+
+    :param keys: (lst) partition keys of the query, in order
+    :param partitions: (dict) partition key to Pandas dataframe, None if missing
+
+    :return: Pandas dataframe of the available partitions
+    """
+    frames = [partitions[key] for key in keys if partitions.get(key) is not None]
+    result = pd.concat(frames, ignore_index=True)
+    result.attrs["freshness"] = combine_freshness([df.attrs.get("freshness") for df in frames])
+
+    return result
+
+
+def add_variables(df, states, years, variables=None, cancel_token=None):
+    """
+    Joins the ACS variables of a query that are not defaults onto its
+    assembled partitions. Counties without an estimate for one of them
+    are dropped, as counties missing a default variable are.
+
+    :param df: Pandas dataframe of assembled partitions
+    :param states: (lst) state FIPS codes
+    :param years: (lst) years, or the two endpoints of a range
+    :param variables: (lst) ACS variables of the query, None for the defaults
+    :param cancel_token: optional CancelToken to stop the download early
+
+    :return: Pandas dataframe with a column for each variable
+    """
+    extra = ACSapi.extra_variables(variables)
+    if not extra:
+        return df
+
+    acs_df = datasets.make_acs_api_call(states, expand_years(years), cancel_token,
+                                        variables=extra)
+    on = ["state_fips", "county_fips", "year"]
+    result = pd.merge(df, acs_df[on + extra], how="inner", on=on, validate="many_to_one")
+    result.attrs["freshness"] = combine_freshness([df.attrs.get("freshness"),
+                                                   acs_df.attrs.get("freshness")])
+
+    return result
+
+
+def get_data_progressive(states, years, cancel_token=None, variables=None, on_finish=None):
+    """
+    Starts a query that publishes partial results. Cached partitions are
+    returned at once, and missing ones are downloaded one year at a time
+    in the background, publishing the rows so far after each year, so the
+    first results show before the slowest download finishes.
+
+    :param states: (lst) state FIPS codes
+    :param years: (lst) years, or the two endpoints of a range
+    :param cancel_token: optional CancelToken to stop the download early
+    :param variables: (lst) ACS variables to include, None for the defaults
+    :param on_finish: optional function called once the background
+            downloads end, however they end
+
+    :return: Pandas dataframe of the cached partitions (None if there are
+            none) and (dict) status of the query, see progress.poll. The
+            status is None when every partition and ACS column was cached.
+    """
+    keys = partition_keys(states, years)
+    partitions = {key: partition_cache.get(key) for key in keys}
+    missing = [key for key, df in partitions.items() if df is None]
+    cached = len(keys) - len(missing)
+    # Columns still to be downloaded are joined in the background too.
+    extra = ACSapi.extra_variables(variables)
+    columns_cached = not extra or ACSapi.columns_cached(extra, expand_years(years))
+
+    def assemble_query():
+        return add_variables(assemble(keys, partitions), states, years, variables, cancel_token)
+
+    initial = assemble_query() if cached and columns_cached else None
+    if not missing and columns_cached:
+        if on_finish is not None:
+            on_finish()
+        return initial, None
+
+    tracker = progress.Progress(len(keys))
+    if initial is not None:
+        tracker.publish(initial, cached)
+    else:
+        tracker.save_status()
+
+    def run():
+        error = None
+        try:
+            with tracker.track():
+                if not missing:
+                    tracker.publish(assemble_query(), cached, True)
+                for group_states, group_years in group_missing(missing).items():
+                    for year in sorted(group_years):
+                        partitions.update(fetch_partitions(list(group_states), [year],
+                                                           cancel_token))
+                        done = sum(df is not None for df in partitions.values())
+                        tracker.publish(assemble_query(), done, done == len(keys))
+        except QueryCancelled as e:
+            error = str(e)
+        except Exception as e:
+            error = repr(e)
+        finally:
+            if error is not None:
+                tracker.finish(error)
+            if on_finish is not None:
+                on_finish()
+
+    workers.submit(progressive_executor, run)
+    return initial, dict(tracker.status)
+
+
+def get_aggregate(states, years, incident_types=None, cancel_token=None):
+    """
+    Gets aid totals by state, year and incident type from the rollup
+    cube, without loading county rows for partitions already summarized.
+    Partitions with no cells yet are downloaded a year at a time, in the
+    same blocks as a progressive query, so one already downloading them
+    holds their lock and its results are reused rather than fetched again.
+
+    :param states: (lst) state FIPS codes
+    :param years: (lst) years, or the two endpoints of a range
+    :param incident_types: (lst) incident types to keep, None for all
+    :param cancel_token: optional CancelToken to stop the download early
+
+    :return: Pandas dataframe with one row per (state, year, incident type)
+    """
+    def load_partitions(missing):
+        loaded = {}
+        for group_states, group_years in group_missing(missing).items():
+            for year in sorted(group_years):
+                loaded.update(fetch_partitions(list(group_states), [year], cancel_token))
+        return loaded
+
+    cells = rollup.get_cells(partition_keys(states, years), load_partitions)
+    return rollup.aggregate(cells, incident_types=incident_types)
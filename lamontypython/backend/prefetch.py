@@ -0,0 +1,260 @@
+"""
+(la)Monty Python
+
+Speculative prefetch for the cross-section view.
+
+Users usually change a selection by widening the year range by a year
+or by adding a neighboring state. Each query's move from the session's
+previous selection is classified and counted across all sessions.
+Once a query has loaded and the user has been idle for PREFETCH_IDLE
+seconds, the (state, year) partitions of the likeliest next selections
+are fetched into the partition cache at background priority, at most
+PREFETCH_BUDGET partitions per query. Prefetching stops as soon as the
+session starts another query.
+
+Prefetched partitions are remembered until they would have expired
+from the partition cache, and a later query using one counts as a hit.
+/debug/prefetch reports the move counts and the hit rate.
+"""
+
+import os
+import json
+import time
+import logging
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from flask import jsonify
+from backend import governor, partitions, workers
+from backend.cache import SharedCache
+from utils import spatial
+from utils.utils import COUNTIES_GEOJSON
+
+logger = logging.getLogger(__name__)
+
+# Partitions fetched after each query, 0 to turn prefetching off.
+PREFETCH_BUDGET = int(os.environ.get("LAMONTY_PREFETCH_BUDGET", 6))
+# Seconds a session must stay on a selection before prefetching.
+PREFETCH_IDLE = float(os.environ.get("LAMONTY_PREFETCH_IDLE", 2.0))
+SESSION_TTL = 60 * 60
+
+MOVES = ["widen_later", "widen_earlier", "add_neighbor", "other"]
+STATS_KEY = "stats"
+
+selection_cache = SharedCache("prefetch_sessions", max_entries=256, ttl=SESSION_TTL)
+stats_cache = SharedCache("prefetch", max_entries=1)
+prefetch_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="prefetch")
+
+
+@functools.lru_cache(maxsize=1)
+def load_neighbors():
+    """
+    Neighboring states in the app's county geometry, computed once.
+
+    :return: (dict) state FIPS code to list of neighboring state FIPS codes
+    """
+    with open(COUNTIES_GEOJSON, "r") as f:
+        return spatial.state_neighbors(json.load(f))
+
+
+def new_stats():
+    """
+    :return: (dict) empty prefetch statistics
+    """
+    return {"moves": dict.fromkeys(MOVES, 0), "prefetched": 0, "used": 0, "pending": {}}
+
+
+def update_stats(function):
+    """
+    Updates the statistics shared by every worker.
+
+    :param function: function taking and returning the statistics dict
+    """
+    with stats_cache.key_lock(STATS_KEY):
+        stats_cache.set(STATS_KEY, function(stats_cache.get(STATS_KEY) or new_stats()))
+
+
+def classify(previous, states, years):
+    """
+    Classifies the move from one selection to the next.
+
+    :param previous: (tuple) previous selection, see record_query
+    :param states: (lst) state FIPS codes of the new selection
+    :param years: (lst) years, or the two endpoints of a range
+
+    :return: (str) one of MOVES, or None if the selection is unchanged
+    """
+    previous_states, (previous_first, previous_last) = previous
+    previous_states, states = set(previous_states), set(states)
+    first, last = min(years), max(years)
+
+    if states == previous_states:
+        if (first, last) == (previous_first, previous_last):
+            return None
+        if (first, last) == (previous_first, previous_last + 1):
+            return "widen_later"
+        if (first, last) == (previous_first - 1, previous_last):
+            return "widen_earlier"
+    elif (first, last) == (previous_first, previous_last) and previous_states < states:
+        added = states - previous_states
+        if len(added) == 1 and previous_states & set(load_neighbors().get(added.pop(), [])):
+            return "add_neighbor"
+    return "other"
+
+
+def record_query(session_id, states, years):
+    """
+    Records a query: counts its move from the session's previous
+    selection and the prefetched partitions it uses.
+
+    :param session_id: (str) browser session id, or None
+    :param states: (lst) state FIPS codes
+    :param years: (lst) years, or the two endpoints of a range
+    """
+    move = None
+    if session_id:
+        selection = (tuple(sorted(set(states))), (min(years), max(years)))
+        previous = selection_cache.get(session_id)
+        selection_cache.set(session_id, selection)
+        if previous is not None:
+            move = classify(previous, states, years)
+    keys = partitions.partition_keys(states, years)
+
+    def count(stats):
+        if move is not None:
+            stats["moves"][move] += 1
+        expired = time.time() - partitions.PARTITION_CACHE_TTL
+        stats["pending"] = {key: fetched for key, fetched in stats["pending"].items()
+                            if fetched > expired}
+        for key in keys:
+            if stats["pending"].pop(key, None) is not None:
+                stats["used"] += 1
+        return stats
+
+    update_stats(count)
+
+
+def move_probabilities(moves):
+    """
+    Estimates how likely each move is, with add-one smoothing so moves
+    not seen yet still get a share.
+
+    :param moves: (dict) count of each of MOVES
+
+    :return: (dict) move to probability
+    """
+    total = sum(moves.values()) + len(MOVES)
+    return {move: (moves.get(move, 0) + 1) / total for move in MOVES}
+
+
+def predict(states, years, moves, first_year, last_year):
+    """
+    Lists the partitions of the likely next selections: the year range
+    widened by one year either way, or one neighboring state added.
+
+    :param states: (lst) state FIPS codes
+    :param years: (lst) years, or the two endpoints of a range
+    :param moves: (dict) count of each of MOVES so far
+    :param first_year: (int) first year that can be selected
+    :param last_year: (int) last year that can be selected
+
+    :return: (lst) partition keys, likeliest first
+    """
+    probabilities = move_probabilities(moves)
+    states = sorted(set(states))
+    first, last = min(years), max(years)
+
+    candidates = []
+    if last < last_year:
+        candidates.append((probabilities["widen_later"],
+                           partitions.partition_keys(states, [last + 1])))
+    if first > first_year:
+        candidates.append((probabilities["widen_earlier"],
+                           partitions.partition_keys(states, [first - 1])))
+    neighbors = load_neighbors()
+    added = sorted({n for state in states for n in neighbors.get(state, [])} - set(states))
+    for state in added:
+        candidates.append((probabilities["add_neighbor"] / len(added),
+                           partitions.partition_keys([state], [first, last])))
+
+    candidates.sort(key=lambda candidate: -candidate[0])
+    return list(dict.fromkeys(key for _, keys in candidates for key in keys))
+
+
+def prefetch(keys, cancel_token, budget=PREFETCH_BUDGET):
+    """
+    Fetches the uncached partitions among `keys` into the partition cache
+    at background priority, stopping once the session moves on.
+
+    :param keys: (lst) partition keys, likeliest first
+    :param cancel_token: CancelToken of the session's last query
+    :param budget: (int) most partitions to fetch
+
+    :return: (lst) partition keys fetched
+    """
+    missing = [key for key in keys if partitions.partition_cache.get(key) is None][:budget]
+    fetched = []
+    with governor.background():
+        for group_states, group_years in partitions.group_missing(missing).items():
+            for year in sorted(group_years):
+                if cancel_token.cancelled:
+                    return fetched
+                # The last fetch is left to finish, since the new query may want it.
+                result = partitions.fetch_partitions(list(group_states), [year])
+                fetched.extend(key for key in result if partitions.partition_cache.get(key) is not None)
+    return fetched
+
+
+def schedule(session_id, cancel_token, states, years, first_year, last_year):
+    """
+    Prefetches the likely next selections of a session once it has been
+    idle for PREFETCH_IDLE seconds after a query.
+
+    :param session_id: (str) browser session id, or None
+    :param cancel_token: CancelToken of the session's query
+    :param states: (lst) state FIPS codes of the query
+    :param years: (lst) years, or the two endpoints of a range
+    :param first_year: (int) first year that can be selected
+    :param last_year: (int) last year that can be selected
+    """
+    if not session_id or PREFETCH_BUDGET <= 0:
+        return
+
+    def run():
+        cancel_token.event.wait(PREFETCH_IDLE)
+        if cancel_token.cancelled:
+            return
+        try:
+            stats = stats_cache.get(STATS_KEY) or new_stats()
+            keys = predict(states, years, stats["moves"], first_year, last_year)
+            fetched = prefetch(keys, cancel_token)
+        except Exception:
+            logger.warning("Prefetch failed", exc_info=True)
+            return
+        if fetched:
+            def add(stats):
+                stats["prefetched"] += len(fetched)
+                stats["pending"].update(dict.fromkeys(fetched, time.time()))
+                return stats
+            update_stats(add)
+
+    workers.submit(prefetch_executor, run)
+
+
+def prefetch_stats():
+    """
+    Flask view reporting the move counts and prefetch hit rate as JSON.
+    """
+    stats = stats_cache.get(STATS_KEY) or new_stats()
+    hit_rate = stats["used"] / stats["prefetched"] if stats["prefetched"] else None
+    return jsonify({"moves": stats["moves"], "prefetched": stats["prefetched"],
+                    "used": stats["used"], "pending": len(stats["pending"]),
+                    "hit_rate": hit_rate, "budget": PREFETCH_BUDGET})
+
+
+def register_stats(server):
+    """
+    Adds the /debug/prefetch route to the Flask server.
+
+    :param server: Flask app behind the Dash app
+    """
+    server.add_url_rule("/debug/prefetch", "prefetch_stats", prefetch_stats)
@@ -0,0 +1,171 @@
+"""
+(la)Monty Python
+
+Progress of long-running queries.
+
+A progressive query runs in the background and publishes what it has
+so far: the rows of every (state, year) partition finished, and a count
+of upstream pages downloaded for the completeness indicator. Both are
+written to a shared cache under the query's job id, so the browser can
+poll any worker for them.
+
+Upstream connectors report pages through page_planned() and page_done().
+These only count when called under a Progress's track() context, which
+fetch threads inherit, and do nothing otherwise.
+"""
+
+import os
+import uuid
+import threading
+import contextvars
+from contextlib import contextmanager
+from backend.cache import SharedCache
+
+# Publish the page count after this many pages; partitions always publish.
+PUBLISH_EVERY_PAGES = int(os.environ.get("LAMONTY_PROGRESS_PAGES", 5))
+JOB_TTL = 15 * 60
+
+job_cache = SharedCache("progress", max_entries=128, ttl=JOB_TTL)
+current = contextvars.ContextVar("progress", default=None)
+
+
+def page_planned(count):
+    """
+    Reports upstream pages about to be downloaded.
+
+    :param count: (int) number of pages
+    """
+    progress = current.get()
+    if progress is not None:
+        progress.add_pages(planned=count)
+
+
+def page_done():
+    """
+    Reports an upstream page downloaded.
+    """
+    progress = current.get()
+    if progress is not None:
+        progress.add_pages(done=1)
+
+
+class Progress:
+    """
+    Publishes the partial results and completeness of one query.
+    """
+
+    def __init__(self, partitions_total):
+        """
+        Constructor.
+
+        :param partitions_total: (int) partitions making up the query
+        """
+        self.job_id = uuid.uuid4().hex
+        self.lock = threading.Lock()
+        self.status = {"job_id": self.job_id, "version": 0,
+                       "partitions_done": 0, "partitions_total": partitions_total,
+                       "pages_done": 0, "pages_planned": 0,
+                       "finished": False, "error": None}
+        self.unpublished_pages = 0
+
+
+    @contextmanager
+    def track(self):
+        """
+        Counts the pages downloaded inside the block, including by threads
+        started from it with a copy of its context.
+        """
+        reset = current.set(self)
+        try:
+            yield self
+        finally:
+            current.reset(reset)
+
+
+    def add_pages(self, planned=0, done=0):
+        """
+        Updates the page counts, publishing every PUBLISH_EVERY_PAGES pages.
+
+        :param planned: (int) pages newly planned
+        :param done: (int) pages newly downloaded
+        """
+        with self.lock:
+            self.status["pages_planned"] += planned
+            self.status["pages_done"] += done
+            self.unpublished_pages += done
+            if self.unpublished_pages < PUBLISH_EVERY_PAGES and not planned:
+                return
+            self.unpublished_pages = 0
+        self.save_status()
+
+
+    def save_status(self):
+        """
+        Publishes the current status without new results.
+        """
+        with self.lock:
+            job_cache.set((self.job_id, "status"), dict(self.status))
+
+
+    def publish(self, data, partitions_done, finished=False, error=None):
+        """
+        Publishes new partial results.
+
+        :param data: Pandas dataframe of every partition finished so far
+        :param partitions_done: (int) partitions in data
+        :param finished: (bool) True once no more results will follow
+        :param error: (str) why the query stopped early, if it did
+        """
+        with self.lock:
+            self.status["version"] += 1
+            self.status.update(partitions_done=partitions_done, finished=finished, error=error)
+            # Data first, so the data a poller finds is never older than the status.
+            job_cache.set((self.job_id, "data"), (self.status["version"], data))
+            job_cache.set((self.job_id, "status"), dict(self.status))
+
+
+    def finish(self, error=None):
+        """
+        Marks the query finished without new results.
+
+        :param error: (str) why the query stopped early, if it did
+        """
+        with self.lock:
+            self.status.update(finished=True, error=error)
+        self.save_status()
+
+
+def poll(job_id, seen_version=0):
+    """
+    Gets the progress of a query, and its results if they changed.
+
+    :param job_id: (str) job id of the query
+    :param seen_version: (int) version of the results the caller already has
+
+    :return: (dict) status, None if the job is unknown or expired,
+            and Pandas dataframe of newer results or None. The status
+            "version" is that of the results returned.
+    """
+    status = job_cache.get((job_id, "status"))
+    if status is None or status["version"] <= seen_version:
+        return status, None
+    version, data = job_cache.get((job_id, "data"))
+    return dict(status, version=version), data
+
+
+def describe(status):
+    """
+    Describes how complete a query is.
+
+    :param status: (dict) status from poll
+
+    :return: (str) short description
+    """
+    if status is None or status["finished"] and not status["error"]:
+        return ""
+    description = f"Loaded {status['partitions_done']} of {status['partitions_total']} state-years"
+    if status["pages_planned"]:
+        description += f", {status['pages_done']} of {status['pages_planned']} upstream pages"
+    if status["error"]:
+        return description + f". Loading stopped: {status['error']}"
+    return description + "..."
@@ -0,0 +1,118 @@
+"""
+(la)Monty Python
+
+Precomputed aid rollup cube.
+
+Each (state_fips, year) partition is summarized into one row per
+(state_fips, year, incident_type, disaster_number) cell holding sums,
+counts and the sorted county-level aid values. Cells are rebuilt
+whenever their partition is fetched, so the cube grows incrementally,
+and aggregate views are answered from the cells alone, without
+touching county-level rows. Cells expire with their partitions, and
+cells built from stale fallback data are not cached, so the aggregate
+view picks up refreshed data.
+"""
+
+import numpy as np
+import pandas as pd
+from backend.cache import SharedCache
+
+CELL_KEYS = ["state_fips", "year", "incident_type", "disaster_number"]
+QUANTILES = {"aid_p25": 0.25, "aid_median": 0.5, "aid_p75": 0.75, "aid_p90": 0.9}
+
+# Same lifetime as the partition cache (partitions.PARTITION_CACHE_TTL).
+CELL_CACHE_TTL = 24 * 60 * 60
+
+cell_cache = SharedCache("rollups", max_entries=1024, ttl=CELL_CACHE_TTL)
+
+
+def build_cells(partition):
+    """
+    Summarizes one partition's county rows into cube cells.
+
+    :param partition: Pandas dataframe of county rows for one (state, year)
+
+    :return: Pandas dataframe with one row per cell
+    """
+    if partition.empty:
+        return pd.DataFrame(columns=CELL_KEYS + ["counties", "population", "aid_requested",
+                                                 "aid_obligated", "aid_per_capita_sum",
+                                                 "aid_values"])
+
+    grouped = partition.groupby(CELL_KEYS, sort=False)
+    cells = grouped.agg(counties=("county_fips", "size"),
+                        population=("population", "sum"),
+                        aid_requested=("aid_requested", "sum"),
+                        aid_obligated=("aid_obligated", "sum"),
+                        aid_per_capita_sum=("aid_per_capita", "sum"))
+    cells["aid_values"] = [np.sort(values.to_numpy()) for _, values in grouped["aid_requested"]]
+
+    return cells.reset_index()
+
+
+def update_partition(key, partition):
+    """
+    Rebuilds and stores the cells of a partition that has just been fetched.
+
+    :param key: (state_fips, year) tuple
+    :param partition: Pandas dataframe of county rows for the partition
+    """
+    cell_cache.set(key, build_cells(partition))
+
+
+def get_cells(keys, load_partitions):
+    """
+    Gets the cells of several partitions, building any that are missing
+    or expired. Cells built from stale partitions are used but not cached.
+
+    :param keys: (lst) (state_fips, year) tuples
+    :param load_partitions: function from a list of keys to a dict of
+            their county rows, called once with every partition that has
+            no cells yet, so they can be downloaded together
+
+    :return: Pandas dataframe of cells
+    """
+    cells = {key: cell_cache.get(key) for key in keys}
+    missing = [key for key, df in cells.items() if df is None]
+    if missing:
+        for key, partition in load_partitions(missing).items():
+            cells[key] = build_cells(partition)
+            if not partition.attrs.get("freshness", {}).get("stale", False):
+                cell_cache.set(key, cells[key])
+
+    return pd.concat([cells[key] for key in keys], ignore_index=True)
+
+
+def aggregate(cells, by=("state_fips", "year", "incident_type"), incident_types=None):
+    """
+    Rolls cells up to a coarser grouping. Sums and counts add up directly;
+    quantiles are exact, computed from the merged per-county values.
+
+    :param cells: Pandas dataframe of cells from get_cells
+    :param by: cell key columns to group by
+    :param incident_types: (lst) incident types to keep, None for all
+
+    :return: Pandas dataframe with one row per group
+    """
+    if incident_types:
+        cells = cells[cells["incident_type"].isin(incident_types)]
+    if cells.empty:
+        return pd.DataFrame(columns=list(by) + ["disasters", "counties", "aid_requested",
+                                                "aid_obligated", "aid_per_capita",
+                                                "aid_per_county"] + list(QUANTILES))
+
+    grouped = cells.groupby(list(by), sort=True)
+    rollup = grouped.agg(disasters=("disaster_number", "nunique"),
+                         counties=("counties", "sum"),
+                         population=("population", "sum"),
+                         aid_requested=("aid_requested", "sum"),
+                         aid_obligated=("aid_obligated", "sum"),
+                         aid_per_capita_sum=("aid_per_capita_sum", "sum"))
+    rollup["aid_per_capita"] = rollup["aid_per_capita_sum"] / rollup["counties"]
+    rollup["aid_per_county"] = rollup["aid_requested"] / rollup["counties"]
+
+    values = [np.concatenate(list(arrays)) for _, arrays in grouped["aid_values"]]
+    for column, q in QUANTILES.items():
+        rollup[column] = [np.quantile(v, q) if len(v) else np.nan for v in values]
+
+    return rollup.drop(columns=["aid_per_capita_sum"]).reset_index()
@@ -0,0 +1,143 @@
+"""
+(la)Monty Python
+
+Per-browser-session query tracking.
+
+Each browser tab holds a session id. Starting a query for a session
+supersedes the session's previous query: its CancelToken is cancelled
+and it stops at its next check between upstream pages or pipeline
+stages. Rapid changes are debounced in the browser (the year slider
+only reports a value once released), so no server thread waits here.
+
+The latest query of each session is recorded as a generation number
+in a small file under the cache directory, so a query is superseded
+even when the newer one lands on another worker process.
+"""
+
+import os
+import hashlib
+import threading
+from backend.cache import CACHE_DIR
+from backend.cancel import CancelToken
+
+try:
+    import fcntl
+except ImportError:  # Windows: queries are only superseded within a process
+    fcntl = None
+
+SESSION_DIR = os.path.join(CACHE_DIR, "sessions")
+
+active = {}
+active_lock = threading.Lock()
+
+
+def generation_path(session_id):
+    """
+    :param session_id: (str) browser session id
+
+    :return: (str) file holding the session's latest query generation
+    """
+    return os.path.join(SESSION_DIR, hashlib.sha1(session_id.encode()).hexdigest())
+
+
+def read_generation(session_id):
+    """
+    Reads the generation of a session's latest query.
+
+    :param session_id: (str) browser session id
+
+    :return: (int) generation, 0 if the session has no queries yet
+    """
+    try:
+        with open(generation_path(session_id)) as f:
+            return int(f.read() or 0)
+    except (OSError, ValueError):
+        return 0
+
+
+def next_generation(session_id):
+    """
+    Records a new query for a session.
+
+    :param session_id: (str) browser session id
+
+    :return: (int) the new query's generation
+    """
+    os.makedirs(SESSION_DIR, exist_ok=True)
+    with open(generation_path(session_id), "a+") as f:
+        if fcntl is not None:
+            fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            f.seek(0)
+            generation = int(f.read() or 0) + 1
+            f.seek(0)
+            f.truncate()
+            f.write(str(generation))
+        finally:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_UN)
+    return generation
+
+
+class SessionToken(CancelToken):
+    """
+    CancelToken that is also cancelled once a newer query starts for
+    the same session, in this process or another.
+    """
+
+    def __init__(self, session_id, generation):
+        """
+        Constructor.
+
+        :param session_id: (str) browser session id
+        :param generation: (int) generation of this query
+        """
+        super().__init__()
+        self.session_id = session_id
+        self.generation = generation
+
+
+    @property
+    def cancelled(self):
+        """
+        :return: (bool) True once cancelled or superseded
+        """
+        if self.event.is_set():
+            return True
+        if fcntl is not None and read_generation(self.session_id) != self.generation:
+            self.cancel("superseded by a newer query")
+            return True
+        return False
+
+
+def begin_query(session_id):
+    """
+    Starts a query for a session, superseding its previous one.
+
+    :param session_id: (str) browser session id, or None if unknown
+
+    :return: CancelToken for the query
+    """
+    if not session_id:
+        return CancelToken()
+
+    token = SessionToken(session_id, next_generation(session_id))
+    with active_lock:
+        previous = active.get(session_id)
+        active[session_id] = token
+    if previous is not None:
+        previous.cancel("superseded by a newer query")
+
+    return token
+
+
+def end_query(session_id, token):
+    """
+    Forgets a finished query.
+
+    :param session_id: (str) browser session id, or None
+    :param token: CancelToken returned by begin_query
+    """
+    with active_lock:
+        if session_id and active.get(session_id) is token:
+            del active[session_id]
@@ -0,0 +1,111 @@
+"""
+(la)Monty Python
+
+Per-stage timing for the data pipeline.
+
+Stages are named with dots for nesting ("fema", "fema.dds", ...) so
+the report can show which branch of the concurrent pipeline was the
+critical path.
+"""
+
+import time
+import logging
+import threading
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+
+class StageTimer:
+    """
+    Records start and end times of named stages, from any thread.
+    """
+
+    def __init__(self):
+        """
+        Constructor.
+        """
+        self.start = time.perf_counter()
+        self.stages = {}
+        self.lock = threading.Lock()
+
+
+    @contextmanager
+    def stage(self, name):
+        """
+        Times the enclosed block as a stage.
+
+        :param name: (str) stage name, dotted for nested stages
+        """
+        begin = time.perf_counter() - self.start
+        try:
+            yield
+        finally:
+            end = time.perf_counter() - self.start
+            with self.lock:
+                self.stages[name] = (begin, end)
+
+
+    def critical_path(self, prefix=""):
+        """
+        Finds the chain of stages that determined the total time: starting
+        from the stage that finished last, repeatedly steps back to the
+        sibling that finished latest before it started, then expands
+        each stage on the chain into its own nested stages.
+
+        :param prefix: (str) parent stage name plus ".", "" for the top level
+
+        :return: (lst) names of the stages on the critical path, in order
+        """
+        with self.lock:
+            siblings = {name: times for name, times in self.stages.items()
+                        if name.startswith(prefix) and "." not in name[len(prefix):]}
+
+        chain = []
+        cutoff = float("inf")
+        while True:
+            candidates = [name for name, (_, end) in siblings.items() if end <= cutoff]
+            if not candidates:
+                break
+            last = max(candidates, key=lambda name: siblings[name][1])
+            chain.append(last)
+            cutoff = siblings.pop(last)[0]
+
+        path = []
+        for name in reversed(chain):
+            path.append(name)
+            path.extend(self.critical_path(name + "."))
+
+        return path
+
+
+    def summary(self):
+        """
+        Summarizes the recorded stages for logging and display.
+
+        :return: (dict) stage name to start, end and duration in seconds,
+                plus the critical path under "critical_path"
+        """
+        with self.lock:
+            stages = dict(self.stages)
+
+        summary = {name: {"start": round(begin, 3), "end": round(end, 3),
+                          "seconds": round(end - begin, 3)}
+                   for name, (begin, end) in sorted(stages.items(), key=lambda s: s[1][0])}
+        summary["critical_path"] = self.critical_path()
+
+        return summary
+
+
+    def log(self, label):
+        """
+        Logs the timing summary at INFO level.
+
+        :param label: (str) description of what was timed
+        """
+        summary = self.summary()
+        critical_path = summary.pop("critical_path")
+        lines = [f"  {name:<24} {t['start']:>8.3f}s -> {t['end']:>8.3f}s  ({t['seconds']:.3f}s)"
+                 for name, t in summary.items()]
+        logger.info("Stage timings for %s (critical path: %s)\n%s",
+                    label, " > ".join(critical_path), "\n".join(lines))
@@ -0,0 +1,60 @@
+"""
+(la)Monty Python
+
+Runs work on thread pools under a copy of the caller's context.
+
+Context variables such as the request priority (backend/governor.py)
+travel into worker threads only when the work runs in a copy of the
+submitting thread's context. Every pool submission in the backend goes
+through submit() or in_context() so that happens in one place.
+
+Optional task hooks wrap every function run this way, in the worker
+thread. Debugging tools that need code running in the worker (e.g. the
+request profiler in utils/profiling.py) register one at startup instead
+of every call site having to know about them.
+"""
+
+import functools
+import contextvars
+
+task_hooks = []
+
+
+def add_task_hook(hook):
+    """
+    Wraps every function submitted from now on.
+
+    :param hook: function taking the submitted function and returning
+            the function to run in its place
+    """
+    if hook not in task_hooks:
+        task_hooks.append(hook)
+
+
+def in_context(func, context=None):
+    """
+    Binds a function to a context, to be run in another thread.
+
+    :param func: function to run in a worker thread
+    :param context: contextvars.Context to run it in, defaults to a
+            copy of the caller's
+
+    :return: callable taking the function's arguments
+    """
+    context = context if context is not None else contextvars.copy_context()
+    for hook in task_hooks:
+        func = hook(func)
+    return functools.partial(context.run, func)
+
+
+def submit(executor, func, *args):
+    """
+    Submits a function to a pool, run in a copy of the caller's context.
+
+    :param executor: concurrent.futures Executor
+    :param func: function to run
+    :param args: its arguments
+
+    :return: Future
+    """
+    return executor.submit(in_context(func), *args)
@@ -0,0 +1,228 @@
+"""
+(la)Monty Python
+
+Headless batch runs of the hurricane analysis.
+
+For every hurricane scope, pulls the FEMA and ACS data, runs the pooled
+and fixed effects regressions (with VIF screening) and exports the
+tables and the map, without a browser or a Dash server. Scopes run in
+parallel worker processes. Each finished scope writes a result.json
+marker last, so rerunning the same command after a failure only
+redoes the scopes that did not finish.
+
+    python -m lamontypython batch --output reports --workers 4
+
+Output layout:
+
+    reports/HARVEY/pooled.csv, pooled_variables.csv,
+                   fe_state.csv, fe_state_variables.csv, ...,
+                   map.html, result.json (or error.txt)
+    reports/summary.json, reports/summary.csv
+
+Fixed effects that cannot be estimated for a scope (e.g. county effects
+when every county appears once) are skipped and noted in result.json, as
+is the map of a scope with no storm track.
+
+With --streamed the pooled regression is fitted one (state, year)
+partition at a time (see DisasterRegs.streamed_ols), and the full panel
+is only loaded if the fixed effects or the map need it.
+"""
+
+import os
+import json
+import time
+import logging
+import traceback
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from backend import governor
+from backend.timing import StageTimer
+from models.hurricane_regs import DisasterRegs
+from pages import detail_view
+
+logger = logging.getLogger(__name__)
+
+RESULT_FILE = "result.json"
+ERROR_FILE = "error.txt"
+
+
+def write_json(path, data):
+    """
+    Writes json atomically, so a crash never leaves a partial marker.
+
+    :param path: (str) file to write
+    :param data: json-serializable value
+    """
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(data, f, indent=2)
+    os.replace(tmp_path, path)
+
+
+def read_result(scope_dir):
+    """
+    Reads the marker of a finished scope.
+
+    :param scope_dir: (str) output directory of the scope
+
+    :return: (dict) result, or None if the scope has not finished
+    """
+    try:
+        with open(os.path.join(scope_dir, RESULT_FILE)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def run_scope(hurricane, output_dir, effects, streamed=False):
+    """
+    Runs the full analysis for one hurricane and writes its outputs.
+    Upstream calls run at background priority so a batch sharing the
+    cache with a live server never delays its users.
+
+    :param hurricane: (str) hurricane name
+    :param output_dir: (str) root output directory
+    :param effects: (lst) fixed effects specifications to run
+    :param streamed: (bool) fit the pooled regression out of core
+
+    :return: (dict) status, timings and output files of the scope
+    """
+    scope_dir = os.path.join(output_dir, hurricane)
+    os.makedirs(scope_dir, exist_ok=True)
+    timer = StageTimer()
+    start = time.perf_counter()
+    files = []
+    notes = []
+
+    def write_table(name, df):
+        df.to_csv(os.path.join(scope_dir, name + ".csv"))
+        files.append(name + ".csv")
+
+    try:
+        with governor.background():
+            with timer.stage("fetch"):
+                hurricane_df, scope = detail_view.hurricane_track_scope(hurricane)
+                regression = DisasterRegs(scope["states_fips"], scope["year"])
+                needs_panel = not streamed or effects or not hurricane_df.empty
+                api_data = regression.pull_data() if needs_panel else None
+
+            with timer.stage("pooled"):
+                if streamed:
+                    reg_output, var_table = regression.streamed_ols()
+                else:
+                    reg_output, _, var_table = regression.pooled_ols(api_data)
+            write_table("pooled", reg_output)
+            write_table("pooled_variables", var_table)
+
+            for effect in effects:
+                try:
+                    with timer.stage("fe_" + effect):
+                        reg_output, _, var_table = regression.panel_ols(api_data, effects=effect)
+                except ValueError as e:
+                    # e.g. county effects on a single-year scope; the other outputs still stand.
+                    logger.warning("%s: skipped %s fixed effects: %s", hurricane, effect, e)
+                    notes.append(f"fe_{effect} skipped: {e}")
+                    continue
+                write_table("fe_" + effect, reg_output)
+                write_table("fe_" + effect + "_variables", var_table)
+
+            if hurricane_df.empty:
+                notes.append("map skipped: no track for this hurricane")
+            else:
+                with timer.stage("figure"):
+                    fig = detail_view.hurricane_map(hurricane_df, api_data, scope["year"][0],
+                                                    detail_view.counties)
+                    fig.write_html(os.path.join(scope_dir, "map.html"), include_plotlyjs="cdn")
+                files.append("map.html")
+    except Exception:
+        with open(os.path.join(scope_dir, ERROR_FILE), "w") as f:
+            f.write(traceback.format_exc())
+        return {"hurricane": hurricane, "status": "failed",
+                "seconds": round(time.perf_counter() - start, 3),
+                "stages": timer.summary(), "error": traceback.format_exc(limit=1)}
+
+    if os.path.exists(os.path.join(scope_dir, ERROR_FILE)):
+        os.remove(os.path.join(scope_dir, ERROR_FILE))
+    result = {"hurricane": hurricane, "status": "done",
+              "states_fips": scope["states_fips"], "year": scope["year"],
+              "rows": None if api_data is None else len(api_data), "seconds": round(time.perf_counter() - start, 3),
+              "stages": timer.summary(), "files": files, "notes": notes}
+    write_json(os.path.join(scope_dir, RESULT_FILE), result)
+    return result
+
+
+def write_summary(output_dir, results, wall_seconds):
+    """
+    Writes the run summary as json and a per-scope timing table as csv.
+
+    :param output_dir: (str) root output directory
+    :param results: (lst) results of every scope, including resumed ones
+    :param wall_seconds: (float) elapsed time of this run
+    """
+    write_json(os.path.join(output_dir, "summary.json"),
+               {"wall_seconds": round(wall_seconds, 3),
+                "done": sum(r["status"] == "done" for r in results),
+                "failed": [r["hurricane"] for r in results if r["status"] == "failed"],
+                "scopes": results})
+
+    rows = []
+    for result in results:
+        row = {"hurricane": result["hurricane"], "status": result["status"],
+               "resumed": result.get("resumed", False), "seconds": result["seconds"],
+               "notes": "; ".join(result.get("notes", []))}
+        row.update({stage: times["seconds"] for stage, times in result["stages"].items()
+                    if stage != "critical_path"})
+        rows.append(row)
+    pd.DataFrame(rows).to_csv(os.path.join(output_dir, "summary.csv"), index=False)
+
+
+def all_hurricanes():
+    """
+    Lists every configured scope in hurricane_scope.json and every
+    hurricane with a track.
+
+    :return: (lst) hurricane names
+    """
+    return list(dict.fromkeys(list(detail_view.hurricane_scope) + list(detail_view.hurricanes)))
+
+
+def run_batch(hurricanes=None, output_dir="reports", workers=None,
+              effects=("state",), force=False, streamed=False):
+    """
+    Runs every scope not yet finished in output_dir.
+
+    :param hurricanes: (lst) hurricane names, None for all_hurricanes()
+    :param output_dir: (str) root output directory
+    :param workers: (int) worker processes, None for one per CPU
+    :param effects: (lst) fixed effects specifications to run
+    :param force: (bool) rerun scopes that already finished
+    :param streamed: (bool) fit the pooled regressions out of core
+
+    :return: (lst) results of every scope
+    """
+    start = time.perf_counter()
+    hurricanes = list(hurricanes or all_hurricanes())
+    os.makedirs(output_dir, exist_ok=True)
+
+    results = {}
+    pending = []
+    for hurricane in hurricanes:
+        previous = None if force else read_result(os.path.join(output_dir, hurricane))
+        if previous is not None:
+            results[hurricane] = dict(previous, resumed=True)
+        else:
+            pending.append(hurricane)
+    logger.info("%d of %d scopes already done, running %d",
+                len(results), len(hurricanes), len(pending))
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(run_scope, hurricane, output_dir, list(effects), streamed): hurricane
+                   for hurricane in pending}
+        for future in as_completed(futures):
+            result = future.result()
+            results[result["hurricane"]] = result
+            logger.info("%s %s in %.1fs", result["hurricane"], result["status"], result["seconds"])
+
+    ordered = [results[hurricane] for hurricane in hurricanes]
+    write_summary(output_dir, ordered, time.perf_counter() - start)
+    return ordered
@@ -0,0 +1,200 @@
+"""
+(la)Monty Python
+
+Command line tool to rebuild the static reference files used by the
+detail view from their raw sources:
+    "ibtracs.ALL.list.v04r00.csv" from the NOAA IBTrACS dataset
+    -> hurricane_path.csv
+    "countypres_2000-2020.csv" from MIT Election Data
+    -> county_president_winner.csv
+
+Both sources are streamed in chunks with only the needed columns, so
+memory stays bounded regardless of file size. Example:
+
+    python data/ingest.py --ibtracs ibtracs.ALL.list.v04r00.csv \
+        --elections countypres_2000-2020.csv --storms HARVEY:2017 IRMA:2017
+"""
+import os
+import sys
+import time
+import argparse
+import pandas as pd
+
+DATA_DIR = os.path.dirname(os.path.abspath(__file__))
+
+DEFAULT_STORMS = ["HARVEY:2017", "IRMA:2017", "MICHAEL:2018"]
+
+HURRICANE_DTYPES = {"SID": str, "SEASON": "int16", "NAME": str, "ISO_TIME": str,
+                    "NATURE": "category", "LAT": "float32", "LON": "float32",
+                    "DIST2LAND": "float32", "LANDFALL": "float32",
+                    "USA_WIND": "float32", "USA_PRES": "float32", "USA_SSHS": "float32",
+                    "STORM_SPEED": "float32", "STORM_DIR": "float32"}
+
+ELECTION_DTYPES = {"year": "int16", "state": "category", "state_po": "category",
+                   "county_name": str, "county_fips": str, "office": "category",
+                   "candidate": "category", "party": "category",
+                   "candidatevotes": "float64", "totalvotes": "float64",
+                   "version": "int32", "mode": "category"}
+
+
+class Progress:
+    """
+    Reports rows read and throughput for a chunked read.
+    """
+
+    def __init__(self, label):
+        """
+        Constructor.
+
+        :param label: (str) name of the source being read
+        """
+        self.label = label
+        self.rows = 0
+        self.start = time.perf_counter()
+
+
+    def update(self, chunk_rows, kept_rows):
+        """
+        Records a processed chunk and prints a progress line.
+
+        :param chunk_rows: (int) rows in the chunk
+        :param kept_rows: (int) rows kept so far
+        """
+        self.rows += chunk_rows
+        elapsed = time.perf_counter() - self.start
+        print(f"\r{self.label}: {self.rows:,} rows read, {kept_rows:,} kept, "
+              f"{self.rows / max(elapsed, 1e-9):,.0f} rows/s", end="", file=sys.stderr)
+
+
+    def finish(self):
+        """
+        Prints the total time taken.
+        """
+        elapsed = time.perf_counter() - self.start
+        print(f"\n{self.label}: done in {elapsed:.1f}s", file=sys.stderr)
+
+
+def parse_storms(storms):
+    """
+    Parses NAME:SEASON storm filters. A bare NAME matches every season.
+
+    :param storms: (lst) strings such as "HARVEY:2017" or "SANDY"
+
+    :return: (dict) upper-case storm name to set of seasons (None for any)
+    """
+    parsed = {}
+    for storm in storms:
+        name, _, season = storm.partition(":")
+        name = name.upper()
+        if not season:
+            parsed[name] = None
+        elif parsed.get(name, set()) is not None:
+            parsed.setdefault(name, set()).add(int(season))
+
+    return parsed
+
+
+def ingest_hurricanes(path, storms, chunksize):
+    """
+    Streams IBTrACS and keeps the track points of the selected storms.
+
+    :param path: (str) path to the IBTrACS csv
+    :param storms: (dict) storm name to seasons, from parse_storms
+    :param chunksize: (int) rows per chunk
+
+    :return: Pandas dataframe of track points
+    """
+    progress = Progress("IBTrACS")
+    kept = []
+    kept_rows = 0
+    # The second line of IBTrACS files holds units, not data.
+    reader = pd.read_csv(path, usecols=list(HURRICANE_DTYPES), dtype=HURRICANE_DTYPES,
+                         skiprows=[1], na_values=[" "], keep_default_na=False,
+                         chunksize=chunksize)
+    for chunk in reader:
+        mask = chunk["NAME"].isin(list(storms))
+        for name, seasons in storms.items():
+            if seasons is not None:
+                mask &= (chunk["NAME"] != name) | chunk["SEASON"].isin(list(seasons))
+        chunk = chunk[mask]
+        kept.append(chunk)
+        kept_rows += len(chunk)
+        progress.update(len(mask), kept_rows)
+    progress.finish()
+
+    return pd.concat(kept, ignore_index=True)[list(HURRICANE_DTYPES)]
+
+
+def ingest_winners(path, chunksize):
+    """
+    Streams the MIT county presidential returns and keeps, for every
+    county and election year, the candidate row(s) with the most votes.
+    Only the current leaders are held in memory between chunks.
+
+    :param path: (str) path to the MIT csv
+    :param chunksize: (int) rows per chunk
+
+    :return: Pandas dataframe of county winners
+    """
+    progress = Progress("Elections")
+    leaders = None
+    reader = pd.read_csv(path, usecols=list(ELECTION_DTYPES), dtype=ELECTION_DTYPES,
+                         chunksize=chunksize)
+    for chunk in reader:
+        rows = len(chunk)
+        chunk = chunk[chunk["county_fips"].notna()]
+        chunk = chunk.assign(county_fips=chunk["county_fips"].str.zfill(5))
+        candidates = chunk if leaders is None else pd.concat([leaders, chunk], ignore_index=True)
+        most_votes = candidates.groupby(["county_fips", "year"], sort=False)["candidatevotes"].transform("max")
+        leaders = candidates[candidates["candidatevotes"] == most_votes]
+        progress.update(rows, len(leaders))
+    progress.finish()
+
+    return leaders.sort_values(["year", "county_fips"]).reset_index(drop=True)
+
+
+def write_table(dataframe, out_dir, name, file_format):
+    """
+    Writes a reference table as csv or (with pyarrow installed) parquet.
+
+    :param dataframe: Pandas dataframe
+    :param out_dir: (str) directory to write to
+    :param name: (str) file name without extension
+    :param file_format: (str) "csv" or "parquet"
+    """
+    path = os.path.join(out_dir, f"{name}.{file_format}")
+    if file_format == "parquet":
+        dataframe.to_parquet(path, index=False)
+    else:
+        dataframe.to_csv(path, index=False)
+    print(f"Wrote {len(dataframe):,} rows to {path}", file=sys.stderr)
+
+
+def main(argv=None):
+    """
+    Parses arguments and rebuilds the requested reference files.
+    """
+    parser = argparse.ArgumentParser(description="Rebuild the static reference data files.")
+    parser.add_argument("--ibtracs", help="path to ibtracs.ALL.list.v04r00.csv")
+    parser.add_argument("--elections", help="path to countypres_2000-2020.csv")
+    parser.add_argument("--storms", nargs="+", default=DEFAULT_STORMS,
+                        help="storms to keep as NAME:SEASON, or NAME for every season")
+    parser.add_argument("--out-dir", default=DATA_DIR)
+    parser.add_argument("--format", choices=["csv", "parquet"], default="csv")
+    parser.add_argument("--chunksize", type=int, default=200_000)
+    args = parser.parse_args(argv)
+
+    if not args.ibtracs and not args.elections:
+        parser.error("nothing to do: pass --ibtracs and/or --elections")
+
+    if args.ibtracs:
+        hurricanes = ingest_hurricanes(args.ibtracs, parse_storms(args.storms), args.chunksize)
+        write_table(hurricanes, args.out_dir, "hurricane_path", args.format)
+
+    if args.elections:
+        winners = ingest_winners(args.elections, args.chunksize)
+        write_table(winners, args.out_dir, "county_president_winner", args.format)
+
+
+if __name__ == "__main__":
+    main()
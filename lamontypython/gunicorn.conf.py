@@ -0,0 +1,46 @@
+"""
+(la)Monty Python
+
+Gunicorn settings for serving app.server in production:
+
+    gunicorn -c gunicorn.conf.py app:server
+
+Every setting can be overridden with the LAMONTY_* environment
+variables below. Workers share fetched datasets through the disk
+cache in backend/cache.py (LAMONTY_CACHE_DIR).
+"""
+import os
+import multiprocessing
+
+# The app reads its data files with paths relative to this directory.
+chdir = os.path.dirname(os.path.abspath(__file__))
+
+bind = os.environ.get("LAMONTY_BIND", "0.0.0.0:8050")
+
+# Processes for CPU-bound work (regressions, merges), threads so a slow
+# API pull only ties up one thread instead of a whole worker.
+workers = int(os.environ.get("LAMONTY_WORKERS", multiprocessing.cpu_count() + 1))
+worker_class = "gthread"
+threads = int(os.environ.get("LAMONTY_THREADS", 4))
+
+# FEMA and ACS pulls for large selections can take minutes.
+timeout = int(os.environ.get("LAMONTY_TIMEOUT", 300))
+
+# Recycle workers after a number of requests to cap memory growth from
+# pandas/plotly, jittered so they do not all restart at once, and give
+# in-flight callbacks time to finish before a recycled worker exits.
+max_requests = int(os.environ.get("LAMONTY_MAX_REQUESTS", 500))
+max_requests_jitter = int(os.environ.get("LAMONTY_MAX_REQUESTS_JITTER", 50))
+graceful_timeout = int(os.environ.get("LAMONTY_GRACEFUL_TIMEOUT", 60))
+keepalive = 5
+
+accesslog = "-"
+errorlog = "-"
+
+
+def on_starting(server):
+    """
+    Creates the shared cache directory before any worker starts.
+    """
+    from backend.cache import CACHE_DIR
+    os.makedirs(os.path.join(chdir, CACHE_DIR), exist_ok=True)
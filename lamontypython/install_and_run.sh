@@ -11,5 +11,9 @@ echo -e "Install is complete."
 
 echo -e "Starting application."
 
-python3 app.py
+if [ "$1" == "--prod" ]; then
+    gunicorn -c gunicorn.conf.py app:server
+else
+    python3 app.py
+fi
 
@@ -0,0 +1,144 @@
+"""
+High-dimensional fixed effects OLS.
+
+Absorbs one or more sets of fixed effects (e.g. county, or county and
+year) by demeaning the data with alternating projections over integer
+group codes, instead of building dummy matrices, then runs OLS on the
+demeaned data with cluster-robust standard errors.
+
+(la)Monty Python
+"""
+import numpy as np
+import pandas as pd
+from scipy import stats
+
+
+def group_means(values, codes, counts):
+    '''
+    Means of each column of values within each group.
+
+    Input:
+        -values (n x k array): data to average.
+        -codes (int array): group code of each row.
+        -counts (int array): number of rows in each group.
+    '''
+    sums = np.column_stack([np.bincount(codes, weights=values[:, j], minlength=len(counts))
+                            for j in range(values.shape[1])])
+    return sums / counts[:, None]
+
+
+def drop_singletons(codes):
+    '''
+    Finds rows that are alone in a group of any factor. Those rows are
+    fitted perfectly by their fixed effect and carry no information, so
+    they are dropped repeatedly until none remain.
+
+    Input:
+        -codes (list of int arrays): group codes of each factor.
+    '''
+    keep = np.ones(len(codes[0]), dtype=bool)
+    while keep.any():
+        singletons = np.zeros(len(keep), dtype=bool)
+        for factor in codes:
+            counts = np.bincount(factor[keep], minlength=factor.max() + 1)
+            singletons[keep] |= counts[factor[keep]] == 1
+        if not singletons.any():
+            return keep
+        keep &= ~singletons
+    return keep
+
+
+def demean(values, codes, tol=1e-10, max_iter=10000):
+    '''
+    Removes every factor's group means from each column by alternating
+    projections, iterating until the data stop changing. One factor
+    converges in a single pass.
+
+    Input:
+        -values (n x k array): data to demean.
+        -codes (list of int arrays): group codes of each factor, 0..G-1.
+        -tol (float): convergence tolerance relative to the data's scale.
+        -max_iter (int): maximum number of sweeps over the factors.
+    '''
+    resid = values.astype(float)
+    counts = [np.bincount(factor) for factor in codes]
+    scale = max(np.abs(resid).max(), 1.0)
+    for _ in range(max_iter):
+        change = 0.0
+        for factor, factor_counts in zip(codes, counts):
+            means = group_means(resid, factor, factor_counts)
+            resid -= means[factor]
+            change = max(change, np.abs(means).max())
+        if len(codes) == 1 or change < tol * scale:
+            break
+
+    return resid
+
+
+class FixedEffectsResult():
+    '''
+    Results of a fixed effects regression, with the attributes
+    DisasterRegs.output_to_df reads from linearmodels results.
+    '''
+
+    def __init__(self, params, std_errors, df_resid, nobs, rsquared_within, n_clusters):
+        self.params = params
+        self.std_errors = std_errors
+        self.tstats = params / std_errors
+        self.pvalues = pd.Series(2 * stats.t.sf(np.abs(self.tstats), df_resid),
+                                 index=params.index)
+        self.nobs = nobs
+        self.rsquared_within = rsquared_within
+        self.n_clusters = n_clusters
+
+
+def absorbing_ols(y, X, effects, clusters):
+    '''
+    Runs OLS absorbing the given fixed effects, with standard errors
+    clustered on `clusters`. Raises ValueError when too few rows are in
+    groups of more than one row, or when a regressor does not vary
+    within groups.
+
+    Input:
+        -y (pandas series): dependent variable.
+        -X (pandas df): regressors, without a constant.
+        -effects (pandas df): one column of group labels per fixed effect.
+        -clusters (pandas series): cluster label of each row.
+    '''
+    name = ' and '.join(effects.columns)
+    codes = [pd.factorize(effects[col])[0] for col in effects.columns]
+    keep = drop_singletons(codes)
+    if keep.sum() <= X.shape[1]:
+        raise ValueError(f"{name} fixed effects: {keep.sum()} of {len(keep)} rows are left after "
+                         "dropping groups with a single row, too few to estimate the regression")
+    codes = [pd.factorize(factor[keep])[0] for factor in codes]
+
+    data = np.column_stack([y.to_numpy(dtype=float)[keep], X.to_numpy(dtype=float)[keep]])
+    data = demean(data, codes)
+    y_dm, X_dm = data[:, 0], data[:, 1:]
+
+    # A regressor constant within groups is absorbed by the fixed effects.
+    scale = np.maximum(np.abs(X.to_numpy(dtype=float)[keep]).max(axis=0), 1.0)
+    absorbed = [col for col, spread in zip(X.columns, np.abs(X_dm).max(axis=0) / scale)
+                if spread < 1e-8]
+    if absorbed:
+        raise ValueError(f"{name} fixed effects: {', '.join(absorbed)} "
+                         "have no variation left within groups")
+
+    xtx_inv = np.linalg.pinv(X_dm.T @ X_dm)
+    beta = xtx_inv @ (X_dm.T @ y_dm)
+    resid = y_dm - X_dm @ beta
+
+    cluster_codes, cluster_labels = pd.factorize(clusters.to_numpy()[keep])
+    n_clusters = len(cluster_labels)
+    scores = np.column_stack([np.bincount(cluster_codes, weights=X_dm[:, j] * resid,
+                                          minlength=n_clusters)
+                              for j in range(X_dm.shape[1])])
+    n, k = X_dm.shape
+    adjustment = n_clusters / (n_clusters - 1) * (n - 1) / (n - k)
+    cov = adjustment * xtx_inv @ (scores.T @ scores) @ xtx_inv
+
+    rsquared_within = 1 - resid @ resid / (y_dm @ y_dm)
+    return FixedEffectsResult(pd.Series(beta, index=X.columns),
+                              pd.Series(np.sqrt(np.diag(cov)), index=X.columns),
+                              n_clusters - 1, n, rsquared_within, n_clusters)
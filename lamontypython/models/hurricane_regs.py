@@ -12,7 +12,11 @@ from statsmodels.stats.outliers_influence import variance_inflation_factor
 from patsy import dmatrices
 import numpy as np
 import pandas as pd
-from backend import datasets
+from backend import partitions, catalog
+from backend.acs_api import ACSapi
+from models.fixed_effects import absorbing_ols
+from models import spec_search, streamed_ols
+from utils import exposure
 
 class DisasterRegs():
     '''
@@ -30,10 +34,25 @@ class DisasterRegs():
                 'vacant_housing_rate':'Percentage of housing units vacant at time of survey.',
                 'rental_vacancy_rate':'Percentage of rental units vacant at time of survey.',
                 'median_rent':'Median gross rent at county level (in nominal dollars).',
-                'median_home_price':'Median home price at county level (in nominal dollars).'}
+                'median_home_price':'Median home price at county level (in nominal dollars).',
+                'renter_occupied_rate':'Percentage of occupied housing units that are renter-occupied.',
+                'median_age':'Median age of county population.',
+                'gini_index':'Gini index of county household income inequality.',
+                'track_distance_km':'Distance from county centroid to the hurricane track (km).',
+                'max_wind_nearby':f'Highest hurricane wind speed (knots) within {exposure.EXPOSURE_RADIUS_KM:g} km of the county.',
+                'hours_within_radius':f'Hours the hurricane spent within {exposure.EXPOSURE_RADIUS_KM:g} km of the county.'}
 
+    regressors = ['foreign_born','black_afam','median_income','snap_benefits','unemp_rate',
+        'health_insurance_rate','vacant_housing_rate','rental_vacancy_rate','median_rent','median_home_price','population']
 
-    def __init__(self, states, year,reg_type = None):
+    outcomes = ['aid_requested','aid_obligated','aid_per_capita','total_obligated']
+
+    effect_columns = {'county':['county'],
+                'county_year':['county','year'],
+                'county_disaster':['county','disaster_number']}
+
+
+    def __init__(self, states, year,reg_type = None,indicators = None,track = None):
         '''
 		Constructor.
 
@@ -42,19 +61,70 @@ class DisasterRegs():
             to specific hurricane.
             -year: year hurricane occurred.
             -reg_type: regression type to run.
+            -indicators: extra ACS variables (see ACSapi.variable_codes) to add
+            to the default regressors. Only the new columns are downloaded.
+            Storm exposure features (see utils/exposure.py) can be added too.
+            -track: the hurricane's track points, needed for exposure features.
 		'''
         self.states = states
         self.year = year
         self.reg_type = reg_type
+        self.track = track
+        indicators = [i for i in (indicators or []) if i not in self.regressors]
+        self.exposure = [i for i in indicators if i in exposure.FEATURES]
+        if self.exposure and track is None:
+            raise ValueError("Exposure features need the hurricane track")
+        self.indicators = [i for i in indicators if i not in exposure.FEATURES]
+        self.regressors = self.regressors + self.indicators + self.exposure
+
+
+    @classmethod
+    def for_disasters(cls,disaster_numbers,**kwargs):
+        '''
+        Class method building a regression over the states and years of FEMA
+        disasters, looked up in the local disaster catalog.
+
+        Input:
+            -disaster_numbers: list of FEMA disaster numbers.
+            -kwargs: other arguments of the constructor.
+        '''
+        disasters = catalog.get_catalog()
+        scope = disasters.scope(disaster_numbers) if disasters is not None else None
+        if scope is None:
+            raise ValueError(f"Disasters {disaster_numbers} are not in the disaster catalog")
+        return cls(scope['states_fips'],scope['year'],**kwargs)
 
 
     def pull_data(self):
         '''
         Method that will pull data using API abstract class.
         '''
-        self.dataframe = datasets.get_data(self.states,self.year)
+        variables = ACSapi.default_variables + self.indicators if self.indicators else None
+        self.dataframe = self.add_exposure(partitions.get_data(self.states,self.year,variables=variables))
         return self.dataframe
-    
+
+
+    def add_exposure(self,dataframe):
+        '''
+        Method merging the selected storm exposure features onto FEMA and ACS data.
+        Counties without a centroid get no wind and no hours near the storm, but
+        their distance to the track is unknown, so those rows are dropped when
+        the distance is a regressor.
+
+        Input:
+            -dataframe: pandas dataframe with state_fips and county_fips columns.
+        '''
+        if not self.exposure:
+            return dataframe
+        features = exposure.storm_exposure(self.track)
+        dataframe = dataframe.merge(features, how='left', on=['state_fips','county_fips'],
+                        validate='many_to_one')
+        zero_fill = [i for i in self.exposure if i in ['max_wind_nearby','hours_within_radius']]
+        dataframe[zero_fill] = dataframe[zero_fill].fillna(0)
+        if 'track_distance_km' in self.exposure:
+            dataframe = dataframe.dropna(subset=['track_distance_km']).reset_index(drop=True)
+        return dataframe
+
 
     def pooled_ols(self,dataset):
         '''
@@ -64,8 +134,7 @@ class DisasterRegs():
             -dataset: pandas dataframe to be read in and analyzed.
         '''
         y = pd.DataFrame(dataset, columns=['aid_requested'])
-        exog_vars = self.vif_detection(pd.DataFrame(dataset, columns=['foreign_born','black_afam','median_income','snap_benefits','unemp_rate',
-        'health_insurance_rate','vacant_housing_rate','rental_vacancy_rate','median_rent','median_home_price','population']),y)
+        exog_vars = self.vif_detection(pd.DataFrame(dataset, columns=self.regressors),y)
         X = sm.add_constant(exog_vars)
         var_table = self.var_table(X)
         pooled_reg = sm.OLS(y,X).fit()
@@ -73,21 +142,61 @@ class DisasterRegs():
         return self.output_to_df(pooled_reg,"pooled"),y.merge(exog_vars, left_index=True, right_index=True),var_table
 
 
-    def panel_ols(self,dataset):
+    def streamed_ols(self,workers=None,cov_type='nonrobust'):
+        '''
+        Method running the pooled OLS regression of pooled_ols without holding
+        the panel in memory: each (state, year) partition is loaded on its own
+        and reduced to cross products (see models/streamed_ols.py), which are
+        summed and solved once. Partitions are read from the disk tier of the
+        partition cache without entering its memory tier, so a scan of many
+        states and years neither stays in memory nor evicts the app's entries. Regressors are screened with the same VIF
+        cutoff as vif_detection, computed from the cross products.
+
+        Input:
+            -workers: partitions loaded and reduced in parallel, None for one
+                at a time.
+            -cov_type: 'nonrobust' for the conventional standard errors of
+                pooled_ols, or 'HC0'/'HC1' for heteroskedasticity-robust ones.
+        '''
+        variables = ACSapi.default_variables + self.indicators if self.indicators else None
+
+        def partition_moments(key):
+            partition = partitions.get_data([key[0]],[key[1]],variables=variables,remember=False)
+            return streamed_ols.Moments.from_frame(self.add_exposure(partition),
+                        self.regressors,'aid_requested')
+
+        keys = partitions.partition_keys(self.states,self.year)
+        moments = streamed_ols.reduce_partitions(keys,partition_moments,self.regressors,workers)
+        exog_vars = streamed_ols.vif_select(moments)
+        stream_reg = streamed_ols.solve(moments,exog_vars,cov_type)
+        var_table = self.var_table(pd.DataFrame(columns=['const'] + exog_vars))
+
+        return self.output_to_df(stream_reg,"pooled"),var_table
+
+
+    def panel_ols(self,dataset,effects='state'):
         '''
-        Method running Fixed Effect regression. The state is set to be the panel variable, 
-        with the year being the time variable.
+        Method running Fixed Effect regression. By default the state is set to be the
+        panel variable, with the year being the time variable. County and two-way
+        effects are absorbed with the alternating projections solver in
+        models/fixed_effects.py, with standard errors clustered by county.
 
         Input:
             -dataset: pandas dataframe to be read in and analyzed.
+            -effects: 'state', or one of the keys of effect_columns: 'county',
+                'county_year' (county and year) or 'county_disaster' (county and
+                disaster number, as two additive effects).
         '''
+        if effects != 'state':
+            return self.absorbed_ols(dataset,effects)
+
+        dataset = dataset.copy()
         dataset['year'] = pd.to_datetime(dataset.year, format='%Y')
         dataset.astype({'state_fips': 'int32'}).dtypes
         dataset = dataset.set_index(['state_fips','year'])
 
         y = pd.DataFrame(dataset, columns=['aid_requested'])
-        exog_vars = self.vif_detection(pd.DataFrame(dataset, columns=['foreign_born','black_afam','median_income','snap_benefits','unemp_rate',
-        'health_insurance_rate','vacant_housing_rate','rental_vacancy_rate','median_rent','median_home_price','population']),y)
+        exog_vars = self.vif_detection(pd.DataFrame(dataset, columns=self.regressors),y)
         X = sm.add_constant(exog_vars)
         var_table = self.var_table(X)
         
@@ -96,6 +205,53 @@ class DisasterRegs():
         return self.output_to_df(fe_reg,"fe"),y.merge(exog_vars, left_index=True, right_index=True),var_table
 
 
+    def absorbed_ols(self,dataset,effects):
+        '''
+        Method running a county or two-way Fixed Effect regression without dummy
+        variables, so it scales to thousands of counties. Counties must be observed
+        more than once, so a scope covering a single year raises a ValueError, as
+        does a regressor that does not vary within counties.
+
+        Input:
+            -dataset: pandas dataframe to be read in and analyzed.
+            -effects: one of the keys of effect_columns.
+        '''
+        if effects not in self.effect_columns:
+            raise ValueError(f"Unknown fixed effects '{effects}', expected 'state' or one of "
+                             f"{list(self.effect_columns)}")
+        dataset = dataset.assign(county=dataset['state_fips'].astype(str) + dataset['county_fips'].astype(str))
+
+        y = pd.DataFrame(dataset, columns=['aid_requested'])
+        exog_vars = self.vif_detection(pd.DataFrame(dataset, columns=self.regressors),y)
+        var_table = self.var_table(exog_vars)
+
+        fe_reg = absorbing_ols(y['aid_requested'], exog_vars,
+                    dataset[self.effect_columns[effects]], dataset['county'])
+
+        return self.output_to_df(fe_reg,"fe"),y.merge(exog_vars, left_index=True, right_index=True),var_table
+
+
+    def specification_search(self,dataset,criterion='bic',max_size=None,top=10,workers=None):
+        '''
+        Method ranking pooled OLS specifications: every subset of the regressors
+        is fitted against each outcome and scored by AIC, BIC and 5-fold
+        cross-validated RMSE. Subsets failing the VIF cutoff of vif_detection are
+        left out. Returns the ranked table and a variable description table.
+
+        Input:
+            -dataset: pandas dataframe to be read in and analyzed.
+            -criterion: 'aic', 'bic' or 'cv', the column candidates are ranked by.
+            -max_size: most regressors in a candidate, None for no limit.
+            -top: number of candidates shown per outcome.
+            -workers: processes to score candidates on, see spec_search.search.
+        '''
+        ranked = spec_search.search(dataset, self.regressors, self.outcomes, criterion=criterion,
+                    max_size=max_size, top=top, workers=workers)
+        var_table = self.var_table(pd.DataFrame(columns=self.regressors))
+
+        return ranked,var_table
+
+
     def output_to_df(self,reg_output,reg_type):
         '''
         Method taking regression summary table and saves in clean pandas df.
@@ -156,7 +312,7 @@ class DisasterRegs():
         '''
         desc_list=[]
         for var in exog_vars.columns:
-            desc_list.append(self.variable_dict[var])
+            desc_list.append(self.variable_dict.get(var, var))
 
         return pd.DataFrame({"Independent Variable":exog_vars.columns, "Description":desc_list})
 
@@ -0,0 +1,222 @@
+"""
+Model specification search.
+
+Scores every subset of the candidate regressors, for several outcome
+variables at once, by AIC, BIC and K-fold cross-validation. OLS only
+needs cross products of the data, so one Gram matrix of the constant,
+regressors and outcomes (plus one per fold) is computed up front and
+each candidate is fitted from its sub-blocks without touching the rows
+again. Candidates are scored in chunks on a small process pool. Its
+workers are started from a forkserver, not forked from the web worker
+that first runs a search, so they do not inherit that worker's threads,
+locks and sockets.
+
+(la)Monty Python
+"""
+import os
+import itertools
+import threading
+import multiprocessing
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+
+# Per server process, so keep it small: every Gunicorn worker gets its own pool.
+SEARCH_WORKERS = int(os.environ.get("LAMONTY_SEARCH_WORKERS", min(2, os.cpu_count() or 1)))
+# Most regressors in a candidate for interactive searches; 17 regressors
+# give 131k subsets in all but 22k of at most 6.
+SEARCH_MAX_SIZE = int(os.environ.get("LAMONTY_SEARCH_MAX_SIZE", 6))
+# Candidates per task; searches smaller than one chunk run in-process.
+CHUNK_SIZE = 256
+CRITERIA = {'aic': 'AIC', 'bic': 'BIC', 'cv': 'CV RMSE'}
+
+pool = None
+pool_lock = threading.Lock()
+
+
+def get_pool():
+    '''
+    Process pool shared by every search in this process, started on first use.
+    '''
+    global pool
+    with pool_lock:
+        if pool is None:
+            pool = ProcessPoolExecutor(max_workers=SEARCH_WORKERS,
+                                       mp_context=multiprocessing.get_context("forkserver"))
+        return pool
+
+
+def gram_matrices(data, folds=5, seed=0):
+    '''
+    Cross products of the data as a whole and within each of `folds`
+    random folds. The data's first column should be the constant.
+
+    Input:
+        -data (n x p array): constant, regressors and outcomes.
+        -folds (int): number of cross-validation folds.
+        -seed (int): seed of the fold assignment.
+    '''
+    fold_of_row = np.random.default_rng(seed).permutation(len(data)) % folds
+    fold_grams = np.stack([data[fold_of_row == f].T @ data[fold_of_row == f]
+                           for f in range(folds)])
+    return fold_grams.sum(axis=0), fold_grams
+
+
+def candidate_subsets(n_regressors, min_size=1, max_size=None):
+    '''
+    Every subset of the regressors with between min_size and max_size members,
+    as tuples of regressor positions.
+
+    Input:
+        -n_regressors (int): number of candidate regressors.
+        -min_size (int): fewest regressors in a candidate.
+        -max_size (int): most regressors in a candidate, None for all of them.
+    '''
+    max_size = n_regressors if max_size is None else min(max_size, n_regressors)
+    return [subset for size in range(min_size, max_size + 1)
+            for subset in itertools.combinations(range(n_regressors), size)]
+
+
+def batched_solve(a, b):
+    '''
+    Solves a stack of linear systems, leaving NaN for the singular ones.
+
+    Input:
+        -a (... x k x k array): coefficient matrices.
+        -b (... x k x m array): right hand sides.
+    '''
+    try:
+        return np.linalg.solve(a, b)
+    except np.linalg.LinAlgError:
+        out = np.full(b.shape, np.nan)
+        for i in np.ndindex(a.shape[:-2]):
+            try:
+                out[i] = np.linalg.solve(a[i], b[i])
+            except np.linalg.LinAlgError:
+                pass
+        return out
+
+
+def score_subsets(gram, fold_grams, n_regressors, subsets):
+    '''
+    Fits OLS with a constant for every subset and every outcome and returns
+    one row of fit statistics per (subset, outcome). Subsets of the same size
+    are solved together as one stack. Subsets whose regressors are perfectly
+    collinear are skipped.
+
+    Input:
+        -gram (p x p array): cross products of constant, regressors and outcomes.
+        -fold_grams (folds x p x p array): the same cross products within each fold.
+        -n_regressors (int): number of regressors; later columns are outcomes.
+        -subsets (list of tuples): regressor positions of each candidate.
+    '''
+    n = gram[0, 0]
+    outcomes = np.arange(1 + n_regressors, gram.shape[0])
+    yy = np.diag(gram)[outcomes]
+    tss = yy - gram[0, outcomes] ** 2 / n
+    # Correlations of the regressors, for the VIFs.
+    means = gram[0, 1:1 + n_regressors] / n
+    centered = gram[1:1 + n_regressors, 1:1 + n_regressors] - n * np.outer(means, means)
+    scale = np.sqrt(np.diag(centered))
+    corr = centered / np.outer(scale, scale)
+    train_grams = gram - fold_grams
+    fold_yy = np.diagonal(fold_grams, axis1=1, axis2=2)[:, outcomes]
+
+    rows = []
+    for size in sorted(set(map(len, subsets))):
+        group = np.array([subset for subset in subsets if len(subset) == size])
+        cols = np.column_stack([np.zeros(len(group), dtype=int), group + 1])
+        k = size + 1
+        block = (cols[:, :, None], cols[:, None, :])
+        cross = (cols[:, :, None], outcomes[None, None, :])
+
+        beta = batched_solve(gram[block], gram[cross])
+        ssr = yy - np.einsum('sij,sij->sj', beta, gram[cross])
+        vif = np.diagonal(batched_solve(corr[group[:, :, None], group[:, None, :]],
+                                        np.broadcast_to(np.eye(size), (len(group), size, size))),
+                          axis1=1, axis2=2)
+        max_vif = vif.max(axis=1)
+
+        sse = np.zeros(ssr.shape)
+        for fold, train, f_yy in zip(fold_grams, train_grams, fold_yy):
+            fold_beta = batched_solve(train[block], train[cross])
+            sse += (f_yy - 2 * np.einsum('sij,sij->sj', fold_beta, fold[cross])
+                    + np.einsum('sij,sik,skj->sj', fold_beta, fold[block], fold_beta))
+
+        # -2 x the Gaussian log-likelihood, as statsmodels reports it.
+        log_lik_term = n * (np.log(np.maximum(ssr, 1e-300) / n) + 1 + np.log(2 * np.pi))
+        aic = log_lik_term + 2 * k
+        bic = log_lik_term + k * np.log(n)
+        cv = np.sqrt(np.maximum(sse, 0) / n)
+        adj_r2 = 1 - (ssr / (n - k)) / (tss / (n - 1))
+        for s, subset in enumerate(map(tuple, group.tolist())):
+            if np.isnan(beta[s]).any() or np.isnan(sse[s]).any():
+                continue
+            for j in range(len(outcomes)):
+                rows.append({'subset': subset, 'outcome': j, 'regressors': size,
+                             'aic': aic[s, j], 'bic': bic[s, j], 'cv': cv[s, j],
+                             'adj_r2': adj_r2[s, j], 'max_vif': max_vif[s]})
+    return rows
+
+
+def search(dataset, regressors, outcomes, criterion='bic', min_size=1, max_size=None,
+           max_vif=5, folds=5, top=10, workers=None):
+    '''
+    Ranks regressor subsets for each outcome. Returns a table of the `top`
+    best candidates per outcome, best first, with every criterion shown.
+
+    Input:
+        -dataset (pandas df): data holding the regressors and outcomes.
+        -regressors (list): candidate regressor columns.
+        -outcomes (list): outcome columns, each scored against every subset.
+        -criterion (str): ranking criterion, 'aic', 'bic' or 'cv' (K-fold RMSE).
+        -min_size, max_size (int): fewest and most regressors in a candidate.
+        -max_vif (float): drop candidates whose largest VIF exceeds this,
+            matching the VIF screen of the single fit. None keeps all.
+        -folds (int): number of cross-validation folds.
+        -top (int): candidates kept per outcome.
+        -workers (int): processes to score on; 1 scores in-process,
+            None uses the shared pool for searches larger than one chunk.
+    '''
+    if criterion not in CRITERIA:
+        raise ValueError(f"criterion must be one of {list(CRITERIA)}")
+    data = dataset[regressors + outcomes].astype(float)
+    data = data[np.isfinite(data).all(axis=1)].to_numpy()
+    data = np.column_stack([np.ones(len(data)), data])
+    gram, fold_grams = gram_matrices(data, folds)
+
+    # Keep at least one residual degree of freedom.
+    max_size = min(max_size or len(regressors), len(data) - 2)
+    subsets = candidate_subsets(len(regressors), min_size, max_size)
+    chunks = [subsets[i:i + CHUNK_SIZE] for i in range(0, len(subsets), CHUNK_SIZE)]
+    if workers == 1 or len(chunks) == 1:
+        rows = [row for chunk in chunks
+                for row in score_subsets(gram, fold_grams, len(regressors), chunk)]
+    else:
+        executor = (ProcessPoolExecutor(max_workers=workers,
+                                        mp_context=multiprocessing.get_context("forkserver"))
+                    if workers else get_pool())
+        try:
+            results = executor.map(score_subsets, itertools.repeat(gram), itertools.repeat(fold_grams),
+                                   itertools.repeat(len(regressors)), chunks)
+            rows = [row for chunk_rows in results for row in chunk_rows]
+        finally:
+            if workers:
+                executor.shutdown()
+
+    scores = pd.DataFrame(rows, columns=['subset', 'outcome', 'regressors', 'aic', 'bic',
+                                         'cv', 'adj_r2', 'max_vif'])
+    if max_vif is not None:
+        scores = scores[scores['max_vif'] <= max_vif]
+    scores = scores.sort_values(criterion).groupby('outcome').head(top)
+    scores = scores.sort_values(['outcome', criterion])
+    scores['rank'] = scores.groupby('outcome').cumcount() + 1
+
+    return pd.DataFrame({'Outcome': [outcomes[j] for j in scores['outcome']],
+                         'Rank': scores['rank'],
+                         'Regressors': [', '.join(regressors[i] for i in subset)
+                                        for subset in scores['subset']],
+                         'AIC': scores['aic'], 'BIC': scores['bic'],
+                         'CV RMSE': scores['cv'],
+                         'Adj. R-Squared': scores['adj_r2'],
+                         'Max VIF': scores['max_vif']}).round(decimals=3).reset_index(drop=True)
@@ -0,0 +1,222 @@
+"""
+OLS from streamed sufficient statistics.
+
+Accumulates the cross products OLS needs (X'X, X'y, y'y and the row
+count) one partition at a time, so the full panel never has to be in
+memory. Heteroskedasticity-robust standard errors need the residuals,
+which are only known once the coefficients are. Expanding the squared
+residual instead gives
+
+    sum e^2 x x' = sum y^2 x x' - 2 sum y (x'b) x x' + sum (x'b)^2 x x'
+
+so the third and fourth moment tensors of the regressors are
+accumulated in the same pass and the robust covariance is assembled
+after solving. Partitions can be reduced in parallel, since the
+statistics of a union are the sums of the statistics of its parts.
+
+(la)Monty Python
+"""
+import numpy as np
+import pandas as pd
+from scipy import stats
+from concurrent.futures import ThreadPoolExecutor
+
+
+class Moments():
+    '''
+    Sufficient statistics of a regression of y on a constant and X.
+    Index 0 of every array is the constant.
+    '''
+
+    def __init__(self, columns):
+        '''
+        Constructor.
+
+        Input:
+            -columns (list): regressor names, without the constant.
+        '''
+        self.columns = ['const'] + list(columns)
+        k = len(self.columns)
+        self.n = 0
+        self.xtx = np.zeros((k, k))
+        self.xty = np.zeros(k)
+        self.yty = 0.0
+        self.y2xx = np.zeros((k, k))
+        self.yxxx = np.zeros((k, k, k))
+        self.xxxx = np.zeros((k, k, k, k))
+
+
+    @classmethod
+    def from_frame(cls, dataset, columns, outcome):
+        '''
+        Class method computing the statistics of one partition.
+
+        Input:
+            -dataset (pandas df): partition holding the regressors and outcome.
+                Rows with missing values are left out.
+            -columns (list): regressor names.
+            -outcome (str): dependent variable.
+        '''
+        moments = cls(columns)
+        dataset = dataset[list(columns) + [outcome]].dropna()
+        if len(dataset):
+            X = dataset[list(columns)].to_numpy(dtype=float)
+            moments.add(np.column_stack([np.ones(len(X)), X]),
+                        dataset[outcome].to_numpy(dtype=float))
+        return moments
+
+
+    def add(self, X, y):
+        '''
+        Method adding rows to the statistics.
+
+        Input:
+            -X (n x k array): regressors, constant first.
+            -y (array): dependent variable.
+        '''
+        n, k = X.shape
+        pairs = (X[:, :, None] * X[:, None, :]).reshape(n, k * k)
+        self.n += n
+        self.xtx += X.T @ X
+        self.xty += X.T @ y
+        self.yty += y @ y
+        self.y2xx += (pairs.T @ (y * y)).reshape(k, k)
+        self.yxxx += (pairs.T @ (X * y[:, None])).reshape(k, k, k)
+        self.xxxx += (pairs.T @ pairs).reshape(k, k, k, k)
+
+
+    def __add__(self, other):
+        '''
+        Statistics of the union of two sets of rows.
+        '''
+        total = Moments(self.columns[1:])
+        for name in ['n', 'xtx', 'xty', 'yty', 'y2xx', 'yxxx', 'xxxx']:
+            setattr(total, name, getattr(self, name) + getattr(other, name))
+        return total
+
+
+def vif_select(moments, max_vif=5):
+    '''
+    Drops the regressor with the highest Variance Inflation Factor until
+    none exceeds max_vif, as DisasterRegs.vif_detection does. The VIFs
+    come from the regressors' correlation matrix, built from the
+    accumulated cross products, so they do not depend on the regressors'
+    units (as spec_search's do). A regressor with no variation, or one
+    the others explain exactly, has an infinite VIF.
+
+    Input:
+        -moments (Moments): accumulated statistics.
+        -max_vif (float): cutoff for multicollinearity.
+    '''
+    n, xtx = moments.n, moments.xtx
+    means = xtx[0, 1:] / n
+    centered = xtx[1:, 1:] - n * np.outer(means, means)
+    scale = np.sqrt(np.clip(np.diag(centered), 0, None))
+    constant = scale <= 1e-12 * np.maximum(np.abs(means), 1)
+    scale[constant] = 1
+    corr = centered / np.outer(scale, scale)
+
+    keep = list(range(len(moments.columns) - 1))
+    while keep:
+        vif = []
+        for col in keep:
+            others = [other for other in keep if other != col]
+            if constant[col]:
+                vif.append(np.inf)
+                continue
+            r = corr[others, col]
+            r2 = r @ np.linalg.pinv(corr[np.ix_(others, others)]) @ r if others else 0.0
+            with np.errstate(divide='ignore'):
+                vif.append(1 / np.maximum(1 - r2, 0))
+        if max(vif) <= max_vif:
+            break
+        del keep[int(np.argmax(vif))]
+
+    return [moments.columns[i + 1] for i in keep]
+
+
+COV_TYPES = ['nonrobust', 'HC0', 'HC1']
+
+
+class StreamedOLSResult():
+    '''
+    Results of a streamed OLS regression, with the attributes
+    DisasterRegs.output_to_df reads from statsmodels results for "pooled".
+    '''
+
+    def __init__(self, params, cov, df_resid, nobs, rsquared, cov_type):
+        self.params = params
+        self.cov_params = cov
+        self.bse = pd.Series(np.sqrt(np.diag(cov)), index=params.index)
+        self.tvalues = params / self.bse
+        self.pvalues = pd.Series(2 * stats.t.sf(np.abs(self.tvalues), df_resid), index=params.index)
+        self.df_resid = df_resid
+        self.nobs = nobs
+        self.rsquared = rsquared
+        self.cov_type = cov_type
+
+
+def solve(moments, columns=None, cov_type='nonrobust'):
+    '''
+    Solves OLS of the outcome on a constant and a subset of the regressors
+    from accumulated statistics.
+
+    Input:
+        -moments (Moments): accumulated statistics.
+        -columns (list): regressors to use, None for all of them.
+        -cov_type (str): 'nonrobust' for conventional standard errors, as
+            statsmodels OLS fits by default, or 'HC0'/'HC1' for
+            heteroskedasticity-robust ones.
+    '''
+    if cov_type not in COV_TYPES:
+        raise ValueError(f"cov_type must be one of {COV_TYPES}")
+    columns = moments.columns[1:] if columns is None else list(columns)
+    idx = [0] + [moments.columns.index(col) for col in columns]
+    n, k = moments.n, len(idx)
+
+    xtx = moments.xtx[np.ix_(idx, idx)]
+    xty = moments.xty[idx]
+    # Equilibrate so the pseudo-inverse is not thrown off by the regressors' units.
+    scale = np.sqrt(np.diag(xtx))
+    scale[scale == 0] = 1
+    xtx_inv = np.linalg.pinv(xtx / np.outer(scale, scale)) / np.outer(scale, scale)
+    beta = xtx_inv @ xty
+    ssr = moments.yty - beta @ xty
+
+    if cov_type == 'nonrobust':
+        cov = ssr / (n - k) * xtx_inv
+    else:
+        meat = (moments.y2xx[np.ix_(idx, idx)]
+                - 2 * np.einsum('abc,c->ab', moments.yxxx[np.ix_(idx, idx, idx)], beta)
+                + np.einsum('abcd,c,d->ab', moments.xxxx[np.ix_(idx, idx, idx, idx)], beta, beta))
+        cov = xtx_inv @ meat @ xtx_inv
+        if cov_type == 'HC1':
+            cov = cov * n / (n - k)
+
+    tss = moments.yty - moments.xty[0] ** 2 / n
+    names = ['const'] + columns
+    return StreamedOLSResult(pd.Series(beta, index=names), pd.DataFrame(cov, index=names, columns=names),
+                             n - k, n, 1 - ssr / tss, cov_type)
+
+
+def reduce_partitions(keys, partition_moments, columns, workers=None):
+    '''
+    Accumulates the statistics of every partition, holding at most
+    `workers` partitions in memory at once.
+
+    Input:
+        -keys (list): partition keys.
+        -partition_moments (function): computes the Moments of one key.
+        -columns (list): regressor names.
+        -workers (int): partitions processed in parallel, None for one at a time.
+    '''
+    total = Moments(columns)
+    if not workers or workers == 1:
+        for key in keys:
+            total = total + partition_moments(key)
+        return total
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for moments in pool.map(partition_moments, keys):
+            total = total + moments
+    return total
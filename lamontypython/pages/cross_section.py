@@ -1,12 +1,16 @@
 # Run this app with `python app.py` and
 # visit http://127.0.0.1:8050/ in your web browser.
 
-from dash import Dash, html, dcc, Input, Output, callback
+from dash import Dash, html, dcc, Input, Output, State, callback, callback_context, no_update
 import plotly.express as px
+from dash.exceptions import PreventUpdate
 import pandas as pd
 import json
+import time
 from helper import parse_restyle
-from backend import datasets
+from utils import profiling
+from backend import partitions, export, sessions, progress, catalog, prefetch
+from backend.acs_api import ACSapi
 
 DV_NAME = 'aid_requested'
 START_YEAR = 2010
@@ -14,18 +18,25 @@ END_YEAR = 2019
 IV_LIST = ['black_afam', 'foreign_born','health_insurance_rate',
     'median_home_price', 'median_income', 'median_rent', 'snap_benefits', 
     'unemp_rate',  'vacant_housing_rate']
+# Indicators outside the default ACS download, fetched when first selected.
+EXTRA_IV_LIST = [i for i in ACSapi.variable_codes if i not in ACSapi.default_variables + IV_LIST]
 LABELS = {'black_afam':'Pcnt. Black' , 'foreign_born': 'Pcnt. Foreign Born',
     'health_insurance_rate': 'Health Iunsurance Rate',
     'median_home_price': 'Median Home Price', 'median_income': 'Median Income', 
     'median_rent': 'Median Rent', 'snap_benefits': 'Pcnt. Snap Benefits', 
     'unemp_rate': 'Unemployment Rate',  'vacant_housing_rate': 'Vacant Housing Pcnt.',
     'aid_requested': 'Aid Amount', 'incident_type': 'Disaster Type',
-    'population':'Population', 'state': 'State', 'county_fips':'County FIPS Code'}
+    'population':'Population', 'state': 'State', 'county_fips':'County FIPS Code',
+    'renter_occupied_rate': 'Pcnt. Renter Occupied', 'median_age': 'Median Age',
+    'gini_index': 'Gini Index'}
 TEXAS_IDX = 43
+# Milliseconds between checks on a query still loading.
+PROGRESS_INTERVAL = 500
 
 with open('data/statestofips.json', 'r') as f:
   states_lookup = json.load(f)
   STATES = [i for i in states_lookup.keys()]
+  STATE_NAMES = {fips: name for name, fips in states_lookup.items()}
 
 years_dict = {}
 for i in range(START_YEAR, END_YEAR + 1):
@@ -44,96 +55,287 @@ layout = html.Div(children=[
             ),
             html.Div(className='filter-div',
                     children=[html.Label('Select X Axis Variable'),
-                    dcc.Dropdown(IV_LIST, 'median_income', id='xaxis-dd')]
+                    dcc.Dropdown(IV_LIST + EXTRA_IV_LIST, 'median_income', id='xaxis-dd')]
             )
         ]
     ),
     html.Br(),
     html.Label('Select Year Range'),
+    # Only report the range once the handle is released, so dragging
+    # through several years starts one query rather than one per year.
     dcc.RangeSlider(START_YEAR, END_YEAR, 1, value=[2015, 2017], 
         id='year-slider',
-        marks = years_dict
+        marks = years_dict,
+        updatemode='mouseup'
     ),
-    html.Br(),
-    html.Div(children=[
+    html.P(id='data-age', className='data-age'),
+    html.Div(id='data-progress', className='data-age'),
+    dcc.Interval(id='progress-interval', interval=PROGRESS_INTERVAL, disabled=True),
+    dcc.RadioItems(['County', 'Aggregate'], 'County', inline=True, id='view-mode'),
+    html.Div(id='aggregate-view', style={'display': 'none'}, children=[
+        html.Label('Click a bar to drill down to its counties.'),
         dcc.Graph(
-            id='scatter-fig'
+            id='aggregate-fig'
         )
     ]),
-    html.Br(),
-    html.Label('Select a range along a parallel coordinates axis to highlight points in the scatter plot.'),
-    html.Div(id='pc-container', children=[
-        html.Div(className='buffer'),
-        html.Div(id='pc-plot',children=[
+    html.Div(id='county-view', children=[
+        html.Div(children=[
             dcc.Graph(
-            id='pc-fig'
-        )
+                id='scatter-fig'
+            )
         ]),
-        html.Div(className='buffer')
+        html.A('Download this selection as CSV', id='export-link', href='', target='_blank'),
+        html.Br(),
+        html.Label('Select a range along a parallel coordinates axis to highlight points in the scatter plot.'),
+        html.Div(id='pc-container', children=[
+            html.Div(className='buffer'),
+            html.Div(id='pc-plot',children=[
+                dcc.Graph(
+                id='pc-fig'
+            )
+            ]),
+            html.Div(className='buffer')
+        ])
     ]),
     dcc.Store(id='query-data'),
+    dcc.Store(id='progress-job'),
     dcc.Store(id='intermediate-value')
 ])
 
 
+def describe_freshness(freshness):
+    '''
+    Describe how old the queried data is for display under the year slider.
+
+    Inputs:
+        freshness: freshness metadata attached to the data by the backend,
+            or None if the static backup data was loaded
+
+    Outputs:
+        a short sentence giving the age of the data
+    '''
+    if freshness is None:
+        return 'Live data unavailable - showing static backup data.'
+
+    minutes = int((time.time() - freshness['fetched_at']) // 60)
+    if minutes < 1:
+        age = 'Data fetched just now.'
+    elif minutes < 120:
+        age = f'Data fetched {minutes} min ago.'
+    else:
+        age = f'Data fetched {minutes // 60} hours ago.'
+    if freshness['stale']:
+        age += ' Upstream is slow; newer data is loading in the background.'
+    return age
+
+
+def progress_indicator(status):
+    '''
+    Build the completeness indicator of a query still loading.
+
+    Inputs:
+        status: progress status of the query from the backend, or None
+
+    Outputs:
+        a progress bar and a description, or nothing once the query is done
+    '''
+    text = progress.describe(status)
+    if not text:
+        return []
+    return [html.Progress(value=str(status['partitions_done']),
+                          max=str(status['partitions_total'])),
+            html.Span(' ' + text)]
+
+
+def load_backup_data(state_codes, years):
+    '''
+    Load the static backup data for the selection, used when the APIs fail.
+
+    Inputs:
+        state_codes: a list of state FIPS codes
+        years: a list of years, or the two endpoints of a range
+
+    Outputs:
+        the backup rows for the selected states and years
+    '''
+    print('API CALL FAILED - LOADING STATIC BACKUP DATA')
+    df = pd.read_csv('data/harvey_test_data.csv')
+    return df[df['state_fips'].isin(state_codes) &
+        (df['year'] >= min(years)) &
+        (df['year'] <= max(years))]
+
+
 @callback(
     Output('query-data', 'data'),
+    Output('data-age', 'children'),
+    Output('data-progress', 'children'),
+    Output('progress-job', 'data'),
+    Output('progress-interval', 'disabled'),
     Input('state-dd', 'value'),
-    Input('year-slider', 'value')
+    Input('year-slider', 'value'),
+    Input('xaxis-dd', 'value'),
+    Input('progress-interval', 'n_intervals'),
+    Input('view-mode', 'value'),
+    State('session-id', 'data'),
+    State('progress-job', 'data')
 )
-def query_api(states, years):
+@profiling.profiled
+def query_api(states, years, xaxis=None, n_intervals=None, view_mode='County', session_id=None,
+    job=None):
     '''
     Load data from FEMA and ACS APIs into app using backend modules and user
     inputs for states and years. Data is used for all visuals on cross-section
     view. If API call fails, load data from static csv as backup.
 
+    Cached data is shown at once. Missing years download in the background,
+    and the progress interval polls for them, refreshing the charts as each
+    year arrives.
+
     Inputs:
         states: a list of state names selected from the states dropdown in ui
         years: a list of years selected from the years slider in ui
+        xaxis: the x axis variable; an extra indicator is added to the query,
+            downloading only that column
+        n_intervals: ticks of the progress interval, set while a query loads
+        view_mode: 'County' or 'Aggregate'. County rows are only loaded for
+            the county view; the aggregate view is answered from the rollup
+            cube by update_aggregate.
+        session_id: id of the browser tab. A newer query from the same tab
+            cancels this one. Once the tab
+            is idle, its likely next selections are prefetched.
+        job: the loading query's job id, the version of its results shown,
+            and its states and years
 
     Outputs:
         Joined data from FEMA and ACS data sources meeting input filter criteria,
-        converted to JSON for in-browser storage.
+        converted to JSON for in-browser storage, a description of the
+        age of that data, the completeness indicator, the loading query's
+        job and whether to stop polling.
     '''
+    triggered = [t['prop_id'] for t in callback_context.triggered]
+    if triggered == ['progress-interval.n_intervals']:
+        return poll_query(job)
+    if view_mode == 'Aggregate':
+        raise PreventUpdate
+    if triggered == ['xaxis-dd.value'] and xaxis not in EXTRA_IV_LIST:
+        # Default variables are already in the stored data.
+        raise PreventUpdate
     if not isinstance(states, list):
         states = [states]
     if not isinstance(years, list):
         years = [years]
     state_codes = [states_lookup[i] for i in states]
+    variables = ACSapi.default_variables + [xaxis] if xaxis in EXTRA_IV_LIST else None
+    cancel_token = sessions.begin_query(session_id)
+    prefetch.record_query(session_id, state_codes, years)
+
+    def finish():
+        sessions.end_query(session_id, cancel_token)
+        # Fetch the likely next selections while the user looks at this one.
+        prefetch.schedule(session_id, cancel_token, state_codes, years, START_YEAR, END_YEAR)
+
     try:
-        # Selecting single year creates duplicate entries. Reduce to one entry.
-        if max(years) == min(years):
-            years = [max(years)]
-        query_df = datasets.get_data(state_codes, years)
+        # Every year in the range is served from cached (state, year) slices
+        # where possible; only missing slices are downloaded, in the background.
+        query_df, status = partitions.get_data_progressive(state_codes, years, cancel_token,
+            variables=variables, on_finish=finish)
     except:
-        print('API CALL FAILED - LOADING STATIC BACKUP DATA')
-        df = pd.read_csv('data/harvey_test_data.csv')
-        query_df = df[df['state_fips'].isin(state_codes) & 
-            (df['year'] >= years[0]) &
-            (df['year'] <= years[1])]
-    
-    return query_df.to_json(date_format='iso', orient='split')
+        sessions.end_query(session_id, cancel_token)
+        query_df = load_backup_data(state_codes, years)
+        return (query_df.to_json(date_format='iso', orient='split'),
+            describe_freshness(None), [], None, True)
+
+    if status is None:
+        return (query_df.to_json(date_format='iso', orient='split'),
+            describe_freshness(query_df.attrs.get('freshness')), [], None, True)
+
+    job = {'job_id': status['job_id'], 'version': status['version'],
+        'states': state_codes, 'years': years}
+    if query_df is None:
+        # Nothing cached yet: keep the charts until the first year arrives.
+        return no_update, 'Loading data...', progress_indicator(status), job, False
+    return (query_df.to_json(date_format='iso', orient='split'),
+        describe_freshness(query_df.attrs.get('freshness')),
+        progress_indicator(status), job, False)
+
+
+def poll_query(job):
+    '''
+    Check on a query loading in the background and pass on any new results.
+
+    Inputs:
+        job: the loading query's job id, the version of its results shown,
+            and its states and years
+
+    Outputs:
+        the same outputs as query_api
+    '''
+    if not job:
+        return no_update, no_update, [], None, True
+    status, query_df = progress.poll(job['job_id'], job['version'])
+    if status is None:
+        # The job expired; stop polling.
+        return no_update, no_update, [], None, True
+
+    done = status['finished']
+    if query_df is None:
+        if done and status['error'] and not job['version']:
+            query_df = load_backup_data(job['states'], job['years'])
+            return (query_df.to_json(date_format='iso', orient='split'),
+                describe_freshness(None), [], None, True)
+        return no_update, no_update, progress_indicator(status), job, done
+
+    job = dict(job, version=status['version'])
+    return (query_df.to_json(date_format='iso', orient='split'),
+        describe_freshness(query_df.attrs.get('freshness')),
+        progress_indicator(status), job, done)
 
 
 @callback(
     Output('disaster-dd', 'options'),
     Output('disaster-dd', 'value'),
-    Input('query-data','data')
+    Input('query-data','data'),
+    State('disaster-dd', 'value'),
+    State('state-dd', 'value'),
+    State('year-slider', 'value')
 )
-def get_disaster_options(query_df_json):
+def get_disaster_options(query_df_json, selected=None, states=None, years=None):
     '''
-    Get disaster options from queried data for dropdown.
+    Get disaster options from queried data for dropdown. With the disaster
+    catalog built, every other type declared in the selected states and years
+    is offered after them, including those in years still loading.
 
     Inputs:
         query_df_json: json file from browser memory, originally created by FEMA
+        selected: disaster types currently selected, kept while they are
+            still present, so partial results arriving do not reset them
+        states: a list of state names selected from the states dropdown in ui
+        years: a list of years selected from the years slider in ui
     
     Outputs:
-        disaster_options: disaster types present in queried data, setting first
-            result as default
+        disaster_options: disaster types present in queried data, then the
+            catalog's other types, setting the first present type as default
     '''
     query_df = pd.read_json(query_df_json, orient='split')
-    disaster_options = [i for i in query_df.incident_type.unique()]
-    disaster_options.sort()
+    present = sorted(query_df.incident_type.dropna().unique())
+    disaster_options = list(present)
+    disasters = catalog.get_catalog()
+    if disasters is not None and states and years:
+        if not isinstance(states, list):
+            states = [states]
+        if not isinstance(years, list):
+            years = [years]
+        declared = disasters.incident_types([states_lookup[i] for i in states],
+            partitions.expand_years(years))
+        disaster_options += sorted(set(declared) - set(present))
+    if not isinstance(selected, list):
+        selected = [selected] if selected else []
+    kept = [i for i in selected if i in disaster_options]
+    if kept:
+        return disaster_options, kept if len(kept) > 1 else kept[0]
+    if not disaster_options:
+        return [], None
+    # Default to a type with rows, so the charts are not empty on first load.
     return disaster_options, disaster_options[0]
 
 
@@ -167,6 +369,33 @@ def update_data(query_df_json, disasters):
     return filtered_df.to_json(date_format='iso', orient='split')
 
 
+@callback(
+    Output('export-link', 'href'),
+    Input('state-dd', 'value'),
+    Input('year-slider', 'value'),
+    Input('disaster-dd', 'value')
+)
+def update_export_link(states, years, disasters):
+    '''
+    Point the download link at a streaming export of the current selection.
+
+    Inputs:
+        states: a list of state names selected from the states dropdown in ui
+        years: a list of years selected from the years slider in ui
+        disasters: a list of disaster types selected by user from ui dropdown
+
+    Outputs:
+        a link to the export route with the same filters
+    '''
+    if not isinstance(states, list):
+        states = [states]
+    if not isinstance(years, list):
+        years = [years]
+    if not isinstance(disasters, list):
+        disasters = [disasters] if disasters else []
+    return export.export_url(states, years, disasters)
+
+
 @callback(
     Output('pc-fig', 'figure'),
     Input('intermediate-value', 'data')
@@ -212,6 +441,9 @@ def modify_scatter(restyleData, filtered_df_json, xaxis):
         scatter_fig: a Dash scatterplot component
     '''
     filtered_df = pd.read_json(filtered_df_json, orient='split')
+    if xaxis not in filtered_df:
+        # A newly selected indicator is still being downloaded by query_api.
+        raise PreventUpdate
     # Only handles dim_range of length one and doesn't support multiple axes
     # or multiple selections along a single axis.
     if restyleData and None not in restyleData[0].values():
@@ -228,3 +460,90 @@ def modify_scatter(restyleData, filtered_df_json, xaxis):
         size_max=60, labels = LABELS)
 
     return scatter_fig
+
+
+@callback(
+    Output('county-view', 'style'),
+    Output('aggregate-view', 'style'),
+    Input('view-mode', 'value')
+)
+def toggle_view(view_mode):
+    '''
+    Show either the county-level charts or the aggregate chart.
+
+    Inputs:
+        view_mode: 'County' or 'Aggregate', selected by user from ui
+
+    Outputs:
+        display styles for the county and aggregate views
+    '''
+    if view_mode == 'Aggregate':
+        return {'display': 'none'}, {'display': 'block'}
+    return {'display': 'block'}, {'display': 'none'}
+
+
+@callback(
+    Output('aggregate-fig', 'figure'),
+    Input('view-mode', 'value'),
+    Input('state-dd', 'value'),
+    Input('year-slider', 'value'),
+    Input('disaster-dd', 'value')
+)
+def update_aggregate(view_mode, states, years, disasters=None):
+    '''
+    Chart total aid requested by state, year and disaster type, answered from
+    the precomputed rollup cube rather than county rows. Only partitions
+    never summarized before are downloaded; county rows are not sent to
+    the browser.
+
+    Inputs:
+        view_mode: 'County' or 'Aggregate', selected by user from ui
+        states: a list of state names selected from the states dropdown in ui
+        years: a list of years selected from the years slider in ui
+        disasters: a list of disaster types selected by user from ui
+            dropdown, all types if none are selected
+
+    Outputs:
+        agg_fig: a stacked bar chart of aid by year and disaster type
+    '''
+    if view_mode != 'Aggregate':
+        raise PreventUpdate
+    if not isinstance(states, list):
+        states = [states]
+    if not isinstance(years, list):
+        years = [years]
+    if not isinstance(disasters, list):
+        disasters = [disasters] if disasters else []
+
+    agg_df = partitions.get_aggregate([states_lookup[i] for i in states], years,
+        incident_types=disasters or None)
+    agg_df['state'] = agg_df['state_fips'].map(STATE_NAMES)
+
+    agg_fig = px.bar(agg_df, x='year', y='aid_requested', color='incident_type',
+        custom_data=['state', 'year', 'incident_type'],
+        hover_data=['state', 'disasters', 'counties', 'aid_per_capita', 'aid_median', 'aid_p90'],
+        labels=LABELS)
+    agg_fig.update_layout(barmode='stack')
+    return agg_fig
+
+
+@callback(
+    Output('view-mode', 'value'),
+    Output('state-dd', 'value'),
+    Output('year-slider', 'value'),
+    Input('aggregate-fig', 'clickData')
+)
+def drill_down(click_data):
+    '''
+    Switch to the county view for the state and year of a clicked bar.
+
+    Inputs:
+        click_data: the bar clicked in the aggregate chart
+
+    Outputs:
+        the county view mode, and the clicked state and year as filters
+    '''
+    if not click_data:
+        raise PreventUpdate
+    state, year, _ = click_data['points'][0]['customdata']
+    return 'County', [state], [year, year]
@@ -8,10 +8,16 @@ Module to display hurricane view with choropleth and regression info
 import pandas as pd
 import plotly.express as px
 from dash import html, dcc, Input, Output, callback, dash_table
-from utils import utils
+from utils import utils, spatial, profiling, exposure
 from models.hurricane_regs import DisasterRegs
+from models import spec_search
+from backend.acs_api import ACSapi
+from backend import catalog
 
 counties, winner, hurricane_path, hurricane_scope, hurricanes = utils.detail_view_init()
+county_index = spatial.CountyIndex(counties)
+EXTRA_INDICATORS = ([i for i in ACSapi.variable_codes if i not in ACSapi.default_variables]
+  + exposure.FEATURES)
 
 layout = html.Div(children=[
   html.P("Note, it might take some time to display data"),
@@ -21,7 +27,16 @@ layout = html.Div(children=[
     ]),
   html.Div(children=[
         html.Label('Regression Type'),
-        dcc.Dropdown(['Pooled', 'Fixed Effects'], 'Pooled', multi = False, id='regression_choice')
+        dcc.Dropdown(['Pooled', 'Fixed Effects', 'Specification Search'], 'Pooled', multi = False, id='regression_choice')
+    ]),
+  html.Div(children=[
+        html.Label('Ranking Criterion (Specification Search)'),
+        dcc.Dropdown([{'label': label, 'value': value} for value, label in spec_search.CRITERIA.items()],
+          'bic', multi = False, clearable = False, id='criterion')
+    ]),
+  html.Div(children=[
+        html.Label('Additional Indicators'),
+        dcc.Dropdown(EXTRA_INDICATORS, [], multi = True, id='indicators')
     ]),
   html.Br(),
   html.Div([
@@ -45,6 +60,56 @@ layout = html.Div(children=[
   ])
 ])
 
+def hurricane_track_scope(hurricane):
+    """
+    Gets a hurricane's track and the states and year it affected.
+    The track is empty for storms only in hurricane_scope.json.
+    :param hurricane: hurricane name
+    """
+    hurricane_df = hurricane_path.loc[(hurricane_path['NAME'] == hurricane)]
+    # FEMA's declarations take precedence, then hand-curated scopes; any other
+    # storm is scoped from its track. A storm late in a season can be declared
+    # in the next fiscal year. Without a track there are no seasons to narrow
+    # the catalog search by, so the hand-curated scope is used.
+    disasters = catalog.get_catalog()
+    seasons = sorted(set(hurricane_df['SEASON'].astype(int)))
+    scope = (disasters and seasons and disasters.hurricane_scope(hurricane, seasons + [seasons[-1] + 1])
+      or hurricane_scope.get(hurricane)
+      or (spatial.storm_scope(county_index, hurricane_df) if seasons else None))
+    if scope is None:
+        raise ValueError(f"No scope or track for hurricane {hurricane}")
+    return hurricane_df, scope
+
+def hurricane_map(hurricane_df, api_data, year, geojson):
+    """
+    Builds the choropleth of county election winners with the hurricane track on top.
+    :param hurricane_df: hurricane track points
+    :param api_data: FEMA and ACS data for the hurricane's scope
+    :param year: year the hurricane occurred
+    :param geojson: county geometry, or a URL to it
+    """
+    election = winner.loc[winner['year'] == utils.get_election_year(year)]
+    merged_df= pd.merge(election, api_data, how="left", on = 'county_fips')
+    fig = px.choropleth_mapbox(merged_df, geojson=geojson,
+      locations='county_fips',
+      hover_name = 'county_name',
+      color = 'party',
+      mapbox_style="open-street-map",
+      zoom=3,
+      center = {"lat": 37.0902, "lon": -95.7129},
+      color_discrete_sequence=px.colors.qualitative.Set1,
+      opacity=0.3,
+    )
+    fig.add_scattermapbox(
+      lat = hurricane_df['LAT'],
+      lon = hurricane_df['LON'],
+      mode = 'markers+text',
+      marker_size= hurricane_df['STORM_SPEED'],
+      marker_color='rgb(255, 222, 113)',
+      showlegend = False
+    )
+    return fig
+
 @callback(
     Output("hurricane_map", 'figure'),
     Output("hurricane_map", 'style'),
@@ -54,16 +119,23 @@ layout = html.Div(children=[
     Output("var_table", 'column'),
     Output("regression-text", 'children'),
     Input('hurricane', 'value'),
-    Input('regression_choice', 'value')
+    Input('regression_choice', 'value'),
+    Input('indicators', 'value'),
+    Input('criterion', 'value')
 )
-def display_hurricane(hurricane, regression_choice):
+@profiling.profiled
+def display_hurricane(hurricane, regression_choice, indicators=None, criterion='bic'):
     """
     Calls API on Hurricane info, runs regression and updates figures.
     :param hurricane: User selected hurricane
     :param regression_choice: User selected regression choice
+    :param indicators: User selected extra ACS indicators and storm exposure
+      features to add as regressors
+    :param criterion: User selected ranking criterion of the specification search
     """
-    hurricane_df = hurricane_path.loc[(hurricane_path['NAME'] == hurricane)]
-    regression = DisasterRegs(hurricane_scope[hurricane]["states_fips"], hurricane_scope[hurricane]["year"])
+    hurricane_df, scope = hurricane_track_scope(hurricane)
+    regression = DisasterRegs(scope["states_fips"], scope["year"], indicators=indicators,
+      track=hurricane_df)
     api_data = regression.pull_data()
     if regression_choice == 'Pooled':
         reg_output,_,var_table = regression.pooled_ols(api_data)
@@ -73,6 +145,14 @@ def display_hurricane(hurricane, regression_choice):
         The p-value column can be interpreted as follows: if the p-value < 0.05, it is statistically significant at the 95% Confidence level. \
         In layman’s terms, that variable is significant in determining\
         the dollar value of FEMA aid requested by the county."
+    elif regression_choice == 'Specification Search':
+        reg_output,var_table = regression.specification_search(api_data, criterion=criterion,
+            max_size=spec_search.SEARCH_MAX_SIZE)
+        text = f"In the table above we see the best pooled OLS specifications for each outcome, \
+        ranked by {spec_search.CRITERIA[criterion]} (lower is better). Every combination of up to \
+        {spec_search.SEARCH_MAX_SIZE} of the variables below is fitted, leaving out combinations where any variable has a VIF above 5. \
+        AIC and BIC reward fit and penalize extra variables, BIC more strongly. \
+        CV RMSE is the prediction error on counties left out of the fit, averaged over 5 folds."
     else:
         reg_output,_,var_table = regression.panel_ols(api_data)
         text = "In the table above we see the results to the Fixed Effect Panel regression, \
@@ -82,25 +162,7 @@ def display_hurricane(hurricane, regression_choice):
         We add this option to analyze whether different states display different characteristics in FEMA. \
         The p-value column can be interpreted as follows: if the p-value < 0.05, it is statistically significant at the 95% Confidence level. \
         In layman’s terms, that variable is significant in determining the dollar value of FEMA aid requested by the county."
-    year_occur = hurricane_scope[hurricane]["year"][0]
-    election = winner.loc[winner['year'] == utils.get_election_year(year_occur)]
-    merged_df= pd.merge(election, api_data, how="left", on = 'county_fips')
-    fig = px.choropleth_mapbox(merged_df, geojson=counties,
-      locations='county_fips',
-      hover_name = 'county_name',
-      color = 'party',
-      mapbox_style="open-street-map",
-      zoom=3,
-      center = {"lat": 37.0902, "lon": -95.7129},
-      color_discrete_sequence=px.colors.qualitative.Set1,
-      opacity=0.3,
-    )
-    fig.add_scattermapbox(
-      lat = hurricane_df['LAT'],
-      lon = hurricane_df['LON'],
-      mode = 'markers+text',
-      marker_size= hurricane_df['STORM_SPEED'],
-      marker_color='rgb(255, 222, 113)',
-      showlegend = False
-    )
+    # Reference the geometry by URL so the browser fetches and caches it once,
+    # and each response only carries the per-county values and the track.
+    fig = hurricane_map(hurricane_df, api_data, scope["year"][0], utils.counties_url())
     return fig, {"display": "flex"}, reg_output.to_dict('records'), reg_output.columns, var_table.to_dict('records'), var_table.columns, text
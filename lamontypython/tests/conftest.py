@@ -0,0 +1,13 @@
+"""
+(la)Monty Python
+
+Test setup: modules are imported the way the app imports them, from the
+lamontypython directory, which is also the working directory for the
+data files they read.
+"""
+import os
+import sys
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, APP_DIR)
+os.chdir(APP_DIR)
@@ -0,0 +1,28 @@
+"""
+(la)Monty Python
+
+Tests of the two-tier SharedCache in backend/cache.py.
+"""
+from backend.cache import SharedCache
+
+
+def test_remember_false_reads_and_writes_past_memory(tmp_path):
+    cache = SharedCache("test", directory=str(tmp_path), max_entries=4)
+    cache.set("kept", 1)
+    cache.set("scanned", 2, remember=False)
+    assert len(cache.memory) == 1
+
+    assert cache.get("scanned", remember=False) == 2
+    assert len(cache.memory) == 1
+    assert cache.get("scanned") == 2
+    assert len(cache.memory) == 2
+
+
+def test_scan_does_not_evict_memory_tier(tmp_path):
+    cache = SharedCache("test", directory=str(tmp_path), max_entries=2)
+    cache.set("hot", "value")
+    for i in range(10):
+        cache.set(("partition", i), i, remember=False)
+        assert cache.get(("partition", i), remember=False) == i
+
+    assert list(cache.memory) == [cache.digest("hot")]
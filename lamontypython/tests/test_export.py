@@ -0,0 +1,48 @@
+"""
+(la)Monty Python
+
+Tests of the Arrow encoding of the bulk export in backend/export.py.
+"""
+import numpy as np
+import pandas as pd
+import pytest
+
+pa = pytest.importorskip('pyarrow')
+pytest.importorskip('censusdata')
+from backend import export
+
+
+def read_stream(batches):
+    return pa.ipc.open_stream(b"".join(export.stream_arrow(iter(batches)))).read_all()
+
+
+def test_arrow_keeps_columns_of_unlisted_types():
+    first = pd.DataFrame({'id': ['5f1c-aa', '7e2d-bb'], 'state_fips': ['48', '48'],
+                          'year': [2017, 2017], 'aid_requested': [1.5, np.nan],
+                          'county_count': [3, 4]})
+    second = pd.DataFrame({'id': ['9a0b-cc'], 'state_fips': [np.nan], 'year': [2018],
+                           'aid_requested': [2.0], 'county_count': [5]})
+
+    table = read_stream([first, second])
+
+    assert table.schema.field('id').type == pa.string()
+    assert table.schema.field('county_count').type == pa.int64()
+    assert table.column('id').to_pylist() == ['5f1c-aa', '7e2d-bb', '9a0b-cc']
+    assert table.column('state_fips').to_pylist() == ['48', '48', None]
+    assert table.column('aid_requested').to_pylist()[:2] == [1.5, None]
+
+
+def test_arrow_types_of_an_empty_first_batch():
+    empty = pd.DataFrame({'state_fips': pd.Series([], dtype=float),
+                          'disaster_name': pd.Series([], dtype=object),
+                          'year': pd.Series([], dtype=float),
+                          'aid_requested': pd.Series([], dtype=float)})
+    rows = pd.DataFrame({'state_fips': ['22'], 'disaster_name': ['IDA'], 'year': [2021],
+                         'aid_requested': [10.0]})
+
+    table = read_stream([empty, rows])
+
+    assert table.schema.field('state_fips').type == pa.string()
+    assert table.schema.field('year').type == pa.int64()
+    assert table.to_pylist() == [{'state_fips': '22', 'disaster_name': 'IDA', 'year': 2021,
+                                  'aid_requested': 10.0}]
@@ -0,0 +1,33 @@
+"""
+(la)Monty Python
+
+Tests of the mission assignment cleaning in backend/fema_api.py.
+"""
+import pandas as pd
+import pytest
+from backend.fema_api import FEMAapi
+
+
+@pytest.fixture
+def api():
+    api = FEMAapi.__new__(FEMAapi)
+    api.zip_df = api.get_zip_fips_df()
+    return api
+
+
+def test_multi_county_zip_is_split_not_double_counted(api):
+    counties = api.zip_df.groupby('ZIP').size()
+    split_zip = counties[counties == 2].index[0]
+    single_zip = counties[counties == 1].index[0]
+    ms = pd.DataFrame({'disasterNumber': [4332, 4332, 4332, 4337],
+                       'zip': [split_zip, split_zip, single_zip, split_zip],
+                       'requestedAmount': [100.0, 50.0, 10.0, 30.0],
+                       'obligationAmount': [80.0, 40.0, 5.0, 20.0]})
+
+    cleaned = api.clean_ms_data(ms)
+
+    assert cleaned['requestedAmount'].sum() == pytest.approx(190.0)
+    assert cleaned['obligationAmount'].sum() == pytest.approx(145.0)
+    per_disaster = cleaned.groupby('disasterNumber')['requestedAmount'].sum()
+    assert per_disaster.to_dict() == pytest.approx({4332: 160.0, 4337: 30.0})
+    assert not cleaned.duplicated(['state_fips', 'county_fips', 'disasterNumber']).any()
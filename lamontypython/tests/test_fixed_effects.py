@@ -0,0 +1,85 @@
+"""
+(la)Monty Python
+
+Checks the absorbing fixed effects solver against OLS with dummy variables.
+"""
+import numpy as np
+import pandas as pd
+import pytest
+import statsmodels.formula.api as smf
+from models.fixed_effects import absorbing_ols
+
+
+def make_panel(n_counties=40, years=(2015, 2016, 2017, 2018), seed=0):
+    rng = np.random.default_rng(seed)
+    panel = pd.DataFrame([(f"c{c}", year) for c in range(n_counties) for year in years],
+                         columns=["county", "year"])
+    county_effect = rng.normal(0, 5, n_counties)[panel["county"].str[1:].astype(int)]
+    year_effect = panel["year"].map(dict(zip(years, rng.normal(0, 3, len(years)))))
+    panel["x1"] = rng.normal(size=len(panel)) + county_effect / 5
+    panel["x2"] = rng.normal(size=len(panel))
+    panel["y"] = (2 * panel["x1"] - panel["x2"] + county_effect + year_effect
+                  + rng.normal(size=len(panel)))
+    return panel
+
+
+@pytest.mark.parametrize("effects, formula", [
+    (["county"], "y ~ x1 + x2 + C(county)"),
+    (["county", "year"], "y ~ x1 + x2 + C(county) + C(year)"),
+])
+def test_matches_dummy_variable_ols(effects, formula):
+    panel = make_panel()
+    result = absorbing_ols(panel["y"], panel[["x1", "x2"]], panel[effects], panel["county"])
+    dummies = smf.ols(formula, data=panel).fit()
+
+    np.testing.assert_allclose(result.params, dummies.params[["x1", "x2"]], rtol=1e-8)
+    assert result.nobs == len(panel)
+
+
+def test_county_disaster_matches_dummy_variable_ols():
+    # Each disaster covers a subset of counties, and counties recur across
+    # disasters, so the two effects are estimable side by side.
+    rng = np.random.default_rng(1)
+    panel = pd.DataFrame([(f"c{c}", d) for d in range(6) for c in range(40)
+                          if rng.random() < 0.6], columns=["county", "disaster_number"])
+    county_effect = panel["county"].map(dict((f"c{c}", e) for c, e in enumerate(rng.normal(0, 5, 40))))
+    disaster_effect = panel["disaster_number"].map(dict(enumerate(rng.normal(0, 3, 6))))
+    panel["x1"] = rng.normal(size=len(panel)) + county_effect / 5
+    panel["x2"] = rng.normal(size=len(panel)) + disaster_effect / 3
+    panel["y"] = (2 * panel["x1"] - panel["x2"] + county_effect + disaster_effect
+                  + rng.normal(size=len(panel)))
+    panel = panel[panel.groupby("county")["county"].transform("size") > 1]
+
+    result = absorbing_ols(panel["y"], panel[["x1", "x2"]], panel[["county", "disaster_number"]],
+                           panel["county"])
+    dummies = smf.ols("y ~ x1 + x2 + C(county) + C(disaster_number)", data=panel).fit()
+
+    np.testing.assert_allclose(result.params, dummies.params[["x1", "x2"]], rtol=1e-8)
+    assert result.nobs == len(panel)
+
+
+def test_singletons_are_dropped():
+    panel = make_panel()
+    extra = pd.DataFrame({"county": ["lonely"], "year": [2015], "x1": [100.0],
+                          "x2": [-100.0], "y": [1000.0]})
+    with_singleton = pd.concat([panel, extra], ignore_index=True)
+
+    result = absorbing_ols(with_singleton["y"], with_singleton[["x1", "x2"]],
+                           with_singleton[["county"]], with_singleton["county"])
+    expected = absorbing_ols(panel["y"], panel[["x1", "x2"]], panel[["county"]], panel["county"])
+
+    np.testing.assert_allclose(result.params, expected.params)
+    assert result.nobs == len(panel)
+
+
+def test_single_year_scope_raises():
+    panel = make_panel(years=(2017,))
+    with pytest.raises(ValueError, match="county fixed effects"):
+        absorbing_ols(panel["y"], panel[["x1", "x2"]], panel[["county"]], panel["county"])
+
+
+def test_regressor_absorbed_by_effects_raises():
+    panel = make_panel()
+    panel["x2"] = panel["county"].str[1:].astype(float)
+    with pytest.raises(ValueError, match="x2 have no variation"):
+        absorbing_ols(panel["y"], panel[["x1", "x2"]], panel[["county"]], panel["county"])
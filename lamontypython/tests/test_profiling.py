@@ -0,0 +1,41 @@
+"""
+(la)Monty Python
+
+Checks that profile captures follow work into worker threads.
+"""
+import glob
+import pickle
+from concurrent.futures import ThreadPoolExecutor
+from flask import Flask
+from backend import workers
+from utils import profiling
+
+pool = ThreadPoolExecutor(max_workers=2)
+
+
+def worker_only_function():
+    return sum(i * i for i in range(10000))
+
+
+def test_capture_includes_worker_threads(tmp_path, monkeypatch):
+    monkeypatch.setattr(profiling, "ENABLED", True)
+    monkeypatch.setattr(profiling, "PROFILE_DIR", str(tmp_path))
+    monkeypatch.setattr(workers, "task_hooks", [])
+    profiling.register_profiling(Flask(__name__))
+    futures = []
+
+    @profiling.profiled
+    def callback():
+        # Returns before the worker has run, as a progressive query does.
+        futures.append(workers.submit(pool, worker_only_function))
+
+    with Flask(__name__).test_request_context(headers={"X-Profile": "1"}):
+        callback()
+    futures[0].result()
+
+    captures = glob.glob(str(tmp_path / "*callback.pkl"))
+    assert len(captures) == 1
+    with open(captures[0], "rb") as f:
+        capture = pickle.load(f)
+    assert "worker_only_function" in capture["cpu"]
+    assert capture["threads"] == 2
@@ -0,0 +1,63 @@
+"""
+(la)Monty Python
+
+Checks the specification search against statsmodels fits of single
+candidates, and the process pool against scoring in-process.
+"""
+import numpy as np
+import pandas as pd
+import pytest
+import statsmodels.api as sm
+from models import spec_search
+
+REGRESSORS = [f"x{i}" for i in range(9)]
+
+
+def make_data(n=300, seed=0):
+    rng = np.random.default_rng(seed)
+    data = pd.DataFrame(rng.normal(size=(n, len(REGRESSORS))), columns=REGRESSORS)
+    data["x1"] += 0.5 * data["x0"]
+    data["y"] = 3 * data["x0"] - 2 * data["x1"] + data["x4"] + rng.normal(0, 2, n)
+    data["z"] = data["x2"] + 0.1 * data["x3"] ** 2 + rng.normal(size=n)
+    return data
+
+
+def kfold_rmse(data, columns, outcome, folds=5, seed=0):
+    '''
+    Out-of-fold RMSE of OLS refitted without each fold, with the folds of
+    spec_search.gram_matrices.
+    '''
+    fold_of_row = np.random.default_rng(seed).permutation(len(data)) % folds
+    X = sm.add_constant(data[columns])
+    sse = 0
+    for f in range(folds):
+        train, test = fold_of_row != f, fold_of_row == f
+        fit = sm.OLS(data.loc[train, outcome], X[train]).fit()
+        sse += ((data.loc[test, outcome] - fit.predict(X[test])) ** 2).sum()
+    return np.sqrt(sse / len(data))
+
+
+@pytest.mark.parametrize("outcome", ["y", "z"])
+def test_candidate_matches_statsmodels(outcome):
+    data = make_data()
+    table = spec_search.search(data, REGRESSORS, ["y", "z"], max_size=3, max_vif=None,
+                               top=1000, workers=1)
+    columns = ["x0", "x1", "x4"]
+    row = table[(table["Outcome"] == outcome)
+                & (table["Regressors"] == ", ".join(columns))].iloc[0]
+    fit = sm.OLS(data[outcome], sm.add_constant(data[columns])).fit()
+
+    assert row["AIC"] == pytest.approx(fit.aic, abs=1e-3)
+    assert row["BIC"] == pytest.approx(fit.bic, abs=1e-3)
+    assert row["Adj. R-Squared"] == pytest.approx(fit.rsquared_adj, abs=1e-3)
+    assert row["CV RMSE"] == pytest.approx(kfold_rmse(data, columns, outcome), abs=1e-3)
+
+
+def test_pool_matches_in_process():
+    data = make_data()
+    assert len(spec_search.candidate_subsets(len(REGRESSORS))) > spec_search.CHUNK_SIZE
+
+    in_process = spec_search.search(data, REGRESSORS, ["y", "z"], workers=1)
+    pooled = spec_search.search(data, REGRESSORS, ["y", "z"], workers=2)
+
+    pd.testing.assert_frame_equal(pooled, in_process)
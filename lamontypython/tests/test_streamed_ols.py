@@ -0,0 +1,117 @@
+"""
+(la)Monty Python
+
+Tests of models/streamed_ols.py against statsmodels fits of the same
+data held in memory.
+"""
+import numpy as np
+import pandas as pd
+import pytest
+import statsmodels.api as sm
+from statsmodels.stats.outliers_influence import variance_inflation_factor
+from models import streamed_ols
+
+REGRESSORS = ['foreign_born', 'black_afam', 'median_income', 'snap_benefits', 'unemp_rate',
+              'health_insurance_rate', 'vacant_housing_rate', 'rental_vacancy_rate',
+              'median_rent', 'median_home_price', 'population']
+
+
+def county_panel(n=600, seed=0):
+    '''
+    Synthetic county rows with shares as fractions next to dollar amounts
+    and populations in the millions, so the cross products span more than
+    fifteen orders of magnitude. Rent and home prices move with income.
+    '''
+    rng = np.random.default_rng(seed)
+    income = rng.normal(55000, 12000, n)
+    data = pd.DataFrame({
+        'state_fips': rng.choice(['12', '22', '48'], n),
+        'year': rng.choice([2016, 2017], n),
+        'foreign_born': rng.uniform(0.01, 0.3, n),
+        'black_afam': rng.uniform(0, 0.4, n),
+        'median_income': income,
+        'snap_benefits': 0.3 - income / 4e5 + rng.normal(0, 0.02, n),
+        'unemp_rate': rng.uniform(0.02, 0.1, n),
+        'health_insurance_rate': rng.uniform(0.75, 0.95, n),
+        'vacant_housing_rate': rng.uniform(0.05, 0.25, n),
+        'rental_vacancy_rate': rng.uniform(0.02, 0.12, n),
+        'median_rent': income / 50 + rng.normal(0, 60, n),
+        'median_home_price': income * 3.5 + rng.normal(0, 15000, n),
+        'population': rng.lognormal(12, 1.5, n)})
+    data['aid_requested'] = (2e5 * data['foreign_born'] + 0.05 * data['population']
+                             - 40 * data['median_rent'] + rng.normal(0, 1e5, n))
+    return data
+
+
+def vif_detection(data, regressors):
+    '''
+    The screen of DisasterRegs.vif_detection, with statsmodels VIFs.
+    '''
+    regressors = list(regressors)
+    while True:
+        X = sm.add_constant(data[regressors]).to_numpy()
+        vif = [variance_inflation_factor(X, i) for i in range(1, X.shape[1])]
+        if max(vif) <= 5:
+            return regressors
+        del regressors[vif.index(max(vif))]
+
+
+def partition_moments(data):
+    partitions = {key: part for key, part in data.groupby(['state_fips', 'year'])}
+    return streamed_ols.reduce_partitions(
+        list(partitions), lambda key: streamed_ols.Moments.from_frame(
+            partitions[key], REGRESSORS, 'aid_requested'), REGRESSORS, workers=2)
+
+
+def test_vif_select_matches_statsmodels_on_unscaled_data():
+    data = county_panel()
+    moments = partition_moments(data)
+
+    expected = vif_detection(data, REGRESSORS)
+    assert len(expected) < len(REGRESSORS)
+    assert streamed_ols.vif_select(moments) == expected
+
+
+def test_vif_select_drops_exact_duplicates():
+    data = county_panel()
+    data['population_copy'] = data['population']
+    moments = streamed_ols.Moments.from_frame(data, REGRESSORS + ['population_copy'],
+                                              'aid_requested')
+
+    kept = streamed_ols.vif_select(moments)
+    assert not {'population', 'population_copy'} <= set(kept)
+
+
+@pytest.mark.parametrize('cov_type', streamed_ols.COV_TYPES)
+def test_streamed_fit_matches_in_memory_ols(cov_type):
+    data = county_panel()
+    moments = partition_moments(data)
+    columns = streamed_ols.vif_select(moments)
+
+    streamed = streamed_ols.solve(moments, columns, cov_type)
+    pooled = sm.OLS(data['aid_requested'], sm.add_constant(data[columns])).fit(
+        cov_type=cov_type, use_t=True)
+
+    assert streamed.nobs == pooled.nobs
+    assert streamed.rsquared == pytest.approx(pooled.rsquared, rel=1e-8)
+    np.testing.assert_allclose(streamed.params, pooled.params, rtol=1e-6)
+    np.testing.assert_allclose(streamed.bse, pooled.bse, rtol=1e-6)
+    np.testing.assert_allclose(streamed.pvalues, pooled.pvalues, rtol=1e-5, atol=1e-12)
+
+
+def test_disaster_regs_streamed_matches_pooled(monkeypatch):
+    pytest.importorskip('censusdata')
+    from backend import partitions
+    from models.hurricane_regs import DisasterRegs
+
+    data = county_panel()
+    monkeypatch.setattr(partitions, 'get_data', lambda states, years, variables=None, remember=True: data[
+        data['state_fips'].isin(states) & data['year'].isin(years)].reset_index(drop=True))
+    regression = DisasterRegs(['12', '22', '48'], [2016, 2017])
+    regression.dataframe = data
+
+    pooled, _, pooled_vars = regression.pooled_ols(data)
+    streamed, streamed_vars = regression.streamed_ols(workers=2)
+
+    pd.testing.assert_frame_equal(streamed, pooled, check_exact=False, atol=2e-3)
+    assert list(streamed_vars.iloc[:, 0]) == list(pooled_vars.iloc[:, 0])
@@ -0,0 +1,175 @@
+"""
+(la)Monty Python
+
+County exposure to a storm, from its track.
+
+For every county centroid, computes the minimum distance to the
+track, the strongest wind recorded while the storm was within a radius
+of it, and the hours it spent within that radius. The track is first
+interpolated to an even time step so each point stands for the same
+length of time. Haversine distances are computed as county-by-point
+matrices with NumPy, a block of counties at a time so memory stays
+bounded for long tracks. Results are cached per storm.
+"""
+import os
+import json
+import functools
+import numpy as np
+import pandas as pd
+from backend.cache import SharedCache
+from utils.utils import COUNTIES_GEOJSON
+
+EARTH_RADIUS_KM = 6371.0
+EXPOSURE_RADIUS_KM = float(os.environ.get("LAMONTY_EXPOSURE_RADIUS_KM", 150))
+TIME_STEP_HOURS = 1.0
+# Largest county-by-point distance matrix held at once.
+MAX_MATRIX_CELLS = int(os.environ.get("LAMONTY_EXPOSURE_MAX_CELLS", 2_000_000))
+
+FEATURES = ["track_distance_km", "max_wind_nearby", "hours_within_radius"]
+
+exposure_cache = SharedCache("exposure", max_entries=16)
+
+
+def ring_centroid(ring):
+    """
+    Area and centroid of a polygon ring, by the shoelace formula.
+
+    :param ring: (n, 2) array of lon/lat vertices, closed
+
+    :return: (float) absolute area and (array) lon/lat centroid
+    """
+    x, y = ring[:, 0], ring[:, 1]
+    cross = x[:-1] * y[1:] - x[1:] * y[:-1]
+    area = cross.sum() / 2
+    if area == 0:
+        return 0.0, ring.mean(axis=0)
+    cx = ((x[:-1] + x[1:]) * cross).sum() / (6 * area)
+    cy = ((y[:-1] + y[1:]) * cross).sum() / (6 * area)
+    return abs(area), np.array([cx, cy])
+
+
+def county_centroids(counties):
+    """
+    Area-weighted centroids of the counties' polygons (holes ignored).
+
+    :param counties: GeoJSON FeatureCollection of counties with
+            5-digit FIPS codes as feature ids
+
+    :return: Pandas dataframe with state_fips, county_fips, lon and lat
+    """
+    rows = []
+    for feature in counties["features"]:
+        geometry = feature["geometry"]
+        polygons = [geometry["coordinates"]] if geometry["type"] == "Polygon" else geometry["coordinates"]
+        parts = [ring_centroid(np.asarray(polygon[0], dtype=float)[:, :2]) for polygon in polygons]
+        areas = np.array([area for area, _ in parts])
+        points = np.array([point for _, point in parts])
+        weights = areas if areas.sum() > 0 else np.ones(len(parts))
+        lon, lat = weights @ points / weights.sum()
+        fips = str(feature["id"]).zfill(5)
+        rows.append((fips[:2], fips[2:], lon, lat))
+
+    return pd.DataFrame(rows, columns=["state_fips", "county_fips", "lon", "lat"])
+
+
+@functools.lru_cache(maxsize=1)
+def load_centroids():
+    """
+    Centroids of the counties in the app's county geometry, read once.
+
+    :return: Pandas dataframe, see county_centroids
+    """
+    with open(COUNTIES_GEOJSON, "r") as f:
+        return county_centroids(json.load(f))
+
+
+def haversine_km(lat1, lon1, lat2, lon2):
+    """
+    Great-circle distance in km, broadcasting over the inputs.
+
+    :param lat1, lon1: (arrays) first points, in degrees
+    :param lat2, lon2: (arrays) second points, in degrees
+
+    :return: (array) distances
+    """
+    lat1, lon1, lat2, lon2 = map(np.radians, (lat1, lon1, lat2, lon2))
+    a = (np.sin((lat2 - lat1) / 2) ** 2
+         + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2)
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.clip(a, 0, 1)))
+
+
+def resample_track(track, step_hours=TIME_STEP_HOURS):
+    """
+    Interpolates a track to an even time step, so each point stands for
+    `step_hours` of the storm.
+
+    :param track: Pandas dataframe of one storm's IBTrACS rows with
+            ISO_TIME, LAT, LON and USA_WIND columns
+    :param step_hours: (float) time between interpolated points
+
+    :return: (arrays) latitudes, longitudes and winds (knots)
+    """
+    track = track.sort_values("ISO_TIME")
+    hours = (pd.to_datetime(track["ISO_TIME"]) - pd.to_datetime(track["ISO_TIME"]).iloc[0]) \
+        .dt.total_seconds().to_numpy() / 3600
+    lat = pd.to_numeric(track["LAT"], errors="coerce").to_numpy()
+    lon = pd.to_numeric(track["LON"], errors="coerce").to_numpy()
+    wind = pd.to_numeric(track["USA_WIND"], errors="coerce").to_numpy()
+
+    grid = np.arange(0, hours[-1] + step_hours / 2, step_hours)
+    known = ~np.isnan(wind)
+    wind = np.interp(grid, hours[known], wind[known]) if known.any() else np.zeros(len(grid))
+    return np.interp(grid, hours, lat), np.interp(grid, hours, lon), wind
+
+
+def exposure_features(centroids, track, radius_km=EXPOSURE_RADIUS_KM,
+                      step_hours=TIME_STEP_HOURS, max_cells=MAX_MATRIX_CELLS):
+    """
+    Computes the exposure features of every county to one storm.
+
+    :param centroids: Pandas dataframe with state_fips, county_fips, lon and lat
+    :param track: Pandas dataframe of one storm's IBTrACS rows
+    :param radius_km: (float) distance within which a county counts as exposed
+    :param step_hours: (float) time step the track is interpolated to
+    :param max_cells: (int) largest distance matrix computed at once
+
+    :return: Pandas dataframe with state_fips, county_fips and FEATURES
+    """
+    track_lat, track_lon, track_wind = resample_track(track, step_hours)
+    county_lat = centroids["lat"].to_numpy()
+    county_lon = centroids["lon"].to_numpy()
+
+    n = len(centroids)
+    min_distance = np.empty(n)
+    max_wind = np.empty(n)
+    hours_within = np.empty(n)
+    block = max(1, max_cells // max(len(track_lat), 1))
+    for start in range(0, n, block):
+        rows = slice(start, start + block)
+        distance = haversine_km(county_lat[rows, None], county_lon[rows, None],
+                                track_lat[None, :], track_lon[None, :])
+        within = distance <= radius_km
+        min_distance[rows] = distance.min(axis=1)
+        max_wind[rows] = np.where(within, track_wind[None, :], 0).max(axis=1)
+        hours_within[rows] = within.sum(axis=1) * step_hours
+
+    return pd.DataFrame({"state_fips": centroids["state_fips"].to_numpy(),
+                         "county_fips": centroids["county_fips"].to_numpy(),
+                         "track_distance_km": min_distance,
+                         "max_wind_nearby": max_wind,
+                         "hours_within_radius": hours_within})
+
+
+def storm_exposure(track, radius_km=EXPOSURE_RADIUS_KM):
+    """
+    Gets the exposure features of every county to a storm, computing
+    them once per storm and radius.
+
+    :param track: Pandas dataframe of one storm's IBTrACS rows
+    :param radius_km: (float) distance within which a county counts as exposed
+
+    :return: Pandas dataframe, see exposure_features
+    """
+    key = (tuple(sorted(track["SID"].unique())), len(track), radius_km, TIME_STEP_HOURS)
+    return exposure_cache.get_or_set(key, lambda: exposure_features(load_centroids(), track,
+                                                                    radius_km))
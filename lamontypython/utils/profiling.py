@@ -0,0 +1,280 @@
+"""
+(la)Monty Python
+
+Opt-in request profiling for Dash callbacks.
+
+With LAMONTY_PROFILING=1 set on the server, a callback decorated with
+@profiled captures a CPU profile and a memory allocation snapshot
+whenever the request asks for it, by sending an "X-Profile: 1" header
+or by loading the page with "?profile=1" in its URL. Captures are
+saved with the callback's inputs and can be browsed at /debug/profiles.
+
+The CPU profile follows the work into worker threads: register_profiling
+adds propagate() as a task hook of backend/workers.py, through which the
+backend submits all of its pool work, so functions started from a
+profiled callback are profiled too (the capture travels in a context
+variable that the pools copy). A capture is saved once the callback and
+every worker thread it started have finished, so a query that hands its
+downloads to the background still has them in its profile.
+
+The allocation snapshot is not scoped the same way: tracemalloc traces
+the whole process, so allocations made by other requests running at
+the same time show up in the capture too. Profile on an otherwise idle
+worker (e.g. a single Gunicorn worker with one thread) when the
+allocation sites matter.
+"""
+import os
+import io
+import time
+import html
+import pickle
+import pstats
+import cProfile
+import functools
+import threading
+import contextvars
+import tracemalloc
+from urllib.parse import urlparse, parse_qs
+from flask import request, has_request_context, abort
+from backend import workers
+
+ENABLED = os.environ.get("LAMONTY_PROFILING") == "1"
+PROFILE_DIR = os.environ.get("LAMONTY_PROFILE_DIR", "profiles")
+TOP_N = 25
+
+tracing_lock = threading.Lock()
+tracing_count = 0
+
+current = contextvars.ContextVar("profile_capture", default=None)
+thread_state = threading.local()
+
+
+def profiling_requested():
+    """
+    Checks whether the current request asked to be profiled
+    """
+    if not ENABLED or not has_request_context():
+        return False
+    if request.headers.get("X-Profile") == "1" or request.args.get("profile") == "1":
+        return True
+    # Dash callbacks are POSTed by the page, so look at the page's own URL too.
+    referrer_query = parse_qs(urlparse(request.referrer or "").query)
+    return referrer_query.get("profile") == ["1"]
+
+
+def start_tracing():
+    """
+    Starts tracemalloc, shared between concurrently profiled requests
+    """
+    global tracing_count
+    with tracing_lock:
+        if tracing_count == 0:
+            tracemalloc.start(10)
+        tracing_count += 1
+
+
+def stop_tracing():
+    """
+    Takes an allocation snapshot and stops tracemalloc once no other
+    profiled request is using it
+    :return: tracemalloc snapshot
+    """
+    global tracing_count
+    with tracing_lock:
+        snapshot = tracemalloc.take_snapshot()
+        tracing_count -= 1
+        if tracing_count == 0:
+            tracemalloc.stop()
+    return snapshot
+
+
+def save_capture(name, args, kwargs, duration, total, profilers, snapshot):
+    """
+    Saves a profile capture with the top functions and allocation sites
+    :param duration: seconds until the callback returned
+    :param total: seconds until the last worker thread it started finished
+    :param profilers: cProfile profiles of the callback and its worker threads
+    :return: capture id
+    """
+    stats = io.StringIO()
+    pstats.Stats(*profilers, stream=stats).sort_stats("cumulative").print_stats(TOP_N)
+    allocations = [(str(stat.traceback), stat.size, stat.count)
+                   for stat in snapshot.statistics("lineno")[:TOP_N]]
+
+    capture_id = f"{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}-{threading.get_ident()}-{name}"
+    capture = {"id": capture_id, "callback": name, "time": time.time(),
+               "duration": duration, "total": total, "threads": len(profilers),
+               "inputs": repr((args, kwargs)), "cpu": stats.getvalue(),
+               "allocations": allocations}
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    with open(os.path.join(PROFILE_DIR, capture_id + ".pkl"), "wb") as f:
+        pickle.dump(capture, f)
+    return capture_id
+
+
+class Capture:
+    """
+    One profiled callback and the worker threads it started, saved when
+    the last of them finishes
+    """
+
+    def __init__(self, name, args, kwargs):
+        self.name = name
+        self.args = args
+        self.kwargs = kwargs
+        self.lock = threading.Lock()
+        self.profilers = []
+        self.running = 0
+        self.duration = None
+        self.start = time.perf_counter()
+
+    def enter(self):
+        """
+        Starts profiling a thread working for the callback
+        :return: cProfile profile for the thread
+        """
+        profiler = cProfile.Profile()
+        with self.lock:
+            self.profilers.append(profiler)
+            self.running += 1
+        return profiler
+
+    def leave(self, callback_returned=False):
+        """
+        Marks a thread finished, saving the capture after the last one
+        :param callback_returned: True when the thread is the callback's own
+        """
+        with self.lock:
+            self.running -= 1
+            if callback_returned:
+                self.duration = time.perf_counter() - self.start
+            done = self.running == 0 and self.duration is not None
+        if done:
+            snapshot = stop_tracing()
+            save_capture(self.name, self.args, self.kwargs, self.duration,
+                         time.perf_counter() - self.start, self.profilers, snapshot)
+
+
+def run_profiled(capture, profiler, func, *args, **kwargs):
+    """
+    Runs a function under a thread's profiler, unless the thread is
+    already being profiled for the capture
+    """
+    if getattr(thread_state, "capture", None) is capture:
+        return func(*args, **kwargs)
+    thread_state.capture = capture
+    try:
+        return profiler.runcall(func, *args, **kwargs)
+    finally:
+        thread_state.capture = None
+
+
+def propagate(func):
+    """
+    Wraps a function submitted to a worker thread so it is profiled
+    along with the callback that started it, if that callback is being
+    profiled. Registered as a task hook of backend/workers.py, which runs
+    it under a copy of the caller's context
+    :param func: function to run in a worker thread
+    """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        capture = current.get()
+        if capture is None or getattr(thread_state, "capture", None) is capture:
+            return func(*args, **kwargs)
+        profiler = capture.enter()
+        try:
+            return run_profiled(capture, profiler, func, *args, **kwargs)
+        finally:
+            capture.leave()
+
+    return wrapper
+
+
+def profiled(func):
+    """
+    Decorator that profiles a callback when the request asks for it
+    :param func: Dash callback function
+    """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if not profiling_requested():
+            return func(*args, **kwargs)
+
+        start_tracing()
+        capture = Capture(func.__name__, args, kwargs)
+        profiler = capture.enter()
+        token = current.set(capture)
+        try:
+            return run_profiled(capture, profiler, func, *args, **kwargs)
+        finally:
+            current.reset(token)
+            capture.leave(callback_returned=True)
+
+    return wrapper
+
+
+def load_captures():
+    """
+    Loads every saved capture, newest first
+    """
+    if not os.path.isdir(PROFILE_DIR):
+        return []
+    captures = []
+    for filename in os.listdir(PROFILE_DIR):
+        if filename.endswith(".pkl"):
+            with open(os.path.join(PROFILE_DIR, filename), "rb") as f:
+                captures.append(pickle.load(f))
+    return sorted(captures, key=lambda capture: capture["time"], reverse=True)
+
+
+def list_profiles():
+    """
+    Debug page listing the saved captures
+    """
+    rows = "".join(
+        f"<tr><td>{time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(c['time']))}</td>"
+        f"<td><a href='/debug/profiles/{html.escape(c['id'])}'>{html.escape(c['callback'])}</a></td>"
+        f"<td>{c['duration']:.3f}s ({c.get('total', c['duration']):.3f}s with workers)</td><td><code>{html.escape(c['inputs'][:200])}</code></td></tr>"
+        for c in load_captures())
+    return ("<h1>Profile captures</h1><table border='1' cellpadding='4'>"
+            "<tr><th>Time</th><th>Callback</th><th>Duration</th><th>Inputs</th></tr>"
+            f"{rows}</table>")
+
+
+def show_profile(capture_id):
+    """
+    Debug page showing one capture's hot functions and allocation sites
+    """
+    path = os.path.join(PROFILE_DIR, os.path.basename(capture_id) + ".pkl")
+    if not os.path.exists(path):
+        abort(404)
+    with open(path, "rb") as f:
+        capture = pickle.load(f)
+
+    allocations = "".join(
+        f"<tr><td><code>{html.escape(site)}</code></td><td>{size / 1024:,.1f} KiB</td><td>{count:,}</td></tr>"
+        for site, size, count in capture["allocations"])
+    return (f"<h1>{html.escape(capture['callback'])} ({capture['duration']:.3f}s)</h1>"
+            f"<p>Worker threads finished after {capture.get('total', capture['duration']):.3f}s; "
+            f"{capture.get('threads', 1)} threads profiled.</p>"
+            f"<p>Inputs: <code>{html.escape(capture['inputs'])}</code></p>"
+            f"<h2>Top functions by cumulative time</h2><pre>{html.escape(capture['cpu'])}</pre>"
+            "<h2>Top allocation sites (live when the last thread finished)</h2>"
+            "<p>Allocations are traced for the whole process, so they include those of "
+            "any other requests served while this one ran.</p>"
+            "<table border='1' cellpadding='4'><tr><th>Site</th><th>Size</th><th>Blocks</th></tr>"
+            f"{allocations}</table>"
+            "<p><a href='/debug/profiles'>All captures</a></p>")
+
+
+def register_profiling(server):
+    """
+    Adds the profile debug pages to the Flask server, and profiles work
+    the backend hands to worker threads, when profiling is enabled
+    :param server: Flask app behind the Dash app
+    """
+    if ENABLED:
+        workers.add_task_hook(propagate)
+        server.add_url_rule("/debug/profiles", "list_profiles", list_profiles)
+        server.add_url_rule("/debug/profiles/<capture_id>", "show_profile", show_profile)
@@ -0,0 +1,338 @@
+"""
+(la)Monty Python
+
+Spatial index over county polygons for deriving a storm's scope from
+its track.
+
+County bounding boxes are packed into a sort-tile-recursive tree, so
+each track point is only tested against the few counties whose boxes
+it falls in. Point-in-polygon and point-to-boundary distance tests are
+vectorized with NumPy across every candidate (point, county) pair.
+"""
+import math
+import numpy as np
+import pandas as pd
+
+KM_PER_DEG_LAT = 110.57
+KM_PER_DEG_LON = 111.32
+NODE_CAPACITY = 16
+
+
+def polygon_rings(geometry):
+    """
+    Lists the rings (exterior and holes) of a GeoJSON Polygon or MultiPolygon.
+
+    :param geometry: GeoJSON geometry dict
+
+    :return: (lst) of (n, 2) arrays of lon/lat vertices
+    """
+    if geometry["type"] == "Polygon":
+        polygons = [geometry["coordinates"]]
+    else:
+        polygons = geometry["coordinates"]
+    return [np.asarray(ring, dtype=float)[:, :2] for polygon in polygons for ring in polygon]
+
+
+def str_pack(boxes, capacity):
+    """
+    Groups boxes into nodes of at most `capacity` boxes using
+    sort-tile-recursive packing.
+
+    :param boxes: (n, 4) array of minx, miny, maxx, maxy
+
+    :return: permutation of the boxes and the (start, count) of
+            each node within the permuted order
+    """
+    n = len(boxes)
+    n_nodes = math.ceil(n / capacity)
+    n_slices = math.ceil(math.sqrt(n_nodes))
+    center_x = (boxes[:, 0] + boxes[:, 2]) / 2
+    center_y = (boxes[:, 1] + boxes[:, 3]) / 2
+
+    order = []
+    starts = []
+    by_x = np.argsort(center_x, kind="stable")
+    for tile in np.array_split(by_x, n_slices):
+        tile = tile[np.argsort(center_y[tile], kind="stable")]
+        starts.extend(range(len(order), len(order) + len(tile), capacity))
+        order.extend(tile)
+
+    starts = np.asarray(starts)
+    counts = np.diff(np.append(starts, len(order)))
+    return np.asarray(order), starts, counts
+
+
+def expand_ranges(starts, counts):
+    """
+    Expands (start, count) ranges into the indices they cover.
+
+    :return: (array) owner of each index and (array) the indices
+    """
+    owners = np.repeat(np.arange(len(starts)), counts)
+    offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    return owners, np.repeat(starts, counts) + offsets
+
+
+class CountyIndex:
+    """
+    Bounding-box tree and edge arrays for the county polygons.
+    """
+
+    def __init__(self, counties):
+        """
+        Constructor.
+
+        :param counties: GeoJSON FeatureCollection of counties with
+                5-digit FIPS codes as feature ids
+        """
+        self.fips = np.array([feature["id"] for feature in counties["features"]])
+
+        edge_parts = []
+        edge_counts = []
+        boxes = []
+        for feature in counties["features"]:
+            rings = polygon_rings(feature["geometry"])
+            edges = np.vstack([np.hstack([ring[:-1], ring[1:]]) for ring in rings])
+            vertices = np.vstack(rings)
+            edge_parts.append(edges)
+            edge_counts.append(len(edges))
+            boxes.append([*vertices.min(axis=0), *vertices.max(axis=0)])
+
+        self.edges = np.vstack(edge_parts)
+        self.edge_counts = np.asarray(edge_counts)
+        self.edge_starts = np.cumsum(self.edge_counts) - self.edge_counts
+        self.boxes = np.asarray(boxes)
+        self.build_tree()
+
+
+    def build_tree(self):
+        """
+        Builds the tree bottom-up. Each level stores node boxes and the
+        (start, count) of each node's children in the level below; the
+        bottom level holds the county boxes themselves.
+        """
+        order, starts, counts = str_pack(self.boxes, NODE_CAPACITY)
+        self.leaf_ids = order
+        self.leaf_boxes = self.boxes[order]
+
+        child_boxes = self.leaf_boxes
+        self.levels = []
+        while True:
+            node_boxes = np.hstack([np.minimum.reduceat(child_boxes[:, :2], starts),
+                                    np.maximum.reduceat(child_boxes[:, 2:], starts)])
+            if len(node_boxes) <= NODE_CAPACITY:
+                self.levels.append((node_boxes, starts, counts))
+                break
+            # Reordering this level's nodes keeps their child ranges valid.
+            order, next_starts, next_counts = str_pack(node_boxes, NODE_CAPACITY)
+            self.levels.append((node_boxes[order], starts[order], counts[order]))
+            child_boxes = node_boxes[order]
+            starts, counts = next_starts, next_counts
+        self.levels.reverse()
+
+
+    def candidates(self, query_boxes):
+        """
+        Finds counties whose bounding box intersects each query box.
+
+        :param query_boxes: (m, 4) array of minx, miny, maxx, maxy
+
+        :return: (array) query index and (array) county index of each
+                intersecting pair
+        """
+        def intersects(boxes, queries):
+            return ((boxes[:, 0] <= queries[:, 2]) & (boxes[:, 2] >= queries[:, 0])
+                    & (boxes[:, 1] <= queries[:, 3]) & (boxes[:, 3] >= queries[:, 1]))
+
+        top_boxes = self.levels[0][0]
+        query_idx = np.repeat(np.arange(len(query_boxes)), len(top_boxes))
+        node_idx = np.tile(np.arange(len(top_boxes)), len(query_boxes))
+
+        for level, (node_boxes, starts, counts) in enumerate(self.levels):
+            if level > 0:
+                owners, node_idx = expand_ranges(starts_above[node_idx], counts_above[node_idx])
+                query_idx = query_idx[owners]
+            keep = intersects(node_boxes[node_idx], query_boxes[query_idx])
+            query_idx, node_idx = query_idx[keep], node_idx[keep]
+            starts_above, counts_above = starts, counts
+
+        owners, leaf_idx = expand_ranges(starts_above[node_idx], counts_above[node_idx])
+        query_idx = query_idx[owners]
+        keep = intersects(self.leaf_boxes[leaf_idx], query_boxes[query_idx])
+
+        return query_idx[keep], self.leaf_ids[leaf_idx[keep]]
+
+
+    def pair_edges(self, county_idx):
+        """
+        Expands (point, county) pairs to every edge of each county.
+
+        :param county_idx: (array) county index of each pair
+
+        :return: (array) pair of each edge and (k, 4) array of edges
+        """
+        pair_idx, edge_idx = expand_ranges(self.edge_starts[county_idx],
+                                           self.edge_counts[county_idx])
+        return pair_idx, self.edges[edge_idx]
+
+
+    def locate(self, lon, lat):
+        """
+        Finds the county containing each point.
+
+        :param lon: (array) point longitudes
+        :param lat: (array) point latitudes
+
+        :return: (array) FIPS code of the containing county, or None
+        """
+        lon, lat = np.asarray(lon, dtype=float), np.asarray(lat, dtype=float)
+        point_idx, county_idx = self.candidates(np.column_stack([lon, lat, lon, lat]))
+        inside = self.contains(lon[point_idx], lat[point_idx], county_idx)
+
+        located = np.full(len(lon), None, dtype=object)
+        located[point_idx[inside]] = self.fips[county_idx[inside]]
+        return located
+
+
+    def contains(self, lon, lat, county_idx):
+        """
+        Even-odd point-in-polygon test for (point, county) pairs.
+
+        :param lon: (array) longitude of each pair's point
+        :param lat: (array) latitude of each pair's point
+        :param county_idx: (array) county index of each pair
+
+        :return: (array) True where the point lies inside the county
+        """
+        pair_idx, edges = self.pair_edges(county_idx)
+        px, py = lon[pair_idx], lat[pair_idx]
+        x1, y1, x2, y2 = edges.T
+        straddles = (y1 > py) != (y2 > py)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            cross_x = x1 + (py - y1) * (x2 - x1) / (y2 - y1)
+        crossings = np.bincount(pair_idx, weights=straddles & (px < cross_x),
+                                minlength=len(county_idx))
+        return crossings % 2 == 1
+
+
+    def boundary_distance(self, lon, lat, county_idx):
+        """
+        Distance in km from each pair's point to the county boundary, using
+        an equirectangular projection centred on the point.
+
+        :return: (array) distance of each pair
+        """
+        pair_idx, edges = self.pair_edges(county_idx)
+        scale_x = KM_PER_DEG_LON * np.cos(np.radians(lat[pair_idx]))
+        px, py = lon[pair_idx] * scale_x, lat[pair_idx] * KM_PER_DEG_LAT
+        x1, x2 = edges[:, 0] * scale_x, edges[:, 2] * scale_x
+        y1, y2 = edges[:, 1] * KM_PER_DEG_LAT, edges[:, 3] * KM_PER_DEG_LAT
+
+        dx, dy = x2 - x1, y2 - y1
+        length_sq = dx * dx + dy * dy
+        with np.errstate(divide="ignore", invalid="ignore"):
+            t = np.clip(((px - x1) * dx + (py - y1) * dy) / length_sq, 0, 1)
+        t = np.nan_to_num(t)
+        distance = np.hypot(x1 + t * dx - px, y1 + t * dy - py)
+
+        starts = np.cumsum(self.edge_counts[county_idx]) - self.edge_counts[county_idx]
+        return np.minimum.reduceat(distance, starts)
+
+
+    def within_distance(self, lon, lat, radius_km):
+        """
+        Finds counties inside or within a radius of any of the points.
+
+        :param lon: (array) point longitudes
+        :param lat: (array) point latitudes
+        :param radius_km: (float) buffer radius around each point
+
+        :return: (array) sorted FIPS codes of the matching counties
+        """
+        lon, lat = np.asarray(lon, dtype=float), np.asarray(lat, dtype=float)
+        pad_lat = radius_km / KM_PER_DEG_LAT
+        pad_lon = radius_km / (KM_PER_DEG_LON * np.maximum(np.cos(np.radians(lat)), 0.01))
+        query_boxes = np.column_stack([lon - pad_lon, lat - pad_lat, lon + pad_lon, lat + pad_lat])
+
+        point_idx, county_idx = self.candidates(query_boxes)
+        if len(point_idx) == 0:
+            return np.array([], dtype=self.fips.dtype)
+
+        plon, plat = lon[point_idx], lat[point_idx]
+        hit = self.contains(plon, plat, county_idx)
+        near = ~hit
+        hit[near] = self.boundary_distance(plon[near], plat[near], county_idx[near]) <= radius_km
+
+        return np.unique(self.fips[county_idx[hit]])
+
+
+def densify_track(lon, lat, spacing_km):
+    """
+    Inserts points along each track segment so consecutive points are
+    at most `spacing_km` apart, turning a buffered polyline into a set
+    of buffered points.
+
+    :return: (array) longitudes and (array) latitudes
+    """
+    lon, lat = np.asarray(lon, dtype=float), np.asarray(lat, dtype=float)
+    if len(lon) < 2:
+        return lon, lat
+
+    step_km = np.hypot((lon[1:] - lon[:-1]) * KM_PER_DEG_LON * np.cos(np.radians(lat[:-1])),
+                       (lat[1:] - lat[:-1]) * KM_PER_DEG_LAT)
+    steps = np.maximum(np.ceil(step_km / spacing_km).astype(int), 1)
+    segment_idx = np.repeat(np.arange(len(steps)), steps)
+    fraction = (np.arange(steps.sum()) - np.repeat(np.cumsum(steps) - steps, steps)) / steps[segment_idx]
+
+    dense_lon = lon[segment_idx] + fraction * (lon[segment_idx + 1] - lon[segment_idx])
+    dense_lat = lat[segment_idx] + fraction * (lat[segment_idx + 1] - lat[segment_idx])
+    return np.append(dense_lon, lon[-1]), np.append(dense_lat, lat[-1])
+
+
+def storm_scope(county_index, track, radius_km=50):
+    """
+    Computes the counties and states affected by a storm, i.e. those
+    within `radius_km` of its track.
+
+    :param county_index: CountyIndex
+    :param track: Pandas dataframe of one storm's IBTrACS rows with
+            LAT, LON and SEASON columns
+    :param radius_km: (float) buffer radius around the track
+
+    :return: (dict) "counties_fips", "states_fips" and "year" lists,
+            in the same shape as the entries of hurricane_scope.json
+    """
+    lon, lat = densify_track(pd.to_numeric(track["LON"]), pd.to_numeric(track["LAT"]),
+                             radius_km / 2)
+    counties = county_index.within_distance(lon, lat, radius_km)
+
+    return {"counties_fips": [str(fips) for fips in counties],
+            "states_fips": sorted({str(fips)[:2] for fips in counties}),
+            "year": sorted({int(season) for season in track["SEASON"]})}
+
+
+def state_neighbors(counties, decimals=4):
+    """
+    Finds the states sharing a border, i.e. those with counties that
+    share a polygon vertex.
+
+    :param counties: GeoJSON FeatureCollection of counties with
+            5-digit FIPS codes as feature ids
+    :param decimals: (int) decimals vertices are rounded to before matching
+
+    :return: (dict) state FIPS code to sorted list of neighboring state FIPS codes
+    """
+    states_at = {}
+    for feature in counties["features"]:
+        state = str(feature["id"]).zfill(5)[:2]
+        for ring in polygon_rings(feature["geometry"]):
+            for vertex in map(tuple, np.round(ring, decimals)):
+                states_at.setdefault(vertex, set()).add(state)
+
+    neighbors = {}
+    for states in states_at.values():
+        if len(states) > 1:
+            for state in states:
+                neighbors.setdefault(state, set()).update(states - {state})
+
+    return {state: sorted(others) for state, others in neighbors.items()}
@@ -5,17 +5,35 @@ March 2022
 
 Module to initialize mapbox set up
 """
+import os
 import json
+import hashlib
+import functools
 import pandas as pd
+from flask import send_file
+
+COUNTIES_GEOJSON = 'data/geojson-counties-fips.json'
+GEOMETRY_MAX_AGE = 365 * 24 * 60 * 60
+
+def read_reference(name, **csv_kwargs):
+    """
+    Reads a reference table written by data/ingest.py, preferring the
+    typed parquet file when one has been built
+    :param name: path to the table without file extension
+    :param csv_kwargs: options for reading the csv fallback
+    """
+    if os.path.exists(name + ".parquet"):
+        return pd.read_parquet(name + ".parquet")
+    return pd.read_csv(name + ".csv", **csv_kwargs)
 
 def detail_view_init():
     """
     Opens set up json files to initialize chloropleth map
     """
-    with open('data/geojson-counties-fips.json', 'r') as f:
+    with open(COUNTIES_GEOJSON, 'r') as f:
         counties = json.load(f)
-    winner = pd.read_csv("data/county_president_winner.csv", dtype={"county_fips": str})
-    hurricane_path = pd.read_csv("data/hurricane_path.csv")
+    winner = read_reference("data/county_president_winner", dtype={"county_fips": str})
+    hurricane_path = read_reference("data/hurricane_path")
     with open('data/hurricane_scope.json', 'r') as f:
         hurricane_scope = json.load(f)
     hurricanes = hurricane_path['NAME'].unique()
@@ -27,3 +45,29 @@ def get_election_year(year):
     :param year: integer year
     """
     return year - year%4
+
+
+@functools.lru_cache(maxsize=None)
+def counties_url():
+    """
+    URL of the county geometry, versioned by a hash of the file so
+    browsers can cache it for good and still pick up a new file
+    """
+    with open(COUNTIES_GEOJSON, 'rb') as f:
+        version = hashlib.sha1(f.read()).hexdigest()[:12]
+    return f'/geometry/counties-{version}.json'
+
+def register_geometry(server):
+    """
+    Serves the county geometry as a static file with long-lived cache
+    headers, so choropleth figures can reference it by URL instead of
+    embedding it in every callback response
+    :param server: Flask app behind the Dash app
+    """
+    @server.route('/geometry/counties-<version>.json')
+    def counties_geometry(version):
+        response = send_file(os.path.abspath(COUNTIES_GEOJSON), mimetype='application/json',
+                             max_age=GEOMETRY_MAX_AGE, conditional=True)
+        response.cache_control.public = True
+        response.cache_control.immutable = True
+        return response